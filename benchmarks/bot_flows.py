@@ -0,0 +1,256 @@
+# End-to-end handler throughput: simulated users go through /start, the crypto purchase flow, admin approval,
+# wallet renewal, a purchase verified on-chain by the payment verifier and an admin bulk job. Updates are fed straight into the dispatcher; every panel and Bot API
+# call goes over HTTP to the in-process fakes in fakes.py. Telegram rate limits are lifted so the numbers show
+# the bot's own cost, not the flood-control pacing.
+#   python benchmarks/bot_flows.py --users 2000 --concurrency 100 --bulk 500
+# Each run is written to benchmarks/results/ and compared against the previous run.
+import argparse, asyncio, itertools, json, os, secrets, subprocess, tempfile, time
+from datetime import datetime
+from pathlib import Path
+
+from common import ROOT, load_bot, percentiles
+from fakes import FakeBotAPI, FakeExplorer, FakePanel
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+ADMIN_ID = 1
+USER_BASE = 10_000_000
+PLAN_KEY = "plan_a"
+
+class StaticPrices:
+    name = "bench"
+
+    async def fetch(self, client, symbols: list) -> dict:
+        return {symbol: 50_000.0 for symbol in symbols}
+
+class Driver:
+    """Builds Telegram updates for simulated users and feeds them to the dispatcher."""
+
+    def __init__(self, vb):
+        self.vb = vb
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, text: str, from_bot: bool = False) -> dict:
+        sender = {"id": 1, "is_bot": True, "first_name": "bench"} if from_bot else self._user(user_id)
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": sender, "text": text}
+
+    async def _feed(self, payload: dict):
+        update = self.vb.Update.model_validate({"update_id": next(self._update_ids), **payload}, context={"bot": self.vb.bot})
+        await self.vb.dp.feed_update(self.vb.bot, update)
+
+    async def text(self, user_id: int, text: str):
+        await self._feed({"message": self._message(user_id, text)})
+
+    async def press(self, user_id: int, data: str, text: str = "menu"):
+        await self._feed({"callback_query": {"id": secrets.token_hex(8), "from": self._user(user_id), "chat_instance": "bench",
+                                             "data": data, "message": self._message(user_id, text, from_bot=True)}})
+
+async def run_scenario(name: str, flow, items: list, concurrency: int) -> dict:
+    gate = asyncio.Semaphore(concurrency)
+    samples, errors = [], 0
+
+    async def one(item):
+        nonlocal errors
+        async with gate:
+            started = time.perf_counter()
+            try:
+                await flow(item)
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"  {name}: first error for {item}: {e!r}")
+                return
+            samples.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(item) for item in items))
+    elapsed = time.perf_counter() - started
+    stats = percentiles(samples or [0.0])
+    return {"ops": len(samples), "errors": errors, "elapsed": elapsed, "ops_per_s": len(samples) / elapsed,
+            "p50_ms": stats["p50"], "p99_ms": stats["p99"], "mean_ms": stats["mean"]}
+
+async def wait_for_bulk(vb, job_id: int, timeout: float = 600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = await vb.bulk_repo.get(job_id)
+        if job and job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(0.05)
+    raise TimeoutError(f"bulk job {job_id} did not finish")
+
+async def wait_for_job(vb, where: str, params: tuple, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = await vb.db.fetchone(f"SELECT id, status, last_error FROM provision_jobs WHERE {where} ORDER BY id DESC LIMIT 1", params)
+        if job and job["status"] == "done":
+            return job
+        if job and job["status"] == "failed":
+            raise RuntimeError(f"provisioning job {job['id']} failed: {job['last_error']}")
+        await asyncio.sleep(0.05)
+    raise TimeoutError(f"provisioning job ({where} {params}) did not finish")
+
+async def run_all(vb, api: FakeBotAPI, panel: FakePanel, explorer: FakeExplorer, args) -> dict:
+    driver = Driver(vb)
+    users = [USER_BASE + i for i in range(args.users)]
+    plan = vb.SUB_PLANS_V2[PLAN_KEY]
+    results = {}
+
+    async def start(user_id):
+        await driver.text(user_id, "/start")
+
+    # With `paid`, the exact amount of the invoice the bot quoted is put on chain before the TxID is sent
+    async def purchase(user_id, name: str = None, paid: bool = False):
+        for data in ("buy_menu", "buy_v2ray"):
+            await driver.press(user_id, data)
+        await driver.text(user_id, name or f"bench{user_id}")
+        for data in ("skip_discount", f"purchase_plan_{PLAN_KEY}", "pay_crypto", "crypto_type_TRX"):
+            await driver.press(user_id, data)
+        txid = secrets.token_hex(32)
+        if paid:
+            invoice = await vb.db.fetchone("SELECT amount FROM invoices WHERE user_id = ? ORDER BY created_at DESC, rowid DESC LIMIT 1", (user_id,))
+            explorer.add("TRX", txid, vb.WALLET_TRX, invoice["amount"])
+        await driver.text(user_id, txid)
+
+    # Measured until the service exists, so it includes the verifier's batching delay and explorer lookup
+    async def autopay(user_id):
+        name = f"auto{user_id}"
+        await purchase(user_id, name, paid=True)
+        deadline = time.monotonic() + 120
+        while not await vb.service_repo.get_by_remark(name):
+            if time.monotonic() > deadline: raise TimeoutError(f"{name} was not provisioned")
+            await asyncio.sleep(0.05)
+
+    # The admin presses the approve button the bot actually sent for each receipt; paid orders are measured until
+    # their provisioning job is done
+    async def approve(data):
+        await driver.press(ADMIN_ID, data, text="receipt")
+        await wait_for_job(vb, "idempotency_key = ?", (f"invoice:{data.replace('inv_ok_', '')}",))
+
+    async def renew(user_id):
+        for data in ("renew_menu", "skip_discount", f"purchase_plan_{PLAN_KEY}", "pay_from_wallet"):
+            await driver.press(user_id, data)
+        await wait_for_job(vb, "user_id = ? AND kind = 'renew'", (user_id,))
+
+    results["start"] = await run_scenario("start", start, users, args.concurrency)
+    vb.PAYMENT_AUTO_VERIFY = False  # receipts go to the admins for the approve scenario
+    results["purchase"] = await run_scenario("purchase", purchase, users, args.concurrency)
+    approvals = [data for data in api.buttons.get(ADMIN_ID, []) if data.startswith("inv_ok_")]
+    results["approve"] = await run_scenario("approve", approve, approvals, args.concurrency)
+    for user_id in users:
+        await vb.wallet_repo.credit(user_id, plan["price"], "adjust")
+    results["renew"] = await run_scenario("renew", renew, users, args.concurrency)
+    vb.PAYMENT_AUTO_VERIFY = True
+    vb.payment_verifier.start()
+    results["autopay"] = await run_scenario("autopay", autopay, users, args.concurrency)
+
+    if args.bulk:
+        started = time.perf_counter()
+        await driver.press(ADMIN_ID, "bulk_create_start")
+        await driver.press(ADMIN_ID, f"bulk_plan_{PLAN_KEY}")
+        await driver.text(ADMIN_ID, str(args.bulk))
+        await driver.text(ADMIN_ID, "benchbulk")
+        job = await wait_for_bulk(vb, (await vb.db.fetchone("SELECT MAX(id) AS id FROM bulk_jobs"))["id"])
+        elapsed = time.perf_counter() - started
+        results["bulk"] = {"ops": job["committed"], "errors": job["quantity"] - job["committed"], "elapsed": elapsed,
+                           "ops_per_s": job["committed"] / elapsed, "p50_ms": None, "p99_ms": None, "mean_ms": None}
+
+    services = (await vb.db.fetchone("SELECT COUNT(*) AS n FROM services"))["n"]
+    print(f"panel clients: {panel.client_count()}   services rows: {services}   Bot API calls: {sum(api.calls.values())}")
+    return results
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def fmt_ms(value) -> str:
+    return f"{value:>8.1f}" if value is not None else f"{'-':>8}"
+
+def delta(new, old) -> str:
+    if not new or not old: return ""
+    return f"{(new - old) / old * 100:+.0f}%"
+
+def report(results: dict, previous: dict):
+    if previous:
+        print(f"(compared with {previous['file']}, commit {previous['commit']})")
+    print(f"{'scenario':<10} {'ops':>6} {'err':>4} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8}   {'Δ ops/s':>8} {'Δ p99':>7}")
+    for name, r in results.items():
+        old = (previous or {}).get("scenarios", {}).get(name, {})
+        print(f"{name:<10} {r['ops']:>6} {r['errors']:>4} {r['ops_per_s']:>9.1f} {fmt_ms(r['p50_ms'])} {fmt_ms(r['p99_ms'])}"
+              f"   {delta(r['ops_per_s'], old.get('ops_per_s')):>8} {delta(r['p99_ms'], old.get('p99_ms')):>7}")
+
+def save(results: dict, args) -> dict:
+    RESULTS_DIR.mkdir(exist_ok=True)
+    runs = sorted(RESULTS_DIR.glob("bot_flows-*.json"))
+    previous = None
+    if runs:
+        previous = json.loads(runs[-1].read_text())
+        previous["file"] = runs[-1].name
+    path = RESULTS_DIR / f"bot_flows-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    path.write_text(json.dumps({"commit": git_commit(), "date": datetime.now().isoformat(timespec="seconds"), "args": vars(args), "scenarios": results}, indent=2))
+    print(f"results written to {path.relative_to(ROOT)}")
+    return previous
+
+# Runs the real RedisStorage/RedisEventIsolation code path against fakeredis's TCP server, so --fsm redis
+# needs no Redis install (pip install fakeredis lupa). That server drops the connection on any error reply,
+# including the NOSCRIPT redis-py's lock recovers from on a real server, so the lock scripts are loaded first.
+async def start_fake_redis():
+    import threading
+    import redis.asyncio as redis
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "redis://%s:%d/0" % server.server_address
+    client = redis.from_url(url)
+    for script in (redis.lock.Lock.LUA_RELEASE_SCRIPT, redis.lock.Lock.LUA_EXTEND_SCRIPT, redis.lock.Lock.LUA_REACQUIRE_SCRIPT):
+        await client.script_load(script)
+    await client.aclose()
+    return server, url
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--bulk", type=int, default=500, help="clients in the bulk job (0 skips it)")
+    parser.add_argument("--panel-latency", type=float, default=0.0, help="ms added to every panel request")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="ms added to every Bot API request")
+    parser.add_argument("--fsm", choices=("sqlite", "memory", "redis"), default="sqlite", help="FSM_STORAGE backend")
+    parser.add_argument("--redis-url", help="Redis server for --fsm redis (default: an in-process fakeredis server)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bot_flows-")
+    os.chdir(workdir)
+    panel = await FakePanel([("bench_v2ray", "vless"), ("bench_wg", "wireguard")], latency_ms=args.panel_latency).start()
+    api = await FakeBotAPI(latency_ms=args.api_latency).start()
+    explorer = await FakeExplorer().start()
+    redis_url, redis_server = args.redis_url, None
+    if args.fsm == "redis" and not redis_url:
+        redis_server, redis_url = await start_fake_redis()
+    vb = load_bot(
+        ADMIN_IDS=ADMIN_ID, TELEGRAM_API_URL=api.url, TXUI_PANEL_URL=panel.url, TXUI_USERNAME="bench", TXUI_PASSWORD="bench",
+        SERVER_DOMAIN="vpn.example.com", TEST_INBOUND_REMARK="bench_v2ray", WALLET_TRX="TBenchWallet", WALLET_TON="UQBenchWallet",
+        DB_PATH=os.path.join(workdir, "bench.db"), BULK_DIR=os.path.join(workdir, "bulk"), METRICS_PORT=0, PRICE_SOURCES="",
+        MONITOR_INTERVAL=86400, TRX_EXPLORER_URL=explorer.url, TON_EXPLORER_URL=explorer.url, FSM_STORAGE=args.fsm, FSM_REDIS_URL=redis_url or "", TG_GLOBAL_RATE=1_000_000, TG_CHAT_RATE=1_000_000, TG_GROUP_RATE=1_000_000, TG_CHAT_BURST=1_000_000,
+    )
+    vb.price_feed.sources.append(StaticPrices())
+    vb.register_middlewares()
+    await vb.dp.emit_startup(bot=vb.bot)
+    print(f"{args.users} users, concurrency {args.concurrency}, panel +{args.panel_latency:g} ms, Bot API +{args.api_latency:g} ms, FSM {args.fsm} ({workdir})")
+    try:
+        results = await run_all(vb, api, panel, explorer, args)
+    finally:
+        await vb.dp.emit_shutdown(bot=vb.bot)
+        await vb.bot.session.close()
+        await api.close()
+        await explorer.close()
+        await panel.close()
+        if redis_server:
+            redis_server.shutdown()
+    report(results, save(results, args))
+
+if __name__ == "__main__":
+    asyncio.run(main())
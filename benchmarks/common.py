@@ -0,0 +1,30 @@
+import importlib.abc, importlib.util, os, statistics, sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BOT_SCRIPT = ROOT / "vpnbot example.py"
+
+# The bot lives in a standalone script, so benchmarks load it by path. A syntactically valid dummy token
+# is enough for aiogram to build the Bot object; nothing here talks to Telegram.
+def load_bot(**env):
+    os.environ.setdefault("API_TOKEN", "123456:BENCHMARK")
+    for key, value in env.items():
+        os.environ[key] = str(value)
+    spec = importlib.util.spec_from_file_location("vpnbot", BOT_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["vpnbot"] = module
+    spec.loader.exec_module(module)
+    return module
+
+# The QR pool's spawned workers unpickle bot functions by module name, so "vpnbot" must be importable there
+# too. They re-run the benchmark's main module, which imports this one and installs the finder.
+class BotFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path=None, target=None):
+        return importlib.util.spec_from_file_location(name, BOT_SCRIPT) if name == "vpnbot" else None
+
+sys.meta_path.append(BotFinder())
+
+def percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"n": len(ordered), "mean": statistics.fmean(ordered), "p50": pick(0.50), "p99": pick(0.99)}
@@ -0,0 +1,86 @@
+# Lookup latency on the users table before and after the indexed schema migration.
+#   python benchmarks/db_lookups.py --users 1000000
+import argparse, os, random, sqlite3, sys, tempfile, time
+from datetime import datetime, timedelta
+
+from common import load_bot, percentiles
+
+def populate(conn, users: int):
+    today = datetime.now()
+    rows = []
+    for user_id in range(1, users + 1):
+        has_service = user_id % 3 != 0
+        expire = (today + timedelta(days=random.randint(-30, 60))).strftime('%Y-%m-%d') if has_service else None
+        referrer = random.randint(1, users) if user_id % 4 == 0 else None
+        rows.append((user_id, f"user{user_id}", f"svc{user_id}" if has_service else None, expire, referrer, "v2ray"))
+        if len(rows) == 50000:
+            conn.executemany("INSERT INTO users (user_id, username, remarks, expire_date, referrer_id, service_type) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            rows.clear()
+    if rows:
+        conn.executemany("INSERT INTO users (user_id, username, remarks, expire_date, referrer_id, service_type) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+def timed(conn, sql: str, params_fn, rounds: int) -> dict:
+    samples = []
+    for _ in range(rounds):
+        params = params_fn()
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return percentiles(samples)
+
+def report(title: str, results: dict):
+    print(f"\n{title}")
+    for name, stats in results.items():
+        print(f"  {name:<22} p50 {stats['p50']:>10.1f} us   p99 {stats['p99']:>10.1f} us   (n={stats['n']})")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--rounds", type=int, default=20, help="samples per query on the unindexed schema")
+    args = parser.parse_args()
+
+    bot = load_bot()
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = sqlite3.connect(path)
+    for pragma in bot.Database.PRAGMAS:
+        conn.execute(pragma)
+    bot.migration_baseline(conn)
+    conn.execute("PRAGMA user_version = 1")
+
+    started = time.perf_counter()
+    populate(conn, args.users)
+    print(f"populated {args.users:,} users in {time.perf_counter() - started:.1f}s ({path})")
+
+    rand_user = lambda: (random.randint(1, args.users),)
+    rand_remark = lambda: (f"svc{random.randint(1, args.users)}",)
+    day = lambda: (datetime.now() + timedelta(days=random.randint(0, 3)))
+    date_window = lambda: (lambda d: (d.strftime('%Y-%m-%d'), (d + timedelta(days=1)).strftime('%Y-%m-%d')))(day())
+    epoch_window = lambda: (lambda d: (int(d.timestamp()), int((d + timedelta(days=1)).timestamp())))(day())
+
+    report("v1 schema (no secondary indexes)", {
+        "referrals by referrer": timed(conn, "SELECT COUNT(*) FROM users WHERE referrer_id = ?", rand_user, args.rounds),
+        "user by remark": timed(conn, "SELECT user_id FROM users WHERE remarks = ?", rand_remark, args.rounds),
+        "expiring in 1 day": timed(conn, "SELECT user_id FROM users WHERE expire_date BETWEEN ? AND ?", date_window, args.rounds),
+    })
+
+    started = time.perf_counter()
+    for version, (name, step) in enumerate(bot.MIGRATIONS[1:], start=2):
+        conn.execute("BEGIN IMMEDIATE")
+        step(conn)
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+    print(f"\nmigrated in place to v{len(bot.MIGRATIONS)} in {time.perf_counter() - started:.1f}s")
+
+    rounds = args.rounds * 100
+    report(f"v{len(bot.MIGRATIONS)} schema (indexed)", {
+        "referrals by referrer": timed(conn, "SELECT COUNT(*) FROM users WHERE referrer_id = ?", rand_user, rounds),
+        "user by remark": timed(conn, "SELECT user_id FROM users WHERE remarks = ?", rand_remark, rounds),
+        "expiring in 1 day": timed(conn, "SELECT user_id FROM users WHERE expire_at BETWEEN ? AND ?", epoch_window, rounds),
+        "services of a user": timed(conn, "SELECT * FROM services WHERE user_id = ?", rand_user, rounds),
+        "service by remark": timed(conn, "SELECT * FROM services WHERE remark = ?", rand_remark, rounds),
+    })
+    conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# In-process stand-ins for a 3x-ui panel, the Telegram Bot API and the TRX/TON chain explorers, so benchmarks can
+# drive the bot end to end without live services. Each takes an optional per-request latency to approximate a remote server.
+import asyncio, base64, itertools, json, time
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+class FakeServer(ABC):
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self._runner = None
+        self.url = None
+
+    @abstractmethod
+    async def handle(self, request: web.Request) -> web.Response:
+        """Answers one request; the subclass decides which endpoints exist."""
+
+    async def _dispatch(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await self.handle(request)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{tail:.*}", self._dispatch)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.url = f"http://{host}:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+class FakePanel(FakeServer):
+    """The subset of the 3x-ui API the bot calls: login, inbound list/get/update and per-client endpoints."""
+
+    def __init__(self, inbounds: list, latency_ms: float = 0.0):
+        super().__init__(latency_ms)
+        self.inbounds = {}
+        self.sessions = itertools.count()
+        self.session = "bench"
+        for i, (remark, protocol) in enumerate(inbounds, start=1):
+            settings = {"clients": []} if protocol != "wireguard" else {"secretKey": "", "peers": []}
+            stream = json.dumps({"network": "tcp", "security": "none"}) if protocol != "wireguard" else ""
+            self.inbounds[i] = {"id": i, "remark": remark, "protocol": protocol, "port": 20000 + i, "enable": True,
+                                "up": 0, "down": 0, "settings": json.dumps(settings), "streamSettings": stream, "clientStats": []}
+
+    async def _body(self, request: web.Request) -> dict:
+        return await request.json() if request.content_type == "application/json" else dict(await request.post())
+
+    def _clients(self, inbound: dict) -> tuple:
+        settings = json.loads(inbound["settings"])
+        return settings, settings.get("clients" if inbound["protocol"] != "wireguard" else "peers", [])
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path = request.path
+        endpoint = path[path.find("/panel"):] if "/panel" in path else path
+        self.calls["/".join(endpoint.split("/")[:5])] += 1
+        if path.endswith("/login"):
+            response = web.json_response({"success": True})
+            response.set_cookie("3x-ui", self.session)
+            return response
+        # Like 3x-ui, API routes answer a session they don't know with 404
+        if "/panel/api/" in path and request.cookies.get("3x-ui") != self.session:
+            return web.json_response({"success": False, "msg": "not found"}, status=404)
+        if path.endswith("/panel/api/inbounds/list"):
+            return web.json_response({"success": True, "obj": list(self.inbounds.values())})
+        if "/panel/api/inbounds/get/" in path:
+            return web.json_response({"success": True, "obj": self.inbounds.get(int(path.rsplit("/", 1)[1]))})
+        if "/panel/api/inbounds/update/" in path:
+            body = await self._body(request)
+            self.inbounds[int(path.rsplit("/", 1)[1])].update(body)
+            return web.json_response({"success": True})
+        if path.endswith("/panel/api/inbounds/addClient"):
+            body = await self._body(request)
+            inbound = self.inbounds[int(body["id"])]
+            settings, clients = self._clients(inbound)
+            new = json.loads(body["settings"])["clients"]
+            emails = {c.get("email") for c in clients}
+            if any(c["email"] in emails for c in new):
+                return web.json_response({"success": False, "msg": "Duplicate email"})
+            clients.extend(new)
+            inbound["settings"] = json.dumps(settings)
+            inbound["clientStats"].extend({"inboundId": inbound["id"], "email": c["email"], "up": 0, "down": 0, "total": c.get("totalGB", 0),
+                                           "expiryTime": c.get("expiryTime", 0), "enable": True} for c in new)
+            return web.json_response({"success": True})
+        if "/panel/api/inbounds/updateClient/" in path:
+            client_id, body = path.rsplit("/", 1)[1], await self._body(request)
+            inbound = self.inbounds[int(body["id"])]
+            settings, clients = self._clients(inbound)
+            new = json.loads(body["settings"])["clients"][0]
+            key = {"trojan": "password", "shadowsocks": "email"}.get(inbound["protocol"], "id")
+            if not any(c.get(key) == client_id for c in clients):
+                return web.json_response({"success": False, "msg": "client not found"})
+            clients[:] = [new if c.get(key) == client_id else c for c in clients]
+            inbound["settings"] = json.dumps(settings)
+            return web.json_response({"success": True})
+        if "/panel/api/inbounds/getClientTraffics/" in path:
+            email = path.rsplit("/", 1)[1]
+            for inbound in self.inbounds.values():
+                for c in self._clients(inbound)[1]:
+                    if c.get("email") == email:
+                        return web.json_response({"success": True, "obj": {"inboundId": inbound["id"], "email": email, "up": 0, "down": 0,
+                                                                            "total": c.get("totalGB", 0), "expiryTime": c.get("expiryTime", 0), "enable": True}})
+            return web.json_response({"success": True, "obj": None})
+        return web.json_response({"success": False, "msg": "not found"}, status=404)
+
+    def expire_sessions(self):
+        self.session = f"bench-{next(self.sessions)}"
+
+    def client_count(self) -> int:
+        return sum(len(self._clients(inbound)[1]) for inbound in self.inbounds.values())
+
+class FakeBotAPI(FakeServer):
+    """Answers /bot<token>/<method> with minimal valid results; sends and edits return a fresh Message."""
+
+    MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageReplyMarkup", "editMessageCaption", "copyMessage"}
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__(latency_ms)
+        self._message_ids = itertools.count(1)
+        self.me = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        self.buttons = defaultdict(list)  # chat_id -> callback_data of every inline button sent there
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["tail"].rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        if method in self.MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id") or 0)
+            for row in json.loads(params.get("reply_markup") or "{}").get("inline_keyboard", []):
+                self.buttons[chat_id].extend(b["callback_data"] for b in row if b.get("callback_data"))
+            result = {"message_id": int(params.get("message_id") or next(self._message_ids)), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "from": self.me, "text": str(params.get("text") or params.get("caption") or "")}
+        elif method == "getMe":
+            result = self.me
+        elif method == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params.get("user_id") or 0), "is_bot": False, "first_name": "user"}}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+class FakeExplorer(FakeServer):
+    """Serves TronGrid's account transactions and toncenter v3's transactions from transfers added with add(),
+    newest first and paged the way the real APIs page (TronGrid by fingerprint, toncenter by offset)."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__(latency_ms)
+        self.transfers = defaultdict(list)  # wallet -> explorer-shaped transactions, newest first
+
+    def add(self, symbol: str, txid: str, to: str, amount: float, ok: bool = True, comment: str = None, at: float = None):
+        at = time.time() if at is None else at
+        if symbol == "TRX":
+            tx = {"txID": txid, "block_timestamp": int(at * 1000), "ret": [{"contractRet": "SUCCESS" if ok else "REVERT"}],
+                  "raw_data": {"contract": [{"type": "TransferContract", "parameter": {"value": {"to_address": to, "amount": round(amount * 1_000_000)}}}]}}
+        else:
+            content = {"decoded": {"type": "text_comment", "comment": comment}} if comment is not None else None
+            tx = {"hash": base64.b64encode(bytes.fromhex(txid)).decode(), "now": int(at),
+                  "description": {"aborted": not ok, "compute_ph": {"success": ok}, "action": {"success": ok}},
+                  "in_msg": {"source": "EQsender", "destination": to, "value": str(round(amount * 1_000_000_000)), "message_content": content}}
+        self.transfers[to].append(tx)
+        self.transfers[to].sort(key=lambda t: t.get("block_timestamp", t.get("now", 0) * 1000), reverse=True)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path, query = request.path, request.query
+        if path.startswith("/v1/accounts/"):
+            self.calls["trongrid"] += 1
+            wallet, limit, start = path.split("/")[3], int(query.get("limit", 20)), int(query.get("fingerprint", 0))
+            data = [t for t in self.transfers[wallet] if t["block_timestamp"] >= int(query.get("min_timestamp", 0))]
+            meta = {"fingerprint": str(start + limit)} if start + limit < len(data) else {}
+            return web.json_response({"success": True, "data": data[start:start + limit], "meta": meta})
+        if path.endswith("/transactions"):
+            self.calls["toncenter"] += 1
+            wallet, limit, offset = query["account"], int(query.get("limit", 10)), int(query.get("offset", 0))
+            data = [t for t in self.transfers[wallet] if t["now"] >= int(query.get("start_utime", 0))]
+            return web.json_response({"transactions": data[offset:offset + limit], "address_book": {}})
+        return web.json_response({"error": "not found"}, status=404)
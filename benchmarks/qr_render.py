@@ -0,0 +1,58 @@
+# QR renders per second for each output format, inline versus through the bot's QrRenderer pool, and how
+# long the event loop stalls while renders are in flight.
+#   python benchmarks/qr_render.py --renders 200 --workers 2
+import argparse, asyncio, time, uuid
+
+from common import load_bot, percentiles
+
+def sample_link(i: int) -> str:
+    return f"vless://{uuid.uuid4()}@vpn.example.com:443?type=ws&security=tls&path=%2Fws&host=vpn.example.com#bench_{i}"
+
+async def loop_lag(stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append((time.perf_counter() - started - 0.001) * 1000)
+
+async def run(bot, fmt: str, links: list, workers: int, pooled: bool) -> dict:
+    renderer = bot.QrRenderer(fmt=fmt, workers=workers, cache_size=len(links))
+    if pooled:
+        # spawned workers boot a fresh interpreter; that one-off startup is not render throughput
+        await asyncio.gather(*(renderer.render(f"warmup-{i}", cache=False) for i in range(workers)))
+    stop, lag = asyncio.Event(), []
+    probe = asyncio.create_task(loop_lag(stop, lag))
+    started = time.perf_counter()
+    if pooled:
+        await asyncio.gather(*(renderer.render(link) for link in links))
+    else:
+        for link in links:
+            bot.render_qr(link, fmt)
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    cached_started = time.perf_counter()
+    if pooled:
+        for link in links:
+            await renderer.render(link)
+    cached = time.perf_counter() - cached_started
+    stop.set()
+    await probe
+    renderer.close()
+    return {"rate": len(links) / elapsed, "cached_rate": len(links) / cached if pooled else None, "lag": percentiles(lag or [0.0])}
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--renders", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    links = [sample_link(i) for i in range(args.renders)]
+    for fmt in bot.QR_FORMATS:
+        for pooled in (False, True):
+            result = await run(bot, fmt, links, args.workers, pooled)
+            mode = f"pool x{args.workers}" if pooled else "inline"
+            cached = f"   cached {result['cached_rate']:>9.0f}/s" if pooled else ""
+            print(f"{fmt:<5} {mode:<8} {result['rate']:>7.1f} renders/s   loop lag p99 {result['lag']['p99']:>6.1f} ms{cached}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
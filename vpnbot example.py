@@ -1,18 +1,37 @@
-import sqlite3, qrcode, io, asyncio, httpx, json, base64, os, uuid, random, string, socket, sys
+import sqlite3, qrcode, io, asyncio, httpx, json, base64, os, uuid, random, string, socket, sys, time, threading, hashlib, multiprocessing, shutil, zipfile, heapq, itertools, contextvars, re, secrets, bisect, math, logging
 from aiogram import Bot, Dispatcher, Router, F, types, BaseMiddleware
 from aiogram.types import Message, CallbackQuery, BotCommand, Update, FSInputFile
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.filters import CommandStart, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Optional
 from dotenv import load_dotenv
-from urllib.parse import urlencode
-from aiogram.exceptions import TelegramForbiddenError
+from urllib.parse import urlencode, urlsplit
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
 from pathlib import Path
+from PIL import Image
+
+try:
+    import h2  # noqa: F401 -- httpx only negotiates HTTP/2 when h2 is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger("vpnbot")
 
 # --- Load Environment Variables from executable/script directory ---
 try:
@@ -40,6 +59,85 @@ SERVER_DOMAIN = os.getenv('SERVER_DOMAIN')
 TEST_INBOUND_REMARK = os.getenv('TEST_INBOUND_REMARK')
 WALLET_TRX = os.getenv('WALLET_TRX')
 WALLET_TON = os.getenv('WALLET_TON')
+TXUI_HTTP2 = os.getenv('TXUI_HTTP2', '1') == '1'
+TXUI_POOL_MAX_CONNECTIONS = int(os.getenv('TXUI_POOL_MAX_CONNECTIONS', '20'))
+TXUI_POOL_MAX_KEEPALIVE = int(os.getenv('TXUI_POOL_MAX_KEEPALIVE', '10'))
+TXUI_KEEPALIVE_EXPIRY = float(os.getenv('TXUI_KEEPALIVE_EXPIRY', '60'))
+INBOUND_CACHE_TTL = int(os.getenv('INBOUND_CACHE_TTL', '300'))
+TXUI_SESSION_TTL = int(os.getenv('TXUI_SESSION_TTL', '3600'))
+TXUI_API_PROBE_TTL = int(os.getenv('TXUI_API_PROBE_TTL', '3600'))
+TXUI_TOKEN_REFRESH_MARGIN = int(os.getenv('TXUI_TOKEN_REFRESH_MARGIN', '300'))
+TXUI_TIMEOUT = float(os.getenv('TXUI_TIMEOUT', '10'))
+TXUI_CONNECT_TIMEOUT = float(os.getenv('TXUI_CONNECT_TIMEOUT', '5'))
+TXUI_TIMEOUTS = {k.strip(): float(v) for k, v in (item.split('=', 1) for item in os.getenv('TXUI_TIMEOUTS', '/panel/api/inbounds/list=30,/panel/api/inbounds/update=30').split(',') if '=' in item)}
+BACKEND_RETRIES = int(os.getenv('BACKEND_RETRIES', '2'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.2'))
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET = int(os.getenv('BREAKER_RESET', '30'))
+PROVISION_COALESCE_MS = int(os.getenv('PROVISION_COALESCE_MS', '50'))
+DB_PATH = os.getenv('DB_PATH', 'example.db')
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+DB_FLUSH_MS = int(os.getenv('DB_FLUSH_MS', '50'))
+DB_FLUSH_ROWS = int(os.getenv('DB_FLUSH_ROWS', '500'))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '300'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '100000'))
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite').lower()
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0')
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', '86400'))
+PRICE_SOURCES = [s.strip() for s in os.getenv('PRICE_SOURCES', 'nobitex,wallex').split(',') if s.strip()]
+PRICE_POLL_INTERVAL = int(os.getenv('PRICE_POLL_INTERVAL', '60'))
+PRICE_MAX_STALENESS = int(os.getenv('PRICE_MAX_STALENESS', '600'))
+PRICE_TIMEOUT = float(os.getenv('PRICE_TIMEOUT', '5'))
+QR_FORMAT = os.getenv('QR_FORMAT', 'png').lower()
+QR_WORKERS = int(os.getenv('QR_WORKERS', '2'))
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', '512'))
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', '30'))
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', '1'))
+TG_GROUP_RATE = float(os.getenv('TG_GROUP_RATE', '20'))
+TG_CHAT_BURST = int(os.getenv('TG_CHAT_BURST', '3'))
+TG_MAX_RETRIES = int(os.getenv('TG_MAX_RETRIES', '3'))
+TG_LOG_MERGE_WINDOW = int(os.getenv('TG_LOG_MERGE_WINDOW', '30'))
+TXUI_NODES = os.getenv('TXUI_NODES', '')
+NODE_HEALTH_INTERVAL = int(os.getenv('NODE_HEALTH_INTERVAL', '60'))
+NODE_FAIL_THRESHOLD = int(os.getenv('NODE_FAIL_THRESHOLD', '2'))
+MONITOR_INTERVAL = int(os.getenv('MONITOR_INTERVAL', '600'))
+USAGE_ALERT_PERCENT = int(os.getenv('USAGE_ALERT_PERCENT', '70'))
+EXPIRY_ALERT_DAYS = int(os.getenv('EXPIRY_ALERT_DAYS', '3'))
+BULK_DIR = os.getenv('BULK_DIR', 'bulk_jobs')
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '50'))
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', '10'))
+SUB_URL_BASE = os.getenv('SUB_URL_BASE', '')
+SUB_URL_PATH = os.getenv('SUB_URL_PATH', '/sub')
+SUB_URL_CACHE_TTL = int(os.getenv('SUB_URL_CACHE_TTL', '300'))
+SUB_URL_CACHE_SIZE = int(os.getenv('SUB_URL_CACHE_SIZE', '50000'))
+SUB_URL_UPDATE_HOURS = int(os.getenv('SUB_URL_UPDATE_HOURS', '12'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('WEB_PORT', '8080'))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv('UPDATE_ENQUEUE_TIMEOUT', '5'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+PAYMENT_AUTO_VERIFY = os.getenv('PAYMENT_AUTO_VERIFY', '1') == '1'
+PAYMENT_VERIFY_INTERVAL = int(os.getenv('PAYMENT_VERIFY_INTERVAL', '30'))
+PAYMENT_VERIFY_TIMEOUT = int(os.getenv('PAYMENT_VERIFY_TIMEOUT', '1800'))
+PAYMENT_AMOUNT_TOLERANCE = float(os.getenv('PAYMENT_AMOUNT_TOLERANCE', '1.0'))
+INVOICE_TTL = int(os.getenv('INVOICE_TTL', '3600'))
+INVOICE_SWEEP_INTERVAL = int(os.getenv('INVOICE_SWEEP_INTERVAL', '60'))
+PROVISION_JOB_WORKERS = int(os.getenv('PROVISION_JOB_WORKERS', '10'))
+PROVISION_JOB_MAX_ATTEMPTS = int(os.getenv('PROVISION_JOB_MAX_ATTEMPTS', '8'))
+PROVISION_JOB_BACKOFF = float(os.getenv('PROVISION_JOB_BACKOFF', '5'))
+PROVISION_JOB_MAX_BACKOFF = float(os.getenv('PROVISION_JOB_MAX_BACKOFF', '900'))
+TRX_EXPLORER_URL = os.getenv('TRX_EXPLORER_URL', 'https://api.trongrid.io')
+TRX_EXPLORER_API_KEY = os.getenv('TRX_EXPLORER_API_KEY', '')
+TON_EXPLORER_URL = os.getenv('TON_EXPLORER_URL', 'https://toncenter.com/api/v3')
+TON_EXPLORER_API_KEY = os.getenv('TON_EXPLORER_API_KEY', '')
 # Force IPv4
 os.environ["FORCE_IPV4"] = "1"
 
@@ -55,7 +153,6 @@ def getaddrinfo_ipv4(*args, **kwargs):
 socket.getaddrinfo = getaddrinfo_ipv4
 
 # --- Global Variables & FSM States ---
-db_conn = None
 MAINTENANCE_MODE = False
 
 # This key must match one of the keys in SUB_PLANS_V2
@@ -99,10 +196,10 @@ def get_plan_by_key(key: str):
     return None, None
 
 # --- Bot Initialization & Middleware ---
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+# TELEGRAM_API_URL points the bot at a self-hosted Bot API server (or the benchmark fake) instead of api.telegram.org
+bot_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=API_TOKEN, session=bot_session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 router = Router()
-dp.include_router(router)
 
 class MaintenanceMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: Update, data: dict):
@@ -115,104 +212,2860 @@ class MaintenanceMiddleware(BaseMiddleware):
             await event.answer("🔧 ربات در حال حاضر در دست تعمیر است.", show_alert=True)
         return
 
+# --- Metrics ---
+# A deliberately small Prometheus registry: recording a sample is a lock and a few integer adds, and
+# everything that has to be computed (queue depths, FSM state counts) is only collected when /metrics is
+# scraped. Served on METRICS_HOST:METRICS_PORT (local only by default); METRICS_PORT=0 turns it off.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names: return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{n}="{escape(v)}"' for n, v in zip(names, values)) + '}'
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in list(self._values.items())]
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+# Gauges are callbacks returning a number, or {label values tuple: number}; they may be coroutines
+class Gauge:
+    def __init__(self, name: str, doc: str, fn, labels: tuple = ()):
+        self.name, self.doc, self.fn, self.labels = name, doc, fn, labels
+
+    async def collect(self) -> list:
+        value = self.fn()
+        if asyncio.iscoroutine(value): value = await value
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge"]
+        if isinstance(value, dict):
+            lines += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in value.items()]
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self._metrics, self._gauges = [], []
+        self._runner = None
+
+    def counter(self, name: str, doc: str, labels: tuple = ()) -> Counter:
+        self._metrics.append(Counter(name, doc, labels))
+        return self._metrics[-1]
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        self._metrics.append(Histogram(name, doc, labels, buckets))
+        return self._metrics[-1]
+
+    def gauge(self, name: str, doc: str, fn, labels: tuple = ()):
+        self._gauges.append(Gauge(name, doc, fn, labels))
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for gauge in self._gauges:
+            try:
+                lines += await gauge.collect()
+            except Exception as e:
+                print(f"Metrics collector {gauge.name} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request):
+        return web.Response(text=await self.render(), content_type='text/plain', charset='utf-8', headers={"X-Content-Type-Options": "nosniff"})
+
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        if not port or self._runner: return
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = Metrics()
+HANDLER_SECONDS = metrics.histogram('bot_handler_seconds', 'Time spent handling an update, by event type and handler', ('event', 'route'))
+PANEL_SECONDS = metrics.histogram('bot_panel_request_seconds', '3x-ui API latency by panel and endpoint', ('panel', 'endpoint'))
+PANEL_ERRORS = metrics.counter('bot_panel_errors_total', '3x-ui API failures (transport errors and HTTP >= 400)', ('panel', 'endpoint'))
+DB_SECONDS = metrics.histogram('bot_db_seconds', 'SQLite time per read, transaction or group commit', ('op',))
+QR_SECONDS = metrics.histogram('bot_qr_render_seconds', 'QR render time including the worker pool hop', ('format',))
+SEND_WAIT_SECONDS = metrics.histogram('bot_telegram_send_wait_seconds', 'Time a Bot API send waited for rate-limit tokens', ('priority',))
+
+# Times every update on dp.update; RouteTagger (on the router) fills in which handler took it
+class TimingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data: dict):
+        route = data['metrics_route'] = ['unhandled']
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, event.event_type, route[0])
+
+class RouteTagger(BaseMiddleware):
+    async def __call__(self, handler, event, data: dict):
+        route, handler_obj = data.get('metrics_route'), data.get('handler')
+        if route is not None and handler_obj is not None:
+            route[0] = getattr(handler_obj.callback, '__name__', 'handler')
+        return await handler(event, data)
+
 # --- Database & Helper Functions ---
-def create_db():
-    global db_conn
- 
-    db_conn = sqlite3.connect("example.db", check_same_thread=False)
-    db_conn.row_factory = sqlite3.Row
-    c = db_conn.cursor()
-
-    c.execute("""CREATE TABLE IF NOT EXISTS users (
+def epoch_to_date(ts: Optional[int]) -> Optional[str]:
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d') if ts else None
+
+# expire_date was written from datetime.now(), i.e. in the server's local time, so it is read back the same way
+def date_to_epoch(date: Optional[str]) -> Optional[int]:
+    try: return int(datetime.strptime(date[:10], '%Y-%m-%d').timestamp())
+    except (TypeError, ValueError): return None
+
+def migration_baseline(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY, username TEXT, plan_key TEXT, service_type TEXT DEFAULT 'v2ray',
         remarks TEXT, txid TEXT, config TEXT, expire_date TEXT, has_test INTEGER DEFAULT 0,
         purchase_count INTEGER DEFAULT 0, referrer_id INTEGER, wallet_balance REAL DEFAULT 0.0,
         successful_referrals INTEGER DEFAULT 0
     )""")
 
-    c.execute("""CREATE TABLE IF NOT EXISTS discounts (
+    conn.execute("""CREATE TABLE IF NOT EXISTS discounts (
         code TEXT PRIMARY KEY, user_id INTEGER, discount_percentage INTEGER, is_used INTEGER DEFAULT 0
     )""")
-    db_conn.commit()
 
-async def log_to_admins(text: str):
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, f"🛠 **لاگ سیستم:**\n\n<pre>{text}</pre>", parse_mode=ParseMode.HTML)
-        except Exception as e:
-            print(f"CRITICAL: Could not send log to admin {admin_id}. Error: {e}")
+# Integer epoch expiry, secondary indexes and a services table so one user can own several services.
+# The user's latest service stays mirrored on the users row for older tooling.
+def migration_services(conn):
+    conn.execute("ALTER TABLE users ADD COLUMN expire_at INTEGER")
+    rows = conn.execute("SELECT user_id, expire_date FROM users WHERE expire_date IS NOT NULL").fetchall()
+    conn.executemany("UPDATE users SET expire_at = ? WHERE user_id = ?", [(date_to_epoch(date), user_id) for user_id, date in rows])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_expire_at ON users(expire_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_remarks ON users(remarks)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS services (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, remark TEXT NOT NULL,
+        service_type TEXT NOT NULL DEFAULT 'v2ray', plan_label TEXT, config TEXT, is_test INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL, expire_at INTEGER
+    )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_services_remark ON services(remark)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_services_user_id ON services(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_services_expire_at ON services(expire_at)")
+    conn.execute("""INSERT OR IGNORE INTO services (user_id, remark, service_type, plan_label, config, is_test, created_at, expire_at)
+        SELECT user_id, remarks, COALESCE(service_type, 'v2ray'), plan_key, config, CASE WHEN plan_key IS NULL AND has_test = 1 THEN 1 ELSE 0 END,
+               CAST(strftime('%s', 'now') AS INTEGER), expire_at
+        FROM users WHERE remarks IS NOT NULL""")
+
+def migration_fsm_states(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY, state TEXT, data TEXT, updated_at INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)")
 
-async def check_subscription(user_id):
-    if not CHANNELS or not any(CHANNELS): return True
-    for ch in CHANNELS:
-        if not ch: continue
+def migration_bulk_jobs(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS bulk_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, admin_id INTEGER NOT NULL, plan_key TEXT NOT NULL, prefix TEXT NOT NULL,
+        quantity INTEGER NOT NULL, committed INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'running',
+        chat_id INTEGER, message_id INTEGER, error TEXT, created_at INTEGER NOT NULL, updated_at INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bulk_jobs_status ON bulk_jobs(status)")
+
+def migration_service_alerts(conn):
+    conn.execute("ALTER TABLE services ADD COLUMN usage_alerted INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE services ADD COLUMN expiry_alerted INTEGER NOT NULL DEFAULT 0")
+
+def migration_service_nodes(conn):
+    conn.execute("ALTER TABLE services ADD COLUMN node TEXT")
+    conn.execute("ALTER TABLE bulk_jobs ADD COLUMN node TEXT")
+
+def migration_subscription_tokens(conn):
+    conn.execute("ALTER TABLE users ADD COLUMN sub_token TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_sub_token ON users(sub_token)")
+
+# One row per submitted TxID; the unique index is the replay protection, so a TxID can pay for one invoice only
+def migration_payments(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, txid TEXT NOT NULL, symbol TEXT NOT NULL, wallet TEXT, amount REAL NOT NULL,
+        user_id INTEGER NOT NULL, invoice_id TEXT NOT NULL, plan_key TEXT NOT NULL, custom_name TEXT NOT NULL,
+        is_renewal INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'pending', detail TEXT,
+        created_at INTEGER NOT NULL, updated_at INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_txid ON payments(txid)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)")
+
+# Invoices are created when the price is quoted; receipts (payments) point at them by the short invoice id.
+# Receipts submitted before this migration keep their invoice_id but have no invoice row.
+def migration_invoices(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS invoices (
+        id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, plan_key TEXT NOT NULL, custom_name TEXT NOT NULL,
+        is_renewal INTEGER NOT NULL DEFAULT 0, symbol TEXT NOT NULL, amount REAL NOT NULL, wallet TEXT,
+        status TEXT NOT NULL DEFAULT 'pending', created_at INTEGER NOT NULL, expires_at INTEGER NOT NULL, updated_at INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status_expires_at ON invoices(status, expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_user_id ON invoices(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_invoice_id ON payments(invoice_id)")
+
+# Outbox of paid provisioning work. A job is committed in the same transaction as the payment that bought it;
+# the unique idempotency key (the checkout or invoice it came from) turns a replayed payment into a no-op.
+def migration_provision_jobs(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS provision_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, idempotency_key TEXT NOT NULL, kind TEXT NOT NULL, user_id INTEGER NOT NULL,
+        plan_key TEXT NOT NULL, remark TEXT NOT NULL, service_type TEXT NOT NULL DEFAULT 'v2ray', status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at INTEGER NOT NULL, node TEXT, inbound_id INTEGER, record TEXT,
+        target_expiry INTEGER, chat_id INTEGER, message_id INTEGER, last_error TEXT, created_at INTEGER NOT NULL, updated_at INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_provision_jobs_key ON provision_jobs(idempotency_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_provision_jobs_status_next ON provision_jobs(status, next_attempt_at)")
+
+# Integer wallet ledger. users.balance becomes the materialized balance (users.wallet_balance is kept as a
+# mirror for older tooling); existing balances are rounded to whole toman and opened with one entry each.
+def migration_wallet_ledger(conn):
+    conn.execute("ALTER TABLE users ADD COLUMN balance INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE users SET balance = CAST(ROUND(wallet_balance) AS INTEGER), wallet_balance = ROUND(wallet_balance) WHERE wallet_balance IS NOT NULL AND wallet_balance != 0")
+    conn.execute("""CREATE TABLE IF NOT EXISTS wallet_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, amount INTEGER NOT NULL, balance_after INTEGER NOT NULL,
+        kind TEXT NOT NULL, ref TEXT, created_at INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user_id ON wallet_ledger(user_id, id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_wallet_ledger_ref ON wallet_ledger(ref)")
+    conn.execute("""INSERT INTO wallet_ledger (user_id, amount, balance_after, kind, created_at)
+        SELECT user_id, balance, balance, 'opening', CAST(strftime('%s', 'now') AS INTEGER) FROM users WHERE balance != 0""")
+
+# Invoice amounts are kept unique among the live invoices of a coin, which is looked up on every quote
+def migration_invoice_amounts(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_symbol_expires_at ON invoices(symbol, expires_at)")
+
+# Databases upgraded before migration_services read expire_date as local time got it as UTC midnight; rows
+# still holding exactly that value (and the services copied from them) are moved to local midnight
+def migration_local_expiry(conn):
+    rows = conn.execute("SELECT user_id, remarks, expire_date, expire_at FROM users "
+                        "WHERE expire_date IS NOT NULL AND expire_at = CAST(strftime('%s', expire_date) AS INTEGER)").fetchall()
+    for user_id, remark, date, wrong in rows:
+        right = date_to_epoch(date)
+        if right is None or right == wrong: continue
+        conn.execute("UPDATE users SET expire_at = ? WHERE user_id = ?", (right, user_id))
+        conn.execute("UPDATE services SET expire_at = ? WHERE remark = ? AND expire_at = ?", (right, remark, wrong))
+
+MIGRATIONS = [
+    ("baseline users/discounts tables", migration_baseline),
+    ("services table, epoch expiry and lookup indexes", migration_services),
+    ("persistent FSM states", migration_fsm_states),
+    ("resumable bulk provisioning jobs", migration_bulk_jobs),
+    ("usage/expiry reminder flags on services", migration_service_alerts),
+    ("panel node of services and bulk jobs", migration_service_nodes),
+    ("subscription URL tokens", migration_subscription_tokens),
+    ("crypto payment receipts", migration_payments),
+    ("persisted crypto invoices", migration_invoices),
+    ("durable provisioning jobs", migration_provision_jobs),
+    ("integer wallet ledger", migration_wallet_ledger),
+    ("invoice amount lookup index", migration_invoice_amounts),
+    ("local-time expiry of pre-migration services", migration_local_expiry),
+]
+
+# SQLite work never runs on the event loop: all writes go through one writer thread (SQLite allows a
+# single writer anyway) and reads are spread over a small pool of reader connections, which WAL lets run
+# concurrently with the writer.
+# Small user-row updates are queued with defer() and group-committed every DB_FLUSH_MS or DB_FLUSH_ROWS,
+# so a burst of /start or provisioning writes costs one fsync per batch instead of one per statement.
+# Durable writes (anything that moves money) commit with synchronous=FULL.
+class Database:
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+    )
+
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READERS):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._connections = []
+        self._pending, self._pending_durable, self._flush_handle = [], False, None
+        self.stats = {"flushes": 0, "deferred_writes": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            self._connections.append(conn)
+        return conn
+
+    def _transaction(self, fn, args, durable=False, op='transaction'):
+        conn = self._conn()
+        started = time.perf_counter()
+        if durable: conn.execute("PRAGMA synchronous=FULL")
+        try:
+            with conn:
+                return fn(conn, *args)
+        finally:
+            if durable: conn.execute("PRAGMA synchronous=NORMAL")
+            DB_SECONDS.observe(time.perf_counter() - started, op)
+
+    @staticmethod
+    def _apply(conn, op, params):
+        if callable(op): return op(conn)
+        cur = conn.execute(op, params)
+        return cur.fetchall() if cur.description else cur.rowcount
+
+    def _write_batch(self, batch, durable):
         try:
-            member = await bot.get_chat_member(chat_id=f"@{ch}", user_id=user_id)
-            if member.status not in ("member", "creator", "administrator"): return False
+            return self._transaction(lambda conn: [self._apply(conn, op, params) for op, params, _ in batch], (), durable, 'group_commit')
         except Exception:
-            return False
-    return True
+            # A bad statement must not take the rest of the batch down with it
+            results = []
+            for op, params, _ in batch:
+                try: results.append(self._transaction(lambda conn: self._apply(conn, op, params), (), durable))
+                except Exception as e: results.append(e)
+            return results
+
+    def _read(self, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(self._conn(), *args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, 'read')
+
+    # Queues a statement (or a fn(conn) callable) for the next group commit; the future resolves after it
+    # is committed, with the rowcount, the fetched rows or the callable's return value
+    def defer(self, op, params: tuple = (), durable: bool = False) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((op, params, fut))
+        self._pending_durable |= durable
+        self.stats["deferred_writes"] += 1
+        if len(self._pending) >= DB_FLUSH_ROWS:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(DB_FLUSH_MS / 1000, self._flush)
+        return fut
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending: return
+        batch, durable = self._pending, self._pending_durable
+        self._pending, self._pending_durable = [], False
+        self.stats["flushes"] += 1
+        job = asyncio.get_running_loop().run_in_executor(self._writer, self._write_batch, batch, durable)
+        job.add_done_callback(lambda f: self._settle(batch, f))
+
+    @staticmethod
+    def _settle(batch, job):
+        results = [job.exception()] * len(batch) if job.exception() else job.result()
+        for (_, _, fut), result in zip(batch, results):
+            if fut.done(): continue
+            if isinstance(result, BaseException): fut.set_exception(result)
+            else: fut.set_result(result)
+
+    # Runs fn(conn, *args) on the writer thread inside one transaction (commit on success, rollback on error).
+    # Anything already deferred is flushed first so writes hit the database in the order they were issued.
+    async def transaction(self, fn, *args, durable: bool = False):
+        self._flush()
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._transaction, fn, args, durable)
+
+    async def read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read, fn, args)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[dict]:
+        row = await self.read(lambda conn: conn.execute(sql, params).fetchone())
+        return dict(row) if row else None
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return [dict(r) for r in await self.read(lambda conn: conn.execute(sql, params).fetchall())]
+
+    # Brings the schema up to date one migration at a time; PRAGMA user_version records the applied version
+    async def migrate(self):
+        version = (await self.fetchone("PRAGMA user_version"))['user_version']
+        for target, (name, step) in enumerate(MIGRATIONS[version:], start=version + 1):
+            def apply(conn):
+                conn.execute("BEGIN IMMEDIATE")
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+            await self.transaction(apply, durable=True)
+            print(f"Database migrated to v{target}: {name}")
+
+    async def close(self):
+        await self.transaction(lambda conn: None)
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+
+class UserRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self, user_id: int) -> Optional[dict]:
+        return await self.db.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+
+    async def ensure_exists(self, user_ids: list):
+        await self.db.transaction(lambda conn: conn.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)", [(u,) for u in user_ids]))
+
+    # Returns True when the user was newly registered; returning users only cost a read unless their username changed
+    async def register(self, user_id: int, username: Optional[str], referrer_id: Optional[int]) -> bool:
+        existing = await self.db.fetchone("SELECT username FROM users WHERE user_id = ?", (user_id,))
+        if existing is None:
+            return bool(await self.db.defer("INSERT OR IGNORE INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)", (user_id, username, referrer_id)))
+        if existing['username'] != username:
+            await self.db.defer("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
+        return False
+
+    async def has_test(self, user_id: int) -> bool:
+        return await self.db.fetchone("SELECT 1 FROM users WHERE user_id = ? AND has_test = 1", (user_id,)) is not None
+
+    async def set_test_service(self, user_id: int, remark: str, config: str, expire_at: int, service: str):
+        await self.db.defer("UPDATE users SET has_test = 1, config = ?, remarks = ?, expire_date = ?, expire_at = ?, service_type = ? WHERE user_id = ?", (config, remark, epoch_to_date(expire_at), expire_at, service, user_id))
+
+    async def set_service(self, user_id: int, plan_label: str, remark: str, config: str, expire_at: int, service: str):
+        await self.db.defer("UPDATE users SET plan_key = ?, service_type = ?, remarks = ?, config = ?, expire_date = ?, expire_at = ? WHERE user_id = ?", (plan_label, service, remark, config, epoch_to_date(expire_at), expire_at, user_id))
+
+    async def set_renewal(self, user_id: int, remark: str, plan_label: str, expire_at: int):
+        await self.db.defer("UPDATE users SET plan_key = ?, expire_date = ?, expire_at = ? WHERE user_id = ? AND remarks = ?", (plan_label, epoch_to_date(expire_at), expire_at, user_id, remark))
+
+    # The secret in the user's subscription URL, created on first use
+    async def get_sub_token(self, user_id: int) -> str:
+        row = await self.db.fetchone("SELECT sub_token FROM users WHERE user_id = ?", (user_id,))
+        if row and row['sub_token']:
+            return row['sub_token']
+        token = secrets.token_urlsafe(16)
+        await self.db.transaction(lambda conn: conn.execute("UPDATE users SET sub_token = ? WHERE user_id = ? AND sub_token IS NULL", (token, user_id)))
+        row = await self.db.fetchone("SELECT sub_token FROM users WHERE user_id = ?", (user_id,))
+        return row['sub_token'] if row else token
+
+    async def get_by_sub_token(self, token: str) -> Optional[int]:
+        row = await self.db.fetchone("SELECT user_id FROM users WHERE sub_token = ?", (token,))
+        return row['user_id'] if row else None
+
+    # Counts the purchase and returns the buyer's referrer, if any
+    async def record_purchase(self, user_id: int) -> Optional[int]:
+        await self.db.defer("UPDATE users SET purchase_count = purchase_count + 1 WHERE user_id = ?", (user_id,))
+        row = await self.db.fetchone("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,))
+        return row['referrer_id'] if row else None
+
+class ServiceRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def add(self, user_id: int, remark: str, service_type: str, plan_label: Optional[str], config: str, expire_at: int, is_test: bool = False, node: Optional[str] = None) -> int:
+        return await self.db.defer(lambda conn: conn.execute(
+            "INSERT INTO services (user_id, remark, service_type, plan_label, config, is_test, created_at, expire_at, node) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, remark, service_type, plan_label, config, int(is_test), int(time.time()), expire_at, node)).lastrowid)
+
+    async def get(self, service_id: int) -> Optional[dict]:
+        return await self.db.fetchone("SELECT * FROM services WHERE id = ?", (service_id,))
+
+    async def get_by_remark(self, remark: str) -> Optional[dict]:
+        return await self.db.fetchone("SELECT * FROM services WHERE remark = ?", (remark,))
+
+    async def list_for_user(self, user_id: int) -> list:
+        return await self.db.fetchall("SELECT * FROM services WHERE user_id = ? ORDER BY id DESC", (user_id,))
+
+    async def list_active(self, user_id: int) -> list:
+        return await self.db.fetchall("SELECT remark, config, node FROM services WHERE user_id = ? AND (expire_at IS NULL OR expire_at > ?) ORDER BY id",
+                                      (user_id, int(time.time())))
+
+    async def set_renewal(self, remark: str, plan_label: str, expire_at: int):
+        await self.db.defer("UPDATE services SET plan_label = ?, expire_at = ?, usage_alerted = 0, expiry_alerted = 0 WHERE remark = ?", (plan_label, expire_at, remark))
+
+    # Applies a chunk of changed panel stats [(remark, percent_used, expire_at)] and returns the services that
+    # just crossed `threshold` percent; they are flagged in the same transaction so each is reminded once.
+    async def sync_usage(self, changes: list, threshold: int) -> list:
+        def sync(conn):
+            conn.executemany("UPDATE services SET expire_at = ?, expiry_alerted = 0 WHERE remark = ? AND expire_at IS NOT ?",
+                             [(exp, remark, exp) for remark, _, exp in changes if exp])
+            conn.executemany("UPDATE services SET usage_alerted = 0 WHERE remark = ? AND usage_alerted = 1",
+                             [(remark,) for remark, pct, _ in changes if pct < threshold])
+            crossed = {remark: pct for remark, pct, _ in changes if pct >= threshold}
+            if not crossed: return []
+            marks = ','.join('?' * len(crossed))
+            rows = conn.execute(f"SELECT id, user_id, remark FROM services WHERE remark IN ({marks}) AND usage_alerted = 0 AND is_test = 0", list(crossed)).fetchall()
+            conn.executemany("UPDATE services SET usage_alerted = 1 WHERE id = ?", [(r['id'],) for r in rows])
+            return [dict(r, percent=crossed[r['remark']]) for r in rows]
+        return await self.db.transaction(sync)
+
+    # Claims services expiring before `until` that have not been reminded yet
+    async def claim_expiring(self, until: int, limit: int = 5000) -> list:
+        def claim(conn):
+            rows = conn.execute("SELECT id, user_id, remark, expire_at FROM services WHERE expire_at BETWEEN ? AND ? AND expiry_alerted = 0 AND is_test = 0 LIMIT ?",
+                                (int(time.time()), until, limit)).fetchall()
+            conn.executemany("UPDATE services SET expiry_alerted = 1 WHERE id = ?", [(r['id'],) for r in rows])
+            return [dict(r) for r in rows]
+        return await self.db.transaction(claim)
+
+class InsufficientBalance(Exception):
+    pass
+
+# Append-only integer ledger (toman) behind every wallet movement. users.balance is the running total, updated
+# in the same transaction as each entry, so reading a balance stays a primary-key lookup however long the
+# history grows. Debits are conditional on the balance covering them. An entry's ref (the payment or purchase
+# it belongs to) can be posted once; posting it again raises sqlite3.IntegrityError and rolls the transaction back.
+class WalletRepository:
+    KINDS = {"opening": "موجودی اولیه", "purchase": "خرید سرویس", "renewal": "تمدید سرویس", "referral": "پاداش زیرمجموعه",
+             "adjust": "شارژ دستی", "refund": "بازگشت وجه"}
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    # Applies one entry inside the caller's transaction and returns the new balance
+    @staticmethod
+    def post(conn, user_id: int, amount: int, kind: str, ref: Optional[str] = None) -> int:
+        amount = int(amount)
+        if amount > 0:
+            conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        if conn.execute("UPDATE users SET balance = balance + ?, wallet_balance = balance + ? WHERE user_id = ? AND (? >= 0 OR balance + ? >= 0)",
+                        (amount, amount, user_id, amount, amount)).rowcount != 1:
+            raise InsufficientBalance(f"user {user_id} cannot cover {-amount}")
+        balance = conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)).fetchone()['balance']
+        conn.execute("INSERT INTO wallet_ledger (user_id, amount, balance_after, kind, ref, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (user_id, amount, balance, kind, ref, int(time.time())))
+        return balance
+
+    async def balance(self, user_id: int) -> int:
+        row = await self.db.fetchone("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        return row['balance'] if row else 0
+
+    # Returns the new balance, or None when `ref` was already posted
+    async def credit(self, user_id: int, amount: int, kind: str, ref: Optional[str] = None) -> Optional[int]:
+        try:
+            return await self.db.transaction(self.post, user_id, amount, kind, ref, durable=True)
+        except sqlite3.IntegrityError:
+            return None
 
-async def get_crypto_price_in_irt(symbol='USDT'):
-    try:
-        api_symbol = symbol.lower()
-        async with httpx.AsyncClient(timeout=10) as client:
-            params = {"srcCurrency": api_symbol, "dstCurrency": "rls"}
-            response = await client.get("https://apiv2.nobitex.ir/market/stats", params=params)
-            response.raise_for_status()
-            data = response.json()
-            market_key = f"{api_symbol}-rls"
-            if market_key not in data.get('stats', {}):
-                await log_to_admins(f"Market key '{market_key}' not found in Nobitex response.")
+    # Credits a referral commission for the purchase `ref` and returns the referrer's new successful_referrals
+    # count, or None when that purchase was already credited
+    async def credit_referral(self, user_id: int, amount: int, ref: str) -> Optional[int]:
+        def credit(conn):
+            self.post(conn, user_id, amount, 'referral', ref)
+            conn.execute("UPDATE users SET successful_referrals = successful_referrals + 1 WHERE user_id = ?", (user_id,))
+            return conn.execute("SELECT successful_referrals FROM users WHERE user_id = ?", (user_id,)).fetchone()['successful_referrals']
+        try:
+            return await self.db.defer(credit, durable=True)
+        except sqlite3.IntegrityError:
+            return None
+
+    # Newest first; pass the last id seen as before_id for the next page (keyset paging on (user_id, id))
+    async def history(self, user_id: int, limit: int = 10, before_id: Optional[int] = None) -> list:
+        return await self.db.fetchall("SELECT * FROM wallet_ledger WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                                      (user_id, before_id or 2 ** 63 - 1, limit))
+
+class DiscountRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get_active_percentage(self, code: str, user_id: int) -> Optional[int]:
+        row = await self.db.fetchone("SELECT discount_percentage FROM discounts WHERE code = ? AND user_id = ? AND is_used = 0", (code, user_id))
+        return row['discount_percentage'] if row else None
+
+class BulkJobRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def create(self, admin_id: int, plan_key: str, prefix: str, quantity: int) -> int:
+        now = int(time.time())
+        return await self.db.transaction(lambda conn: conn.execute(
+            "INSERT INTO bulk_jobs (admin_id, plan_key, prefix, quantity, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (admin_id, plan_key, prefix, quantity, now, now)).lastrowid, durable=True)
+
+    async def get(self, job_id: int) -> Optional[dict]:
+        return await self.db.fetchone("SELECT * FROM bulk_jobs WHERE id = ?", (job_id,))
+
+    async def list_by_status(self, status: str) -> list:
+        return await self.db.fetchall("SELECT * FROM bulk_jobs WHERE status = ? ORDER BY id", (status,))
+
+    async def set_node(self, job_id: int, node: str):
+        await self.db.transaction(lambda conn: conn.execute("UPDATE bulk_jobs SET node = ? WHERE id = ?", (node, job_id)))
+
+    async def set_progress_message(self, job_id: int, chat_id: int, message_id: int):
+        await self.db.transaction(lambda conn: conn.execute("UPDATE bulk_jobs SET chat_id = ?, message_id = ? WHERE id = ?", (chat_id, message_id, job_id)))
+
+    # A chunk only counts once this returns; it is written synchronously so a crash never loses a committed chunk
+    async def commit_chunk(self, job_id: int, committed: int):
+        await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE bulk_jobs SET committed = ?, updated_at = ? WHERE id = ?", (committed, int(time.time()), job_id)), durable=True)
+
+    async def set_status(self, job_id: int, status: str, error: Optional[str] = None):
+        await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE bulk_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?", (status, error, int(time.time()), job_id)), durable=True)
+
+# Receipt statuses: pending (waiting for the chain), review (sent to the admins), approved, rejected
+class PaymentRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    # Records a receipt for `invoice`; returns the new payment id, or None when the TxID was already submitted
+    async def submit(self, txid: str, invoice: dict, status: str = 'pending') -> Optional[int]:
+        now = int(time.time())
+        try:
+            return await self.db.transaction(lambda conn: conn.execute(
+                "INSERT INTO payments (txid, symbol, wallet, amount, user_id, invoice_id, plan_key, custom_name, is_renewal, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (txid, invoice['symbol'], invoice['wallet'], invoice['amount'], invoice['user_id'], invoice['id'], invoice['plan_key'],
+                 invoice['custom_name'], invoice['is_renewal'], status, now, now)).lastrowid, durable=True)
+        except sqlite3.IntegrityError:
+            return None
+
+    async def get(self, payment_id: int) -> Optional[dict]:
+        return await self.db.fetchone("SELECT * FROM payments WHERE id = ?", (payment_id,))
+
+    # With the window of the invoice each receipt pays (NULL for receipts older than the invoices table)
+    async def list_pending(self, limit: int = 500) -> list:
+        return await self.db.fetchall(
+            "SELECT p.*, i.created_at AS invoice_created_at, i.expires_at AS invoice_expires_at FROM payments p "
+            "LEFT JOIN invoices i ON i.id = p.invoice_id WHERE p.status = 'pending' ORDER BY p.id LIMIT ?", (limit,))
+
+    # Moves a payment out of `expected` status; False means another path already resolved it
+    async def resolve(self, payment_id: int, status: str, detail: Optional[str] = None, expected: str = 'pending') -> bool:
+        return await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE payments SET status = ?, detail = ?, updated_at = ? WHERE id = ? AND status = ?",
+            (status, detail, int(time.time()), payment_id, expected)).rowcount == 1, durable=True)
+
+    # Settles every open receipt of an invoice an admin decided, including 'pending' ones the verifier has not
+    # reached yet, which would otherwise go to review later against an invoice that is already closed
+    async def resolve_for_invoice(self, invoice_id: str, status: str, detail: Optional[str] = None, expected: tuple = ('pending', 'review')) -> int:
+        marks = ', '.join('?' * len(expected))
+        return await self.db.transaction(lambda conn: conn.execute(
+            f"UPDATE payments SET status = ?, detail = COALESCE(?, detail), updated_at = ? WHERE invoice_id = ? AND status IN ({marks})",
+            (status, detail, int(time.time()), invoice_id, *expected)).rowcount, durable=True)
+
+    async def count_by_status(self) -> dict:
+        return {r['status']: r['n'] for r in await self.db.fetchall("SELECT status, COUNT(*) AS n FROM payments GROUP BY status")}
+
+# Invoice statuses: pending, approved, rejected, expired. Every state change is a conditional update on the
+# primary key, so an admin tap, the verifier and the sweeper can race without double-fulfilling an invoice.
+class InvoiceRepository:
+    ALPHABET = '23456789ABCDEFGHJKLMNPQRSTUVWXYZ'
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    # The quote is rounded up to 0.001 and the last three micro-unit digits are picked so that no other live
+    # invoice of the coin asks for the same amount, which ties an on-chain transfer to one invoice.
+    # Returns (invoice_id, amount to pay).
+    async def create(self, user_id: int, plan_key: str, custom_name: str, is_renewal: bool, symbol: str, amount: float, wallet: str, ttl: int = INVOICE_TTL) -> tuple:
+        now = int(time.time())
+        base = math.ceil(round(amount * 1000, 6)) * 1000
+        def insert(conn):
+            used = {round(r[0] * 1_000_000) for r in conn.execute(
+                "SELECT amount FROM invoices WHERE symbol = ? AND expires_at > ?", (symbol, now))}
+            free = [tag for tag in range(1, 1000) if base + tag not in used]
+            unique = (base + (secrets.choice(free) if free else secrets.randbelow(999) + 1)) / 1_000_000
+            conn.execute(
+                "INSERT INTO invoices (id, user_id, plan_key, custom_name, is_renewal, symbol, amount, wallet, created_at, expires_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (invoice_id, user_id, plan_key, custom_name, int(is_renewal), symbol, unique, wallet, now, now + ttl, now))
+            return unique
+        while True:
+            invoice_id = ''.join(secrets.choice(self.ALPHABET) for _ in range(8))
+            try:
+                return invoice_id, await self.db.transaction(insert, durable=True)
+            except sqlite3.IntegrityError:
+                continue
+
+    async def get(self, invoice_id: str) -> Optional[dict]:
+        return await self.db.fetchone("SELECT * FROM invoices WHERE id = ?", (invoice_id,))
+
+    async def transition(self, invoice_id: str, status: str, expected: str = 'pending') -> bool:
+        return await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE invoices SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+            (status, int(time.time()), invoice_id, expected)).rowcount == 1, durable=True)
+
+    # Pending invoices with a receipt waiting for an admin, oldest first
+    async def list_awaiting_review(self, limit: int = 10) -> list:
+        return await self.db.fetchall(
+            "SELECT i.*, COUNT(p.id) AS receipts FROM invoices i JOIN payments p ON p.invoice_id = i.id AND p.status = 'review' "
+            "WHERE i.status = 'pending' GROUP BY i.id ORDER BY i.created_at LIMIT ?", (limit,))
+
+    async def count_by_status(self) -> dict:
+        return {r['status']: r['n'] for r in await self.db.fetchall("SELECT status, COUNT(*) AS n FROM invoices GROUP BY status")}
+
+    # Invoices past their expiry with no receipt still being checked or reviewed
+    async def expire_stale(self, now: int) -> int:
+        return await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE invoices SET status = 'expired', updated_at = ? WHERE status = 'pending' AND expires_at < ? "
+            "AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.invoice_id = invoices.id AND p.status IN ('pending', 'review'))", (now, now)).rowcount)
+
+# Job statuses: pending (due at next_attempt_at), running, done, failed, refunded. kind is create or renew.
+class ProvisionJobRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    @staticmethod
+    def _insert(conn, key: str, kind: str, user_id: int, plan_key: str, remark: str, service: str, chat_id: Optional[int], message_id: Optional[int]) -> int:
+        now = int(time.time())
+        return conn.execute(
+            "INSERT INTO provision_jobs (idempotency_key, kind, user_id, plan_key, remark, service_type, next_attempt_at, chat_id, message_id, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (key, kind, user_id, plan_key, remark, service, now, chat_id, message_id, now, now)).lastrowid
+
+    # Debits the wallet and queues the job in one transaction; None (and no debit) when `key` was already used.
+    # Raises InsufficientBalance when the balance does not cover the price.
+    async def enqueue_wallet(self, key: str, kind: str, user_id: int, plan_key: str, remark: str, service: str, price: float,
+                             chat_id: Optional[int] = None, message_id: Optional[int] = None) -> Optional[int]:
+        def enqueue(conn):
+            WalletRepository.post(conn, user_id, -price, 'renewal' if kind == 'renew' else 'purchase', key)
+            return self._insert(conn, key, kind, user_id, plan_key, remark, service, chat_id, message_id)
+        try:
+            return await self.db.transaction(enqueue, durable=True)
+        except sqlite3.IntegrityError:
+            return None
+
+    # Approves a pending invoice and queues its job in one transaction; None when the invoice was no longer pending
+    async def enqueue_invoice(self, invoice: dict) -> Optional[int]:
+        plan, service = get_plan_by_key(invoice['plan_key'])
+        def enqueue(conn):
+            if conn.execute("UPDATE invoices SET status = 'approved', updated_at = ? WHERE id = ? AND status = 'pending'",
+                            (int(time.time()), invoice['id'])).rowcount != 1:
                 return None
-            latest_price_rials = float(data['stats'][market_key]['latest'])
-            return latest_price_rials / 10
-    except Exception as e:
-        await log_to_admins(f"Error fetching {symbol} price: {e}")
+            return self._insert(conn, f"invoice:{invoice['id']}", 'renew' if invoice['is_renewal'] else 'create', invoice['user_id'],
+                                invoice['plan_key'], invoice['custom_name'], service or 'v2ray', None, None)
+        return await self.db.transaction(enqueue, durable=True)
+
+    async def get(self, job_id: int) -> Optional[dict]:
+        return await self.db.fetchone("SELECT * FROM provision_jobs WHERE id = ?", (job_id,))
+
+    # Marks up to `limit` due jobs running and returns them with their attempt already counted
+    async def claim_due(self, limit: int) -> list:
+        def claim(conn):
+            now = int(time.time())
+            rows = conn.execute("SELECT id FROM provision_jobs WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?", (now, limit)).fetchall()
+            conn.executemany("UPDATE provision_jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?", [(now, r['id']) for r in rows])
+            if not rows: return []
+            return [dict(r) for r in conn.execute(f"SELECT * FROM provision_jobs WHERE id IN ({','.join('?' * len(rows))}) ORDER BY next_attempt_at, id", [r['id'] for r in rows])]
+        return await self.db.transaction(claim)
+
+    async def next_due(self) -> Optional[int]:
+        return (await self.db.fetchone("SELECT MIN(next_attempt_at) AS t FROM provision_jobs WHERE status = 'pending'"))['t']
+
+    # Written before the first panel write, so every retry targets the same node/inbound with the same client or expiry
+    async def pin(self, job_id: int, node: str, inbound_id: int, record: Optional[str] = None, target_expiry: Optional[int] = None):
+        await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE provision_jobs SET node = ?, inbound_id = ?, record = ?, target_expiry = ?, updated_at = ? WHERE id = ?",
+            (node, inbound_id, record, target_expiry, int(time.time()), job_id)), durable=True)
+
+    async def set_message(self, job_id: int, chat_id: int, message_id: int):
+        await self.db.defer("UPDATE provision_jobs SET chat_id = ?, message_id = ? WHERE id = ?", (chat_id, message_id, job_id))
+
+    async def finish(self, job_id: int):
+        await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE provision_jobs SET status = 'done', last_error = NULL, updated_at = ? WHERE id = ?", (int(time.time()), job_id)), durable=True)
+
+    async def retry(self, job_id: int, delay: float, error: str):
+        now = int(time.time())
+        await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE provision_jobs SET status = 'pending', next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (now + int(delay), error, now, job_id)))
+
+    async def fail(self, job_id: int, error: str):
+        await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE provision_jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?", (error, int(time.time()), job_id)), durable=True)
+
+    # Closes a running job that can never succeed as refunded and credits back what its wallet debit took, in one
+    # transaction. Returns the refunded amount, or None when the job was not paid from the wallet.
+    async def refund(self, job: dict, error: str) -> Optional[int]:
+        def refund(conn):
+            debit = conn.execute("SELECT amount FROM wallet_ledger WHERE ref = ?", (job['idempotency_key'],)).fetchone()
+            if debit is None or conn.execute(
+                    "UPDATE provision_jobs SET status = 'refunded', last_error = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                    (error, int(time.time()), job['id'])).rowcount != 1:
+                return None
+            WalletRepository.post(conn, job['user_id'], -debit['amount'], 'refund', f"refund:{job['idempotency_key']}")
+            return -debit['amount']
+        return await self.db.transaction(refund, durable=True)
+
+    # New-service orders for `remark` that are queued or being built
+    async def creating(self, remark: str) -> bool:
+        return await self.db.fetchone("SELECT 1 FROM provision_jobs WHERE status IN ('pending', 'running') AND kind = 'create' AND remark = ?", (remark,)) is not None
+
+    # Gives a failed job a fresh set of attempts; False when it is not failed (already retried or done)
+    async def requeue(self, job_id: int) -> bool:
+        now = int(time.time())
+        return await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE provision_jobs SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? WHERE id = ? AND status = 'failed'",
+            (now, now, job_id)).rowcount == 1)
+
+    # Jobs a restart cut off mid-attempt; they are safe to run again
+    async def requeue_running(self) -> int:
+        return await self.db.transaction(lambda conn: conn.execute(
+            "UPDATE provision_jobs SET status = 'pending', updated_at = ? WHERE status = 'running'", (int(time.time()),)).rowcount)
+
+    async def count_by_status(self) -> dict:
+        return {r['status']: r['n'] for r in await self.db.fetchall("SELECT status, COUNT(*) AS n FROM provision_jobs GROUP BY status")}
+
+db = Database()
+user_repo = UserRepository(db)
+service_repo = ServiceRepository(db)
+discount_repo = DiscountRepository(db)
+bulk_repo = BulkJobRepository(db)
+payment_repo = PaymentRepository(db)
+invoice_repo = InvoiceRepository(db)
+provision_job_repo = ProvisionJobRepository(db)
+wallet_repo = WalletRepository(db)
+
+# --- FSM Storage ---
+# Keeps purchase flows alive across restarts. Reads are served from an in-process cache, writes are
+# group-committed through Database.defer, and flows untouched for FSM_STATE_TTL seconds are dropped.
+# This backend is meant for a single process; run several workers with FSM_STORAGE=redis instead.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database: Database, ttl: int = FSM_STATE_TTL, cache_size: int = 10000):
+        self.db, self.ttl, self.cache_size = database, ttl, cache_size
+        self._cache = OrderedDict()
+        # in-flight cache fills and write-behind writes per key
+        self._loading, self._writes = {}, {}
+        self._task = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id, key.thread_id, getattr(key, 'business_connection_id', None), key.destiny]
+        return ":".join("" if p is None else str(p) for p in parts)
+
+    async def _entry(self, key: StorageKey) -> list:
+        k = self._key(key)
+        entry = self._cache.get(k)
+        if entry is None:
+            # Concurrent misses share one load, so a later load can't replace an entry that was already updated
+            loading = self._loading.get(k)
+            if loading is None:
+                loading = self._loading[k] = asyncio.ensure_future(self._load(k))
+                loading.add_done_callback(lambda _: self._loading.pop(k, None))
+            entry = await asyncio.shield(loading)
+        self._cache.move_to_end(k)
+        if entry[2] < time.time() - self.ttl:
+            entry[0], entry[1] = None, {}
+        return entry
+
+    async def _load(self, k: str) -> list:
+        # An entry evicted with its write still queued is read back only after that write lands
+        pending = self._writes.get(k)
+        if pending is not None:
+            await asyncio.wait([pending])
+        row = await self.db.fetchone("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (k,))
+        entry = [row['state'], json.loads(row['data'] or '{}'), row['updated_at']] if row else [None, {}, int(time.time())]
+        self._cache[k] = entry
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return entry
+
+    def _persist(self, key: StorageKey, entry: list):
+        k = self._key(key)
+        entry[2] = int(time.time())
+        if entry[0] is None and not entry[1]:
+            fut = self.db.defer("DELETE FROM fsm_states WHERE key = ?", (k,))
+        else:
+            fut = self.db.defer("INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)", (k, entry[0], json.dumps(entry[1]), entry[2]))
+        self._writes[k] = fut
+        fut.add_done_callback(lambda f: self._written(k, f))
+
+    def _written(self, k: str, fut: asyncio.Future):
+        if self._writes.get(k) is fut:
+            del self._writes[k]
+        if fut.cancelled():
+            logger.warning("FSM state write for %s was cancelled", k)
+        elif fut.exception() is not None:
+            logger.error("FSM state write failed for %s", k, exc_info=fut.exception())
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._persist(key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key))[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        entry = await self._entry(key)
+        entry[1] = dict(data)
+        self._persist(key, entry)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict((await self._entry(key))[1])
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 3600))
+            cutoff = int(time.time()) - self.ttl
+            try:
+                await self.db.defer("DELETE FROM fsm_states WHERE updated_at < ?", (cutoff,))
+            except Exception:
+                logger.exception("FSM sweep failed")
+            for k in [k for k, entry in self._cache.items() if entry[2] < cutoff]:
+                self._cache.pop(k, None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+def create_dispatcher() -> Dispatcher:
+    if FSM_STORAGE == 'redis':
+        # Any Redis-protocol server works (redis, valkey, dragonfly...)
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage, RedisEventIsolation
+        except ImportError:
+            sys.exit("❌ FSM_STORAGE=redis به پکیج redis نیاز دارد: pip install redis")
+        storage = RedisStorage.from_url(FSM_REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+        return Dispatcher(storage=storage, events_isolation=RedisEventIsolation(redis=storage.redis))
+    if FSM_STORAGE == 'memory':
+        return Dispatcher(storage=MemoryStorage())
+    return Dispatcher(storage=SQLiteStorage(db))
+
+dp = create_dispatcher()
+dp.include_router(router)
+
+# --- Outbound Scheduler ---
+# Every Bot API call goes through this session middleware. Sends and edits wait for a per-chat token
+# (TG_CHAT_RATE/s in private chats, TG_GROUP_RATE/min in groups) and then for a global token
+# (TG_GLOBAL_RATE/s). Global tokens go to the highest priority class first, so replies to users overtake
+# bulk progress and admin logs during spikes. RetryAfter pauses the affected chat and the call is retried.
+PRIORITY_REPLY, PRIORITY_NOTIFY, PRIORITY_BULK, PRIORITY_LOG = range(4)
+send_priority = contextvars.ContextVar('send_priority', default=PRIORITY_REPLY)
+RATE_LIMITED_METHODS = ('send', 'copyMessage', 'forwardMessage', 'editMessage')
+
+@contextmanager
+def sending_priority(priority: int):
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+# GCRA token bucket: reserve() books the next free slot and returns how long the caller must wait for it
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval, self.burst = 1 / rate, max(1, burst)
+        self.tat = 0.0
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        tat = max(self.tat, now)
+        self.tat = tat + self.interval
+        return max(0.0, tat - (self.burst - 1) * self.interval - now)
+
+    def pause(self, seconds: float):
+        self.tat = max(self.tat, time.monotonic() + seconds + (self.burst - 1) * self.interval)
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE, group_rate: float = TG_GROUP_RATE, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, burst=int(global_rate))
+        self.chat_rate, self.group_rate, self.max_chats = chat_rate, group_rate / 60, max_chats
+        self._chats = OrderedDict()
+        self._waiting, self._seq = [], itertools.count()
+        self._wakeup = asyncio.Event()
+        self._gate_task = None
+        self._chat_waiters = 0
+        self.waits = deque(maxlen=1000)
+        self.stats = {"sent": 0, "flood_waits": 0, "retries": 0}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate if is_private else self.group_rate, TG_CHAT_BURST)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _gate(self):
+        ready = False  # a global token already waited out but not yet handed to a sender
+        while True:
+            # Cancelled sends leave their futures in the heap; they must not be given a token
+            while self._waiting and self._waiting[0][2].done():
+                heapq.heappop(self._waiting)
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if not ready:
+                delay = self.global_bucket.reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+                ready = True
+                continue
+            # The waiter is picked after the sleep so that higher-priority arrivals still go first,
+            # and a token whose waiters were all cancelled meanwhile is kept for the next one
+            heapq.heappop(self._waiting)[2].set_result(None)
+            ready = False
+
+    async def _admit(self, chat_id, priority: int):
+        self._chat_waiters += 1
+        try:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        finally:
+            self._chat_waiters -= 1
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), fut))
+        if self._gate_task is None or self._gate_task.done():
+            self._gate_task = asyncio.create_task(self._gate())
+        self._wakeup.set()
+        await fut
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        limited = chat_id is not None and method.__api_method__.startswith(RATE_LIMITED_METHODS)
+        started = time.monotonic()
+        for attempt in range(TG_MAX_RETRIES + 1):
+            if limited:
+                await self._admit(chat_id, send_priority.get())
+                if attempt == 0:
+                    self.waits.append(time.monotonic() - started)
+                    SEND_WAIT_SECONDS.observe(time.monotonic() - started, send_priority.get())
+            try:
+                result = await make_request(bot, method)
+                if limited: self.stats["sent"] += 1
+                return result
+            except TelegramRetryAfter as e:
+                self.stats["flood_waits"] += 1
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                self.stats["retries"] += 1
+                if limited:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+    def depth(self) -> int:
+        return len(self._waiting) + self._chat_waiters
+
+    def wait_percentiles(self) -> tuple:
+        ordered = sorted(self.waits)
+        if not ordered: return 0.0, 0.0
+        return ordered[len(ordered) // 2], ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+outbound = OutboundScheduler()
+bot.session.middleware(outbound)
+
+# Sends `text` to every admin concurrently; failures are only printed since admins may have blocked the bot
+async def notify_admins(text: str, priority: int = PRIORITY_NOTIFY, **kwargs):
+    async def send(admin_id):
+        try:
+            await bot.send_message(admin_id, text, **kwargs)
+        except Exception as e:
+            print(f"CRITICAL: Could not send to admin {admin_id}. Error: {e}")
+    with sending_priority(priority):
+        await asyncio.gather(*(send(admin_id) for admin_id in ADMIN_IDS))
+
+# The first occurrence of a log line goes out at once; identical lines within TG_LOG_MERGE_WINDOW seconds
+# are only counted and reported as one follow-up, so an error loop cannot flood the admins' chats.
+class AdminLog:
+    def __init__(self, window: int = TG_LOG_MERGE_WINDOW):
+        self.window = window
+        self._repeats = {}
+        self._tasks = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def add(self, text: str):
+        if text in self._repeats:
+            self._repeats[text] += 1
+            return
+        self._repeats[text] = 0
+        self._spawn(self._send(text))
+        self._spawn(self._expire(text))
+
+    async def _send(self, text: str):
+        await notify_admins(f"🛠 **لاگ سیستم:**\n\n<pre>{text}</pre>", priority=PRIORITY_LOG, parse_mode=ParseMode.HTML)
+
+    async def _expire(self, text: str):
+        await asyncio.sleep(self.window)
+        repeats = self._repeats.pop(text, 0)
+        if repeats:
+            await self._send(f"{text}\n\n(+{repeats} تکرار در {self.window} ثانیه گذشته)")
+
+admin_log = AdminLog()
+
+async def log_to_admins(text: str):
+    admin_log.add(text)
+
+# Membership results per (user, channel). Positives expire after SUBSCRIPTION_CACHE_TTL; negatives are kept
+# until the user presses "عضو شدم", which is the only time we expect the answer to change.
+class SubscriptionCache:
+    def __init__(self, ttl: int = SUBSCRIPTION_CACHE_TTL, max_size: int = SUBSCRIPTION_CACHE_SIZE):
+        self.ttl, self.max_size = ttl, max_size
+        self._entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, user_id: int, channel: str, recheck_negative: bool = False) -> Optional[bool]:
+        entry = self._entries.get((user_id, channel))
+        if entry is not None:
+            is_member, checked_at = entry
+            if (is_member and time.monotonic() - checked_at < self.ttl) or (not is_member and not recheck_negative):
+                self._entries.move_to_end((user_id, channel))
+                self.stats["hits"] += 1
+                return is_member
+        self.stats["misses"] += 1
         return None
 
+    def put(self, user_id: int, channel: str, is_member: bool):
+        self._entries[(user_id, channel)] = (is_member, time.monotonic())
+        self._entries.move_to_end((user_id, channel))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+subscription_cache = SubscriptionCache()
+
+async def _check_channel(user_id: int, channel: str, recheck_negative: bool) -> bool:
+    cached = subscription_cache.get(user_id, channel, recheck_negative)
+    if cached is not None: return cached
+    try:
+        member = await bot.get_chat_member(chat_id=f"@{channel}", user_id=user_id)
+    except Exception:
+        # Errors are not cached so a Telegram hiccup does not lock the user out
+        return False
+    is_member = member.status in ("member", "creator", "administrator")
+    subscription_cache.put(user_id, channel, is_member)
+    return is_member
+
+async def check_subscription(user_id, recheck_negative: bool = False):
+    if not CHANNELS or not any(CHANNELS): return True
+    results = await asyncio.gather(*(_check_channel(user_id, ch, recheck_negative) for ch in CHANNELS if ch))
+    return all(results)
+
+# --- Resilience ---
+# Panel and price calls go through a ResiliencePolicy: a timeout per call, a few jittered retries paid for out
+# of a retry budget, and a circuit breaker. After BREAKER_FAILURES consecutive failures the breaker opens and
+# calls fail at once with CircuitOpen for BREAKER_RESET seconds; then one probe call is let through and its
+# outcome closes or re-opens the breaker. Admins hear about a backend when it goes down and when it comes back,
+# not once per failed request.
+BACKEND_RETRIES_TOTAL = metrics.counter('bot_backend_retries_total', 'Panel and price calls retried, by backend', ('backend',))
+BREAKER_REJECTIONS = metrics.counter('bot_circuit_rejections_total', 'Calls failed fast by an open circuit breaker, by backend', ('backend',))
+policies = []  # every ResiliencePolicy, for metrics and the admin status view
+
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker:
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, name: str, threshold: int = BREAKER_FAILURES, reset: int = BREAKER_RESET):
+        self.name, self.threshold, self.reset = name, max(1, threshold), reset
+        self.state, self.failures = 'closed', 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def retry_in(self) -> float:
+        return max(0.0, self._opened_at + self.reset - time.monotonic()) if self.state == 'open' else 0.0
+
+    def allow(self) -> bool:
+        if self.state == 'open' and not self.retry_in():
+            self.state, self._probing = 'half_open', False
+        if self.state == 'closed':
+            return True
+        if self.state == 'half_open' and not self._probing:
+            self._probing = True
+            return True
+        self.stats["rejected"] += 1
+        BREAKER_REJECTIONS.inc(self.name)
+        return False
+
+    def success(self):
+        if self.state != 'closed':
+            self._announce(f"✅ ارتباط با {self.name} دوباره برقرار شد.")
+        self.state, self.failures, self._probing = 'closed', 0, False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == 'closed' and self.failures >= self.threshold:
+            self.stats["opened"] += 1
+            self._announce(f"⛔️ {self.name} پس از {self.failures} خطای پیاپی در دسترس نیست؛ درخواست‌ها تا بازگشت آن فوراً رد می‌شوند.")
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            self.state, self._opened_at = 'open', time.monotonic()
+
+    # A probe that was cancelled says nothing about the backend; let the next call probe instead
+    def release(self):
+        self._probing = False
+
+    @staticmethod
+    def _announce(text: str):
+        try: asyncio.get_running_loop().create_task(log_to_admins(text))
+        except RuntimeError: pass
+
+# Each successful call deposits `ratio` of a retry and each retry spends one, so retries stay under `ratio` of
+# the load that succeeds; once a backend stops answering they end when the balance (at most `cap`) is spent.
+class RetryBudget:
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, cap: float = 10.0):
+        self.ratio, self.cap = ratio, cap
+        self.balance = cap
+
+    def deposit(self):
+        self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1: return False
+        self.balance -= 1
+        return True
+
+class ResiliencePolicy:
+    def __init__(self, name: str, retries: int = BACKEND_RETRIES, base_delay: float = RETRY_BASE_DELAY):
+        self.name, self.retries, self.base_delay = name, retries, base_delay
+        self.breaker = CircuitBreaker(name)
+        self.budget = RetryBudget()
+        self.stats = {"calls": 0, "retries": 0, "budget_exhausted": 0}
+        policies.append(self)
+
+    # `attempt` makes one call and raises on failure; `retryable(exc)` decides whether that failure may be repeated.
+    # The breaker sees one outcome per call, however many attempts it took.
+    async def call(self, attempt, retryable=lambda e: True):
+        if not self.breaker.allow():
+            raise CircuitOpen(f"{self.name} unavailable, next try in {self.breaker.retry_in():.0f}s")
+        self.stats["calls"] += 1
+        tries = 0
+        while True:
+            try:
+                result = await attempt()
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                # Other calls may have opened the breaker meanwhile; then this one stops retrying too
+                retry = tries < self.retries and retryable(e) and self.breaker.state != 'open'
+                if retry and not self.budget.withdraw():
+                    self.stats["budget_exhausted"] += 1
+                    retry = False
+                if not retry:
+                    self.breaker.failure()
+                    raise
+                tries += 1
+                self.stats["retries"] += 1
+                BACKEND_RETRIES_TOTAL.inc(self.name)
+                await asyncio.sleep(self.base_delay * 2 ** (tries - 1) * random.uniform(0.5, 1.5))
+            else:
+                self.budget.deposit()
+                self.breaker.success()
+                return result
+
+# --- Price Feed ---
+# Price sources return {symbol: price in Toman} for whatever symbols they could quote.
+class NobitexPriceSource:
+    name = "nobitex"
+
+    async def fetch(self, client: httpx.AsyncClient, symbols: list) -> dict:
+        params = {"srcCurrency": ",".join(s.lower() for s in symbols), "dstCurrency": "rls"}
+        response = await client.get("https://apiv2.nobitex.ir/market/stats", params=params)
+        response.raise_for_status()
+        stats = response.json().get('stats', {})
+        prices = {}
+        for symbol in symbols:
+            market = stats.get(f"{symbol.lower()}-rls") or {}
+            if market.get('latest'):
+                prices[symbol] = float(market['latest']) / 10
+        return prices
+
+class WallexPriceSource:
+    name = "wallex"
+
+    async def fetch(self, client: httpx.AsyncClient, symbols: list) -> dict:
+        response = await client.get("https://api.wallex.ir/v1/markets")
+        response.raise_for_status()
+        markets = response.json().get('result', {}).get('symbols', {})
+        prices = {}
+        for symbol in symbols:
+            last_price = (markets.get(f"{symbol.upper()}TMN") or {}).get('stats', {}).get('lastPrice')
+            if last_price:
+                prices[symbol] = float(last_price)
+        return prices
+
+PRICE_SOURCE_TYPES = {source.name: source for source in (NobitexPriceSource, WallexPriceSource)}
+
+# Polls every source in PRICE_SOURCES order in the background and serves invoices from memory. A quote stays
+# usable for PRICE_MAX_STALENESS seconds if every upstream is failing; past that callers get None.
+class PriceFeed:
+    def __init__(self, sources: list, symbols: tuple = ('TRX', 'TON'), interval: int = PRICE_POLL_INTERVAL, max_staleness: int = PRICE_MAX_STALENESS):
+        self.sources, self.symbols = sources, list(symbols)
+        self.interval, self.max_staleness = interval, max_staleness
+        self._prices = {}
+        self._client = None
+        self._task = None
+        self._refreshing = None
+        self._failing = False
+        self._policies = {}
+        self.stats = {"served": 0, "stale_served": 0, "misses": 0, "upstream_errors": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=PRICE_TIMEOUT)
+        return self._client
+
+    def policy(self, source) -> ResiliencePolicy:
+        if source.name not in self._policies:
+            self._policies[source.name] = ResiliencePolicy(f"price:{source.name}")
+        return self._policies[source.name]
+
+    async def _poll(self, symbols: list):
+        missing = list(symbols)
+        for source in self.sources:
+            if not missing: break
+            try:
+                prices = await self.policy(source).call(lambda: source.fetch(self.client, missing))
+            except CircuitOpen:
+                continue
+            except Exception as e:
+                self.stats["upstream_errors"] += 1
+                print(f"Price source {source.name} failed: {e}")
+                continue
+            for symbol, price in prices.items():
+                if price > 0:
+                    self._prices[symbol] = (price, time.monotonic(), source.name)
+            missing = [s for s in missing if s not in prices]
+        if missing and not self._failing:
+            self._failing = True
+            await log_to_admins(f"دریافت قیمت {', '.join(missing)} از همه منابع ناموفق بود.")
+        elif not missing:
+            self._failing = False
+
+    # Concurrent callers share one in-flight refresh instead of each hitting the upstream
+    async def refresh(self, symbols: list = None):
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._poll(symbols or self.symbols))
+        await asyncio.shield(self._refreshing)
+
+    def age(self, symbol: str) -> Optional[float]:
+        entry = self._prices.get(symbol)
+        return time.monotonic() - entry[1] if entry else None
+
+    async def get(self, symbol: str) -> Optional[float]:
+        age = self.age(symbol)
+        if age is None or age > self.max_staleness:
+            await self.refresh([symbol] if symbol not in self.symbols else None)
+            age = self.age(symbol)
+            if age is None or age > self.max_staleness:
+                self.stats["misses"] += 1
+                return None
+        self.stats["served"] += 1
+        if age > self.interval * 2:
+            self.stats["stale_served"] += 1
+        return self._prices[symbol][0]
+
+    async def _poll_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Price feed refresh failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+
+price_feed = PriceFeed([PRICE_SOURCE_TYPES[name]() for name in PRICE_SOURCES if name in PRICE_SOURCE_TYPES])
+
+async def get_crypto_price_in_irt(symbol='USDT'):
+    return await price_feed.get(symbol)
+
 # --- TXUI Panel Manager ---
+V2RAY_NETWORKS = ('tcp', 'ws', 'grpc', 'kcp', 'h2', 'http')
+CLIENT_PROTOCOLS = ('vless', 'vmess', 'trojan', 'shadowsocks')
+
+# The field 3x-ui keys a client on in updateClient/{clientId}: the uuid for vless/vmess, the password for
+# trojan and the email for shadowsocks
+def client_key(protocol: str, client: dict) -> str:
+    protocol = (protocol or '').lower()
+    if protocol == 'trojan': return client['password']
+    if protocol == 'shadowsocks': return client['email']
+    return client['id']
+
+class PanelError(Exception):
+    pass
+
+# In-process index of the panel's inbounds with streamSettings pre-parsed. The full list is refreshed
+# in the background every INBOUND_CACHE_TTL seconds; a write only invalidates the inbound it touched.
+class InboundIndex:
+    def __init__(self, manager: "TxuiManager", ttl: int = INBOUND_CACHE_TTL):
+        self.manager, self.ttl = manager, ttl
+        self._inbounds = {}
+        self._by_remark, self._by_protocol, self._by_network = {}, {}, {}
+        self._stale = set()
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    @staticmethod
+    def _parse(inbound: dict) -> dict:
+        entry = dict(inbound)
+        try:
+            entry['stream'] = json.loads(inbound.get('streamSettings') or '{}')
+        except (TypeError, ValueError):
+            entry['stream'] = {}
+        return entry
+
+    def _reindex(self):
+        by_remark, by_protocol, by_network = {}, {}, {}
+        for inbound_id, entry in self._inbounds.items():
+            by_remark.setdefault(entry.get('remark'), inbound_id)
+            by_protocol.setdefault((entry.get('protocol') or '').lower(), []).append(inbound_id)
+            by_network.setdefault(entry['stream'].get('network'), []).append(inbound_id)
+        self._by_remark, self._by_protocol, self._by_network = by_remark, by_protocol, by_network
+
+    async def refresh(self):
+        res = await self.manager.request("GET", "/panel/api/inbounds/list")
+        res.raise_for_status()
+        self._inbounds = {i['id']: self._parse(i) for i in res.json().get('obj') or []}
+        self._stale.clear()
+        self._reindex()
+        self._loaded_at = time.monotonic()
+
+    async def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl * 2:
+            return
+        async with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl * 2:
+                await self.refresh()
+
+    # Fresh copy of a single inbound (used before whole-inbound writes); also refreshes its index entry.
+    async def fetch(self, inbound_id: int) -> dict:
+        res = await self.manager.request("GET", f"/panel/api/inbounds/get/{inbound_id}")
+        res.raise_for_status()
+        obj = res.json().get('obj')
+        if obj:
+            self._inbounds[inbound_id] = self._parse(obj)
+        else:
+            self._inbounds.pop(inbound_id, None)
+        self._stale.discard(inbound_id)
+        self._reindex()
+        return obj
+
+    def invalidate(self, inbound_id: int):
+        self._stale.add(inbound_id)
+
+    # Client records are parsed from the inbound's settings lazily, once per cached copy of the inbound.
+    async def find_client(self, inbound_id: int, email: str, _retry: bool = True):
+        entry = await self.get(inbound_id)
+        if entry is None: return None
+        if 'clients_by_email' not in entry:
+            try: settings = json.loads(entry.get('settings') or '{}')
+            except (TypeError, ValueError): settings = {}
+            clients = (settings.get('clients') or []) + (settings.get('peers') or [])
+            entry['clients_by_email'] = {c.get('email'): c for c in clients}
+        client = entry['clients_by_email'].get(email)
+        if client is None and _retry:
+            self.invalidate(inbound_id)
+            return await self.find_client(inbound_id, email, _retry=False)
+        return dict(client) if client else None
+
+    async def find_client_stats(self, email: str):
+        await self._ensure_loaded()
+        for entry in self._inbounds.values():
+            stats = next((c for c in entry.get('clientStats') or [] if c.get('email') == email), None)
+            if stats: return stats
+        return None
+
+    def entries(self) -> list:
+        return list(self._inbounds.values())
+
+    async def get(self, inbound_id: int):
+        await self._ensure_loaded()
+        if inbound_id in self._stale:
+            await self.fetch(inbound_id)
+        return self._inbounds.get(inbound_id)
+
+    async def find(self, remark: str = None, service: str = None):
+        await self._ensure_loaded()
+        inbound_id = self._by_remark.get(remark) if remark else None
+        if inbound_id is not None and service:
+            entry = self._inbounds[inbound_id]
+            is_wireguard = (entry.get('protocol') or '').lower() == 'wireguard' or entry['stream'].get('network') == 'wireguard'
+            if is_wireguard != (service == 'wireguard'):
+                inbound_id = None
+        if inbound_id is None and service:
+            networks = ('wireguard',) if service == 'wireguard' else V2RAY_NETWORKS
+            candidates = [i for n in networks for i in self._by_network.get(n, [])]
+            if service == 'wireguard':
+                candidates += self._by_protocol.get('wireguard', [])
+            inbound_id = min(candidates) if candidates else None
+        return await self.get(inbound_id) if inbound_id is not None else None
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Inbound cache refresh failed: {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+ADD_CLIENT = "/panel/api/inbounds/addClient"
+UPDATE_CLIENT = "/panel/api/inbounds/updateClient"
+CLIENT_TRAFFIC = "/panel/api/inbounds/getClientTraffics"
+
 class TxuiManager:
-    _token = None
-    _token_expiry = None
+    def __init__(self, panel_url: str = TXUI_PANEL_URL, username: str = TXUI_USERNAME, password: str = TXUI_PASSWORD):
+        self.panel_url, self.username, self.password = panel_url, username, password
+        self._token = None
+        self._token_expiry = None
+        self._login = None
+        self._refresh_timer = None
+        self._client = None
+        self.stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "logins": 0, "session_retries": 0}
+        self.inbounds = InboundIndex(self)
+        self._missing_since = {}  # per-client endpoint -> when the panel last answered it 404
+        self.policy = ResiliencePolicy(f"panel:{urlsplit(panel_url or '').netloc or 'main'}")
+
+    # One long-lived client per panel: keep-alive connections are reused across handlers instead of
+    # paying a TCP+TLS handshake on every purchase.
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            limits = httpx.Limits(max_connections=TXUI_POOL_MAX_CONNECTIONS, max_keepalive_connections=TXUI_POOL_MAX_KEEPALIVE, keepalive_expiry=TXUI_KEEPALIVE_EXPIRY)
+            self._client = httpx.AsyncClient(
+                base_url=self.panel_url or "", verify=False, timeout=httpx.Timeout(TXUI_TIMEOUT, connect=TXUI_CONNECT_TIMEOUT), limits=limits, http2=TXUI_HTTP2 and HTTP2_AVAILABLE,
+                event_hooks={"request": [self._on_request], "response": [self._on_response]},
+            )
+        return self._client
+
+    # httpcore traces every request: a request whose headers go out without a TCP connect before them rode an
+    # existing connection (a keep-alive HTTP/1.1 connection or another stream on an HTTP/2 one)
+    async def _on_request(self, request: httpx.Request):
+        connected = False
+        async def trace(event_name, info):
+            nonlocal connected
+            if event_name == "connection.connect_tcp.complete":
+                connected = True
+                self.stats["connections_opened"] += 1
+            elif event_name.endswith(".send_request_headers.started"):
+                if not connected: self.stats["connections_reused"] += 1
+                connected = False
+        request.extensions["trace"] = trace
+
+    async def _on_response(self, response: httpx.Response):
+        self.stats["requests"] += 1
+
+    def connection_stats(self) -> dict:
+        return {key: self.stats[key] for key in ("requests", "connections_opened", "connections_reused")}
+
+    @staticmethod
+    def timeout_for(endpoint: str) -> httpx.Timeout:
+        seconds = TXUI_TIMEOUTS.get(endpoint, TXUI_TIMEOUT)
+        return httpx.Timeout(seconds, connect=min(seconds, TXUI_CONNECT_TIMEOUT))
+
+    # Every call goes through the panel's ResiliencePolicy. Reads are retried on any failure; writes only when
+    # the request never reached the panel, since a write that timed out may still have been applied.
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        # Ids, uuids and emails sit after the action segment, so four segments name the endpoint
+        endpoint, panel = '/'.join(path.split('/')[:5]), urlsplit(self.panel_url or '').netloc
+        kwargs.setdefault("timeout", self.timeout_for(endpoint))
+        retryable = (lambda e: True) if method == "GET" else (lambda e: isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)))
+        return await self.policy.call(lambda: self._send(method, path, endpoint, panel, dict(kwargs)), retryable)
+
+    # One attempt; 5xx answers raise so that they count against the breaker
+    async def _send(self, method: str, path: str, endpoint: str, panel: str, kwargs: dict) -> httpx.Response:
+        token = await self.get_token()
+        if not token:
+            raise httpx.HTTPError("3x-ui login failed")
+        headers = dict(kwargs.pop("headers", None) or {})
+        for attempt in range(2):
+            headers["Cookie"] = f"3x-ui={token}"
+            started = time.perf_counter()
+            try:
+                res = await self.client.request(method, path, headers=headers, **kwargs)
+            except Exception:
+                PANEL_ERRORS.inc(panel, endpoint)
+                raise
+            finally:
+                PANEL_SECONDS.observe(time.perf_counter() - started, panel, endpoint)
+            # A session the panel no longer accepts answers 401, redirects to the login page, or (for the API routes)
+            # answers 404: log in once and retry, so an expired cookie isn't mistaken for a missing endpoint
+            if attempt or not (res.status_code == 401 or res.is_redirect or (res.status_code == 404 and "/panel/api/" in path)):
+                break
+            self.stats["session_retries"] += 1
+            self._drop_token(token)
+            token = await self.get_token()
+            if not token:
+                break
+        if res.status_code >= 400 or res.is_redirect: PANEL_ERRORS.inc(panel, endpoint)
+        if res.status_code >= 500: res.raise_for_status()
+        return res
+
+    async def close(self):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        await self.inbounds.stop()
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
 
     async def get_token(self):
         if self._token and self._token_expiry and datetime.now() < self._token_expiry:
             return self._token
-
+        return await self._login_once()
+
+    # Concurrent callers share one in-flight /login instead of each posting their own
+    async def _login_once(self):
+        if self._login is None or self._login.done():
+            self._login = asyncio.ensure_future(self._do_login())
+        return await asyncio.shield(self._login)
+
+    def _drop_token(self, token: str):
+        if self._token == token:
+            self._token, self._token_expiry = None, None
+
+    # Log in again TXUI_TOKEN_REFRESH_MARGIN seconds before the session runs out, so requests never wait on /login
+    def _schedule_refresh(self):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        delay = max((self._token_expiry - datetime.now()).total_seconds() - TXUI_TOKEN_REFRESH_MARGIN, 1)
+        self._refresh_timer = asyncio.get_running_loop().call_later(delay, lambda: asyncio.ensure_future(self._login_once()))
+
+    async def _do_login(self):
+        self.stats["logins"] += 1
         try:
-            async with httpx.AsyncClient(verify=False, timeout=20.0) as client:
-                data = {
-                    "username": TXUI_USERNAME,
-                    "password": TXUI_PASSWORD
-                }
+            data = {
+                "username": self.username,
+                "password": self.password
+            }
+
+            res = await self.client.post("/login", data=data, follow_redirects=True, timeout=self.timeout_for("/login"))
+            token = res.cookies.get("3x-ui")
+            logger.info("3x-ui login to %s answered %s (%s)", self.panel_url, res.status_code, "session issued" if token else "no session cookie")
+
+            if token:
+                # Trust the lifetime the panel put on the cookie; fall back to TXUI_SESSION_TTL for session cookies
+                cookie = next((c for c in res.cookies.jar if c.name == "3x-ui"), None)
+                self._token = token
+                self._token_expiry = datetime.fromtimestamp(cookie.expires) if cookie and cookie.expires else datetime.now() + timedelta(seconds=TXUI_SESSION_TTL)
+                self._schedule_refresh()
+                return token
+            else:
+                await log_to_admins(f"⚠️ لاگین انجام شد اما توکن خالی است! پاسخ: {res.text[:300]}")
 
-                url = f"{TXUI_PANEL_URL}/login"
+        except Exception as e:
+            # Not sent to the admins: the failed request counts against the panel's breaker, which reports outages once
+            logger.warning("3x-ui login to %s failed: %s", self.panel_url, e)
+            return None
 
-                print(f"🔹 در حال ارسال درخواست لاگین به: {url}")
-                res = await client.post(url, data=data, follow_redirects=True)
-                print(f"🔹 وضعیت پاسخ: {res.status_code}")
+    @staticmethod
+    def _check(res: httpx.Response) -> dict:
+        res.raise_for_status()
+        body = res.json()
+        if not body.get('success', True):
+            raise PanelError(body.get('msg') or f"panel rejected {res.request.url.path}")
+        return body
+
+    # Per-client endpoints (3x-ui >= 1.7) keep the cost of a sale independent of how many clients the
+    # inbound already has. Older panels answer 404, after which we fall back to whole-inbound rewrites.
+    # Older panels lack the per-client endpoints. _send has already logged in again before a 404 gets here, so
+    # a 404 means the route is missing; each endpoint is tracked on its own and probed again after TXUI_API_PROBE_TTL.
+    def supports(self, endpoint: str) -> bool:
+        since = self._missing_since.get(endpoint)
+        if since is not None and time.monotonic() - since >= TXUI_API_PROBE_TTL:
+            del self._missing_since[endpoint]
+            since = None
+        return since is None
+
+    def _missing(self, endpoint: str):
+        self._missing_since[endpoint] = time.monotonic()
+        logger.warning("%s answered %s with 404; using whole-inbound calls instead for %ss", self.panel_url, endpoint, TXUI_API_PROBE_TTL)
+
+    async def add_client(self, inbound_id: int, clients: list):
+        if self.supports(ADD_CLIENT):
+            payload = {"id": inbound_id, "settings": json.dumps({"clients": clients})}
+            res = await self.request("POST", ADD_CLIENT, json=payload)
+            if res.status_code != 404:
+                self._check(res)
+                self.inbounds.invalidate(inbound_id)
+                return
+            self._missing(ADD_CLIENT)
+        await self.update_inbound_settings(inbound_id, lambda settings: settings.setdefault('clients', []).extend(clients))
+
+    async def update_client(self, inbound_id: int, client: dict):
+        if self.supports(UPDATE_CLIENT):
+            inbound = await self.inbounds.get(inbound_id)
+            if inbound is None:
+                raise PanelError(f"inbound {inbound_id} not found")
+            payload = {"id": inbound_id, "settings": json.dumps({"clients": [client]})}
+            res = await self.request("POST", f"{UPDATE_CLIENT}/{client_key(inbound.get('protocol'), client)}", json=payload)
+            if res.status_code != 404:
+                self._check(res)
+                self.inbounds.invalidate(inbound_id)
+                return
+            self._missing(UPDATE_CLIENT)
+
+        def replace(settings):
+            settings['clients'] = [client if c.get('email') == client['email'] else c for c in settings.get('clients', [])]
+        await self.update_inbound_settings(inbound_id, replace)
+
+    async def get_client_traffic(self, email: str):
+        if self.supports(CLIENT_TRAFFIC):
+            res = await self.request("GET", f"{CLIENT_TRAFFIC}/{email}")
+            if res.status_code != 404:
+                return self._check(res).get('obj')
+            self._missing(CLIENT_TRAFFIC)
+        return await self.inbounds.find_client_stats(email)
+
+    # Fallback read-modify-write of a whole inbound; `mutate` edits the parsed settings in place.
+    async def update_inbound_settings(self, inbound_id: int, mutate):
+        inbound_obj = await self.inbounds.fetch(inbound_id)
+        if not inbound_obj:
+            raise PanelError(f"inbound {inbound_id} not found")
+        inbound_settings = json.loads(inbound_obj['settings'])
+        mutate(inbound_settings)
+        inbound_obj['settings'] = json.dumps(inbound_settings)
+        try:
+            res = await self.request("POST", f"/panel/api/inbounds/update/{inbound_id}", json=inbound_obj)
+            self._check(res)
+        finally:
+            self.inbounds.invalidate(inbound_id)
+
+# --- Provisioning Scheduler ---
+# All client writes for an inbound go through one worker, so concurrent approvals can no longer overwrite
+# each other's clients. Whatever is queued within PROVISION_COALESCE_MS is merged into as few panel calls
+# as possible and every caller gets its own future back.
+class ProvisioningScheduler:
+    def __init__(self, manager: TxuiManager, window: float = PROVISION_COALESCE_MS / 1000):
+        self.manager, self.window = manager, window
+        self._queues, self._workers = {}, {}
+        self.stats = {"ops": 0, "batches": 0, "panel_writes": 0}
+
+    def _submit(self, inbound_id: int, kind: str, payload) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(inbound_id, []).append((kind, payload, fut))
+        self.stats["ops"] += 1
+        worker = self._workers.get(inbound_id)
+        if worker is None or worker.done():
+            self._workers[inbound_id] = asyncio.create_task(self._drain(inbound_id))
+        return fut
+
+    def add_client(self, inbound_id: int, client: dict) -> asyncio.Future:
+        return self._submit(inbound_id, 'add', client)
+
+    def add_peer(self, inbound_id: int, peer: dict) -> asyncio.Future:
+        return self._submit(inbound_id, 'peer', peer)
+
+    # Resolves to the new expiry in ms, or None when the client does not exist on the inbound. With expiry_ms the
+    # client is set to that absolute expiry instead of being extended, which makes replaying the renewal harmless.
+    def renew_client(self, inbound_id: int, email: str, days: int, total_gb: int, expiry_ms: Optional[int] = None) -> asyncio.Future:
+        return self._submit(inbound_id, 'renew', {"email": email, "days": days, "total_gb": total_gb, "expiry_ms": expiry_ms})
+
+    @staticmethod
+    def _resolve(fut: asyncio.Future, result=None, error: Exception = None):
+        if fut.done(): return
+        if error is not None: fut.set_exception(error)
+        else: fut.set_result(result)
+
+    @staticmethod
+    def _renewed_expiry(current_expiry_ms: int, days: int) -> int:
+        now_ms = int(datetime.now().timestamp() * 1000)
+        return max(current_expiry_ms or 0, now_ms) + days * 24 * 60 * 60 * 1000
+
+    async def _drain(self, inbound_id: int):
+        while self._queues.get(inbound_id):
+            await asyncio.sleep(self.window)
+            batch, self._queues[inbound_id] = self._queues[inbound_id], []
+            self.stats["batches"] += 1
+            try:
+                await self._apply(inbound_id, batch)
+            except Exception as e:
+                for _, _, fut in batch: self._resolve(fut, error=e)
+
+    async def _apply(self, inbound_id: int, batch: list):
+        # Peers, and any kind whose per-client endpoint the panel lacks, go into one whole-inbound rewrite
+        direct = {'add': self.manager.supports(ADD_CLIENT), 'renew': self.manager.supports(UPDATE_CLIENT)}
+        adds = [op for op in batch if op[0] == 'add' and direct['add']]
+        renews = [op for op in batch if op[0] == 'renew' and direct['renew']]
+        rewrites = [op for op in batch if not direct.get(op[0], False)]
+
+        if adds:
+            try:
+                await self.manager.add_client(inbound_id, [client for _, client, _ in adds])
+                self.stats["panel_writes"] += 1
+                for _, client, fut in adds: self._resolve(fut, client)
+            except PanelError:
+                # One bad client (e.g. a duplicate email) must not fail the rest of the batch
+                for _, client, fut in adds:
+                    try:
+                        await self.manager.add_client(inbound_id, [client])
+                        self.stats["panel_writes"] += 1
+                        self._resolve(fut, client)
+                    except Exception as e:
+                        self._resolve(fut, error=e)
+        for _, op, fut in renews:
+            try:
+                client = await self.manager.inbounds.find_client(inbound_id, op['email'])
+                if not client:
+                    self._resolve(fut, None); continue
+                expiry = op['expiry_ms']
+                if expiry is None:
+                    traffic = await self.manager.get_client_traffic(op['email'])
+                    expiry = self._renewed_expiry((traffic or client).get('expiryTime', 0), op['days'])
+                client.update(totalGB=op['total_gb'], expiryTime=expiry, enable=True)
+                await self.manager.update_client(inbound_id, client)
+                self.stats["panel_writes"] += 1
+                self._resolve(fut, client['expiryTime'])
+            except Exception as e:
+                self._resolve(fut, error=e)
+        if rewrites:
+            await self._rewrite(inbound_id, rewrites)
+
+    # Applies every queued operation to one fresh copy of the inbound and writes it back once
+    async def _rewrite(self, inbound_id: int, ops: list):
+        results = {}
+
+        def mutate(settings):
+            key = 'peers' if 'peers' in settings or 'clients' not in settings else 'clients'
+            for kind, payload, fut in ops:
+                if kind == 'add':
+                    settings.setdefault('clients', []).append(payload); results[fut] = payload
+                elif kind == 'peer':
+                    settings.setdefault(key, []).append(payload); results[fut] = payload
+                else:
+                    client = next((c for c in settings.get('clients', []) if c.get('email') == payload['email']), None)
+                    if client:
+                        client.update(totalGB=payload['total_gb'], expiryTime=payload['expiry_ms'] or self._renewed_expiry(client.get('expiryTime', 0), payload['days']), enable=True)
+                    results[fut] = client['expiryTime'] if client else None
+        await self.manager.update_inbound_settings(inbound_id, mutate)
+        self.stats["panel_writes"] += 1
+        for fut, result in results.items(): self._resolve(fut, result)
+
+    async def close(self):
+        workers = [w for w in self._workers.values() if not w.done()]
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
+
+# --- Node Registry ---
+# A node is one 3x-ui panel with its own login, connection pool, inbound cache and provisioning queue.
+# Without TXUI_NODES the bot runs a single node built from TXUI_PANEL_URL/SERVER_DOMAIN/TEST_INBOUND_REMARK.
+# TXUI_NODES points to a JSON list of {"name", "panel_url", "username", "password", "server_domain",
+# "inbound_remark", "capacity"} objects; the first entry also owns services created before nodes existed.
+class Node:
+    def __init__(self, name: str, panel_url: str, username: str, password: str, server_domain: str, inbound_remark: str, capacity: int = 0):
+        self.name, self.server_domain, self.inbound_remark, self.capacity = name, server_domain, inbound_remark, capacity
+        self.manager = TxuiManager(panel_url, username, password)
+        self.provisioner = ProvisioningScheduler(self.manager)
+        self.healthy, self.failures = True, 0
+        self.clients, self.traffic_rate = 0, 0.0
+        self._traffic, self._checked_at = None, None
+
+    # Client count and traffic come from the inbound list the health check just refreshed
+    def _measure(self):
+        stats = [c for entry in self.manager.inbounds.entries() for c in entry.get('clientStats') or []]
+        traffic = sum((c.get('up') or 0) + (c.get('down') or 0) for c in stats)
+        now = time.monotonic()
+        if self._traffic is not None and now > self._checked_at:
+            self.traffic_rate = max(0, traffic - self._traffic) / (now - self._checked_at)
+        self.clients, self._traffic, self._checked_at = len(stats), traffic, now
+
+    async def check(self, fail_threshold: int = NODE_FAIL_THRESHOLD):
+        try:
+            await self.manager.inbounds.refresh()
+        except Exception as e:
+            self.failures += 1
+            if self.healthy and self.failures >= fail_threshold:
+                self.healthy = False
+                await log_to_admins(f"نود {self.name} از دسترس خارج شد: {e}")
+            return
+        if not self.healthy:
+            await log_to_admins(f"نود {self.name} دوباره در دسترس است.")
+        self.healthy, self.failures = True, 0
+        self._measure()
+
+    def load(self, busiest_rate: float) -> float:
+        clients = self.clients / self.capacity if self.capacity else self.clients / 10000
+        return clients + (self.traffic_rate / busiest_rate if busiest_rate else 0)
+
+def load_nodes() -> list:
+    if not TXUI_NODES:
+        return [Node('main', TXUI_PANEL_URL, TXUI_USERNAME, TXUI_PASSWORD, SERVER_DOMAIN, TEST_INBOUND_REMARK)]
+    with open(TXUI_NODES, encoding='utf-8') as f:
+        return [Node(n['name'], n['panel_url'], n['username'], n['password'], n['server_domain'], n.get('inbound_remark') or TEST_INBOUND_REMARK, int(n.get('capacity') or 0))
+                for n in json.load(f)]
+
+class NodeRegistry:
+    def __init__(self, nodes: list, interval: int = NODE_HEALTH_INTERVAL):
+        self.nodes = {node.name: node for node in nodes}
+        self.default = nodes[0]
+        self.interval = interval
+        self._task = None
+
+    def get(self, name: Optional[str]) -> Node:
+        return self.nodes.get(name) or self.default
+
+    # New clients go to the least loaded healthy node that has an inbound for the service
+    async def place(self, service: str):
+        candidates = [n for n in self.nodes.values() if n.healthy] or [self.default]
+        busiest = max(n.traffic_rate for n in candidates)
+        for node in sorted(candidates, key=lambda n: n.load(busiest)):
+            try:
+                inbound = await node.manager.inbounds.find(node.inbound_remark, service=service)
+            except Exception as e:
+                print(f"Node {node.name} unavailable for placement: {e}")
+                continue
+            if inbound:
+                return node, inbound
+        return None, None
+
+    # The inbound currently holding `remark` on its node, falling back to the node's configured inbound
+    async def locate(self, node: Node, remark: str, service: str = None):
+        stats = await node.manager.inbounds.find_client_stats(remark)
+        if stats and stats.get('inboundId'):
+            return await node.manager.inbounds.get(stats['inboundId'])
+        return await node.manager.inbounds.find(node.inbound_remark, service=service)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(node.check() for node in self.nodes.values()))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        for node in self.nodes.values():
+            node.manager.inbounds.start()
+        # With a single panel there is nothing to route around, so the extra polling is skipped
+        if len(self.nodes) > 1 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+        for node in self.nodes.values():
+            await node.provisioner.close()
+            await node.manager.close()
+
+node_registry = NodeRegistry(load_nodes())
+# The default node's manager and queue, for code that predates multiple panels
+txui_manager, provisioner = node_registry.default.manager, node_registry.default.provisioner
+
+# Returns (kind, record) for a new client of `plan` on `inbound`, where kind picks provisioner.add_client or
+# add_peer, or None when the inbound's protocol is not supported.
+def new_client_record(inbound: dict, remark: str, plan: dict):
+    protocol = (inbound.get('protocol') or '').lower()
+    expiry_ms = int((datetime.now() + timedelta(days=plan['days'])).timestamp() * 1000)
+    total_gb = int(plan.get('limit', 0) * 1024 * 1024 * 1024)
+    if protocol in CLIENT_PROTOCOLS:
+        record = {"email": remark, "totalGB": total_gb, "expiryTime": expiry_ms, "limitIp": 2, "enable": True}
+        if protocol == 'trojan':
+            record['password'] = secrets.token_urlsafe(16)
+        elif protocol == 'shadowsocks':
+            # 2022 ciphers need a base64 key of the cipher's size; the older ones take any string
+            method = inbound_settings(inbound).get('method', '')
+            key = os.urandom(16 if '128' in method else 32)
+            record.update(method=method, password=base64.b64encode(key).decode() if method.startswith('2022') else secrets.token_urlsafe(16))
+        else:
+            record['id'] = str(uuid.uuid4())
+        return 'client', record
+    if protocol == 'wireguard':
+        # generate simple base64 keys (note: for production you should generate real WG keys)
+        priv_b64 = base64.b64encode(os.urandom(32)).decode()
+        pub_b64 = base64.b64encode(os.urandom(32)).decode()
+        return 'peer', {"id": str(uuid.uuid4()), "email": remark, "totalGB": total_gb, "expiryTime": expiry_ms, "enable": True, "privateKey": priv_b64, "publicKey": pub_b64}
+    return None
+
+def inbound_settings(inbound: dict) -> dict:
+    try: return json.loads(inbound.get('settings') or '{}')
+    except (TypeError, ValueError): return {}
+
+def client_link(inbound: dict, record: dict, server_address: str = SERVER_DOMAIN) -> str:
+    server_port, remark = inbound['port'], record['email']
+    protocol = (inbound.get('protocol') or '').lower()
+    if 'publicKey' in record:
+        # Build a wireguard config link (may need manual tweaks depending on panel/server setup)
+        return f"wg://{record['publicKey']}@{server_address}:{server_port}?preshared_key={base64.b64encode(os.urandom(16)).decode()}#{remark}"
+    if protocol == 'shadowsocks':
+        settings = inbound_settings(inbound)
+        method = record.get('method') or settings.get('method', '')
+        # Multi-user 2022 ciphers take the server key followed by the user key
+        secret = f"{settings['password']}:{record['password']}" if method.startswith('2022') and settings.get('password') else record['password']
+        userinfo = base64.urlsafe_b64encode(f"{method}:{secret}".encode()).decode().rstrip('=')
+        return f"ss://{userinfo}@{server_address}:{server_port}#{remark}"
+    stream_settings = inbound['stream']
+    params = {'type': stream_settings.get('network', 'tcp'), 'security': stream_settings.get('security', 'none')}
+    if params['security'] == 'tls': params['sni'] = stream_settings.get('tlsSettings', {}).get('serverName', server_address)
+    if protocol == 'trojan':
+        return f"trojan://{record['password']}@{server_address}:{server_port}?{urlencode(params)}#{remark}"
+    return f"vless://{record['id']}@{server_address}:{server_port}?{urlencode(params)}#{remark}"
+
+# --- QR Rendering ---
+# Encoding a QR matrix is pure Python and holds the GIL for ~10-20 ms, so renders run in a small process
+# pool (threads where fork is unavailable, e.g. the Windows build) and results are cached by link hash.
+#   png  - qrcode's default image, same output as before
+#   fast - fixed mask pattern drawn straight into a 1-bit PNG, roughly 3x cheaper to produce
+#   svg  - vector image, sent as a document because Telegram photos must be raster
+QR_FORMATS = {'png': ('config_qr.png', True), 'fast': ('config_qr.png', True), 'svg': ('config_qr.svg', False)}
+
+def render_qr(link: str, fmt: str = 'png') -> bytes:
+    if fmt == 'png':
+        bio = io.BytesIO()
+        qrcode.make(link).save(bio, 'PNG')
+        return bio.getvalue()
+    # Every mask pattern gives a valid code; skipping the penalty search over all eight is most of the saving.
+    qr = qrcode.QRCode(mask_pattern=0, border=2)
+    qr.add_data(link)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    size = len(matrix)
+    if fmt == 'svg':
+        path = ''.join(f"M{x},{y}h1v1h-1z" for y, row in enumerate(matrix) for x, dark in enumerate(row) if dark)
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" width="{size * 10}" height="{size * 10}" shape-rendering="crispEdges">'
+                f'<rect width="100%" height="100%" fill="#fff"/><path d="{path}" fill="#000"/></svg>').encode()
+    pixels = bytes(0 if dark else 255 for row in matrix for dark in row)
+    img = Image.frombytes('L', (size, size), pixels).resize((size * 8, size * 8), Image.NEAREST).convert('1')
+    bio = io.BytesIO()
+    img.save(bio, 'PNG', compress_level=1)
+    return bio.getvalue()
+
+class QrRenderer:
+    def __init__(self, fmt: str = QR_FORMAT, workers: int = QR_WORKERS, cache_size: int = QR_CACHE_SIZE):
+        self.fmt = fmt if fmt in QR_FORMATS else 'png'
+        self.workers = max(1, workers)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._pool = None
+        self.stats = {"renders": 0, "hits": 0, "render_time": 0.0}
+
+    def _executor(self):
+        if self._pool is None:
+            # Forking a process that already runs the db threads can copy a lock some other thread holds,
+            # so workers start from a fresh interpreter instead.
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def start(self):
+        # Spawned workers import the whole bot; boot them before updates arrive so the first renders don't wait on it.
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(self._executor(), render_qr, 'warmup', self.fmt) for _ in range(self.workers)))
+        except BrokenProcessPool:
+            print("QR process pool failed to start, falling back to threads")
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr")
+
+    async def _render(self, link: str, fmt: str) -> bytes:
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(self._executor(), render_qr, link, fmt)
+        except BrokenProcessPool:
+            print("QR process pool died, falling back to threads")
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr")
+            data = await loop.run_in_executor(self._pool, render_qr, link, fmt)
+        self.stats["renders"] += 1
+        self.stats["render_time"] += time.perf_counter() - started
+        QR_SECONDS.observe(time.perf_counter() - started, fmt)
+        return data
+
+    # cache=False is for one-off bulk renders that would only evict the links users actually re-request
+    async def render(self, link: str, fmt: Optional[str] = None, cache: bool = True) -> bytes:
+        fmt = fmt or self.fmt
+        if not cache:
+            return await self._render(link, fmt)
+        key = hashlib.sha256(f"{fmt}:{link}".encode()).digest()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.stats["hits"] += 1
+            return self._cache[key]
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._render(link, fmt))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        data = await asyncio.shield(task)
+        self._cache[key] = data
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    async def send(self, chat_id: int, link: str, caption: str, **kwargs):
+        data = await self.render(link)
+        filename, as_photo = QR_FORMATS[self.fmt]
+        if as_photo:
+            return await bot.send_photo(chat_id=chat_id, photo=types.BufferedInputFile(data, filename), caption=caption, **kwargs)
+        return await bot.send_document(chat_id=chat_id, document=types.BufferedInputFile(data, filename), caption=caption, **kwargs)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+qr_renderer = QrRenderer()
+
+# --- Bulk Provisioning ---
+# Bulk orders are created in chunks of BULK_CHUNK_SIZE with at most BULK_CONCURRENCY clients in flight.
+# Each chunk's links and QR images are appended to the job's directory under BULK_DIR and then committed
+# in bulk_jobs, so an interrupted job resumes from the last committed chunk. Remarks are derived from the
+# job id and index, which lets a resumed job adopt clients that reached the panel in an uncommitted chunk.
+class BulkProvisioner:
+    def __init__(self, root: str = BULK_DIR, chunk_size: int = BULK_CHUNK_SIZE, concurrency: int = BULK_CONCURRENCY):
+        self.root = Path(root)
+        self.chunk_size, self.concurrency = max(1, chunk_size), max(1, concurrency)
+        self._tasks = {}
+        self._last_progress = {}
+
+    @staticmethod
+    def remark(job: dict, index: int) -> str:
+        return f"{job['prefix']}_{job['id']}_{index + 1}"
+
+    def _dir(self, job_id: int) -> Path:
+        return self.root / str(job_id)
+
+    def is_running(self, job_id: int) -> bool:
+        task = self._tasks.get(job_id)
+        return task is not None and not task.done()
+
+    def start(self, job_id: int):
+        if not self.is_running(job_id):
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+
+    async def _progress(self, job: dict, done: int, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self._last_progress.get(job['id'], 0) < 2:
+            return
+        self._last_progress[job['id']] = now
+        bar = '▓' * (10 * done // job['quantity']) + '░' * (10 - 10 * done // job['quantity'])
+        try:
+            await bot.edit_message_text(f"⏳ ساخت گروهی #{job['id']}\n{bar} {done}/{job['quantity']}", chat_id=job['chat_id'], message_id=job['message_id'])
+        except Exception:
+            pass
+
+    # Clients from earlier attempts of this job that the panel already has, keyed by remark
+    async def _existing(self, job: dict, node: Node, inbound_id: int) -> dict:
+        obj = await node.manager.inbounds.fetch(inbound_id) or {}
+        try: settings = json.loads(obj.get('settings') or '{}')
+        except (TypeError, ValueError): settings = {}
+        marker = f"{job['prefix']}_{job['id']}_"
+        return {c['email']: c for c in (settings.get('clients') or []) + (settings.get('peers') or []) if str(c.get('email', '')).startswith(marker)}
+
+    @staticmethod
+    def _truncate_links(path: Path, lines: int):
+        # Drops links a crashed chunk appended after the last commit, reading one line at a time
+        if not path.exists():
+            return
+        with open(path, 'r+b') as f:
+            for _ in range(lines):
+                if not f.readline(): break
+            f.truncate(f.tell())
+
+    @staticmethod
+    def _write_chunk(job_dir: Path, results: list):
+        qr_dir = job_dir / 'qr'
+        qr_dir.mkdir(parents=True, exist_ok=True)
+        ext = QR_FORMATS[qr_renderer.fmt][0].rsplit('.', 1)[1]
+        for remark, _, image in results:
+            (qr_dir / f"{remark}.{ext}").write_bytes(image)
+        with open(job_dir / 'links.txt', 'a', encoding='utf-8') as f:
+            f.write(''.join(f"{link}\n" for _, link, _ in results))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _archive(job_dir: Path, zip_path: Path):
+        # Files are copied into the zip one at a time, so memory stays flat whatever the job size
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.write(job_dir / 'links.txt', 'configs.txt', compress_type=zipfile.ZIP_DEFLATED)
+            for image in sorted((job_dir / 'qr').iterdir()):
+                zf.write(image, f"qr/{image.name}", compress_type=zipfile.ZIP_STORED)
+
+    async def _chunk(self, job: dict, node: Node, inbound: dict, plan: dict, start: int, end: int, existing: dict, slots: asyncio.Semaphore) -> list:
+        async def one(index):
+            remark = self.remark(job, index)
+            async with slots:
+                record = existing.get(remark)
+                if record is None:
+                    kind, record = new_client_record(inbound, remark, plan)
+                    await (node.provisioner.add_peer if kind == 'peer' else node.provisioner.add_client)(inbound['id'], record)
+                link = client_link(inbound, record, node.server_domain)
+                return remark, link, await qr_renderer.render(link, cache=False)
+        # Let every client of the chunk settle before failing, so a resume never races leftovers of this attempt
+        results = await asyncio.gather(*(one(i) for i in range(start, end)), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise errors[0]
+        return results
+
+    async def _run(self, job_id: int):
+        send_priority.set(PRIORITY_BULK)
+        job = await bulk_repo.get(job_id)
+        plan, service = get_plan_by_key(job['plan_key'])
+        job_dir = self._dir(job_id)
+        try:
+            # A job stays on the node it started on so that a resume can find its earlier clients
+            if job['node']:
+                node = node_registry.get(job['node'])
+                inbound = await node.manager.inbounds.find(node.inbound_remark, service=service)
+            else:
+                node, inbound = await node_registry.place(service)
+            if not inbound or new_client_record(inbound, 'probe', plan) is None:
+                raise PanelError(f"no usable inbound for {service}")
+            if not job['node']:
+                await bulk_repo.set_node(job_id, node.name)
+            await bulk_repo.set_status(job_id, 'running')
+            job_dir.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(self._truncate_links, job_dir / 'links.txt', job['committed'])
+            existing = await self._existing(job, node, inbound['id']) if job['committed'] or job['status'] != 'running' else {}
+            slots = asyncio.Semaphore(self.concurrency)
+            done = job['committed']
+            await self._progress(job, done, final=True)
+            while done < job['quantity']:
+                end = min(done + self.chunk_size, job['quantity'])
+                results = await self._chunk(job, node, inbound, plan, done, end, existing, slots)
+                await asyncio.to_thread(self._write_chunk, job_dir, results)
+                await bulk_repo.commit_chunk(job_id, end)
+                done = end
+                await self._progress(job, done, final=done == job['quantity'])
+
+            zip_path = self.root / f"{job['prefix']}_{job_id}.zip"
+            await asyncio.to_thread(self._archive, job_dir, zip_path)
+            caption = f"✅ {job['quantity']} اشتراک از پلن '{plan['label']}' با موفقیت ساخته شد."
+            # Bot API uploads are capped at 50 MB; past that only the link list is sent and the zip stays on disk
+            if zip_path.stat().st_size < 49 * 1024 * 1024:
+                await bot.send_document(job['chat_id'], FSInputFile(zip_path), caption=caption)
+                zip_path.unlink()
+            else:
+                await bot.send_document(job['chat_id'], FSInputFile(job_dir / 'links.txt', f"{job['prefix']}_configs.txt"), caption=f"{caption}\n\n📦 فایل کامل QR‌ها روی سرور: {zip_path}")
+            await bulk_repo.set_status(job_id, 'done')
+            await asyncio.to_thread(shutil.rmtree, job_dir, True)
+            await log_to_admins(f"ادمین {job['admin_id']} تعداد {job['quantity']} اشتراک از پلن {plan['label']} ساخت.")
+        except Exception as e:
+            await bulk_repo.set_status(job_id, 'failed', str(e))
+            job = await bulk_repo.get(job_id)
+            kb = InlineKeyboardBuilder().row(types.InlineKeyboardButton(text="▶️ ادامه ساخت", callback_data=f"bulk_resume_{job_id}"))
+            await bot.send_message(job['chat_id'], f"❌ ساخت گروهی #{job_id} پس از {job['committed']}/{job['quantity']} اشتراک متوقف شد.", reply_markup=kb.as_markup())
+            await log_to_admins(f"خطای ساخت گروهی #{job_id}: {e}")
+        finally:
+            self._last_progress.pop(job_id, None)
+
+    # Jobs cut off by a restart are reported with a resume button rather than restarted blindly
+    async def recover(self):
+        for job in await bulk_repo.list_by_status('running'):
+            await bulk_repo.set_status(job['id'], 'failed', 'interrupted by restart')
+            kb = InlineKeyboardBuilder().row(types.InlineKeyboardButton(text="▶️ ادامه ساخت", callback_data=f"bulk_resume_{job['id']}"))
+            try:
+                await bot.send_message(job['chat_id'] or job['admin_id'], f"⚠️ ساخت گروهی #{job['id']} با راه‌اندازی مجدد ربات در {job['committed']}/{job['quantity']} متوقف شد.", reply_markup=kb.as_markup())
+            except Exception as e:
+                print(f"Could not report interrupted bulk job {job['id']}: {e}")
+
+    async def close(self):
+        tasks = [t for t in self._tasks.values() if not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+bulk_provisioner = BulkProvisioner()
+
+# --- Usage Monitor ---
+# Every MONITOR_INTERVAL seconds the full inbound list (with clientStats) is pulled in one request, which
+# also refreshes the inbound cache. Only clients whose usage percentage, quota, expiry or enable flag
+# changed since the previous cycle are written back, in chunks; the previous cycle is remembered as one
+# integer fingerprint per client. Users then get one message per cycle covering all of their services
+# that crossed USAGE_ALERT_PERCENT or expire within EXPIRY_ALERT_DAYS, with a renew button for each.
+class UsageMonitor:
+    CHUNK = 500
+
+    def __init__(self, interval: int = MONITOR_INTERVAL, usage_percent: int = USAGE_ALERT_PERCENT, expiry_days: int = EXPIRY_ALERT_DAYS):
+        self.interval, self.usage_percent, self.expiry_days = interval, usage_percent, expiry_days
+        self._fingerprints = {}
+        self._task = None
+        self.stats = {"cycles": 0, "clients": 0, "changed": 0, "reminders": 0, "last_duration": 0.0}
+
+    def _changes(self, nodes: list):
+        fingerprints = {}
+        for entry in (entry for node in nodes for entry in node.manager.inbounds.entries()):
+            for client in entry.get('clientStats') or []:
+                email, total = client.get('email'), client.get('total') or 0
+                used = (client.get('up') or 0) + (client.get('down') or 0)
+                percent = min(100, used * 100 // total) if total else 0
+                # 3x-ui stores "starts on first use" expiries as negative durations; those have no date yet
+                expiry = (client.get('expiryTime') or 0) // 1000 if (client.get('expiryTime') or 0) > 0 else None
+                key, fingerprint = hash(email), hash((percent, total, expiry, client.get('enable')))
+                fingerprints[key] = fingerprint
+                if self._fingerprints.get(key) != fingerprint:
+                    yield email, percent, expiry
+        self.stats["clients"] = len(fingerprints)
+        self._fingerprints = fingerprints
+
+    async def run_once(self):
+        started = time.monotonic()
+        nodes = []
+        for node in node_registry.nodes.values():
+            try:
+                await node.manager.inbounds.refresh()
+                nodes.append(node)
+            except Exception as e:
+                print(f"Usage monitor skipped node {node.name}: {e}")
+        reminders = {}
+        changes = self._changes(nodes)
+        while chunk := list(itertools.islice(changes, self.CHUNK)):
+            self.stats["changed"] += len(chunk)
+            for svc in await service_repo.sync_usage(chunk, self.usage_percent):
+                reminders.setdefault(svc['user_id'], []).append(svc)
+        for svc in await service_repo.claim_expiring(int(time.time()) + self.expiry_days * 86400):
+            reminders.setdefault(svc['user_id'], []).append(svc)
+        await self._notify(reminders)
+        self.stats["cycles"] += 1
+        self.stats["last_duration"] = time.monotonic() - started
+
+    async def _remind(self, user_id: int, services: list):
+        lines, kb = [], InlineKeyboardBuilder()
+        for svc in services:
+            if 'percent' in svc:
+                lines.append(f"📊 سرویس <b>{svc['remark']}</b>: {svc['percent']}٪ حجم مصرف شده است.")
+            else:
+                days_left = max(0, (svc['expire_at'] - int(time.time())) // 86400)
+                lines.append(f"⏳ سرویس <b>{svc['remark']}</b>: {days_left} روز تا پایان اعتبار باقی مانده است.")
+        for svc_id, remark in dict((svc['id'], svc['remark']) for svc in services).items():
+            kb.row(types.InlineKeyboardButton(text=f"♻️ تمدید {remark}", callback_data=f"renew_svc_{svc_id}"))
+        try:
+            await bot.send_message(user_id, "🔔 <b>یادآوری اشتراک</b>\n\n" + "\n".join(lines), reply_markup=kb.as_markup())
+            self.stats["reminders"] += 1
+        except TelegramForbiddenError:
+            pass
+        except Exception as e:
+            print(f"Could not send reminder to {user_id}: {e}")
+
+    async def _notify(self, reminders: dict):
+        # The outbound scheduler paces these; batching only bounds how many sends are pending at once
+        users = list(reminders.items())
+        with sending_priority(PRIORITY_BULK):
+            for i in range(0, len(users), self.CHUNK):
+                await asyncio.gather(*(self._remind(user_id, services) for user_id, services in users[i:i + self.CHUNK]))
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Usage monitor cycle failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+usage_monitor = UsageMonitor()
+
+# --- Payment Verification ---
+# Explorer backends return {txid: {"to", "amount", "time", "ok", "comment"}} for those of `txids` found among
+# the incoming transfers to `wallet` since the unix time `since`, so one walk per chain covers every receipt
+# waiting in a cycle. Pages are followed back to `since` (at most MAX_PAGES of them). TxIDs are lowercase hex.
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+def tron_address(hex_address: str) -> str:
+    if not hex_address or hex_address.startswith('T'): return hex_address
+    raw = bytes.fromhex(hex_address)
+    raw += hashlib.sha256(hashlib.sha256(raw).digest()).digest()[:4]
+    n, encoded = int.from_bytes(raw, 'big'), ''
+    while n:
+        n, rem = divmod(n, 58)
+        encoded = BASE58_ALPHABET[rem] + encoded
+    return '1' * (len(raw) - len(raw.lstrip(b'\0'))) + encoded
+
+class TronGridExplorer:
+    symbol = "TRX"
+    MAX_PAGES = 20
+
+    def __init__(self, base_url: str = TRX_EXPLORER_URL, api_key: str = TRX_EXPLORER_API_KEY, page_size: int = 200):
+        self.base_url, self.api_key, self.page_size = base_url.rstrip('/'), api_key, page_size
+
+    @staticmethod
+    def same_address(a: str, b: str) -> bool:
+        return tron_address(a) == tron_address(b)
+
+    async def fetch(self, client: httpx.AsyncClient, wallet: str, txids: list, since: int) -> dict:
+        headers = {"TRON-PRO-API-KEY": self.api_key} if self.api_key else {}
+        params = {"only_to": "true", "only_confirmed": "true", "limit": self.page_size, "order_by": "block_timestamp,desc", "min_timestamp": since * 1000}
+        wanted, found = set(txids), {}
+        for _ in range(self.MAX_PAGES):
+            response = await client.get(f"{self.base_url}/v1/accounts/{wallet}/transactions", params=params, headers=headers)
+            response.raise_for_status()
+            body = response.json()
+            for tx in body.get('data', []):
+                txid = str(tx.get('txID', '')).lower()
+                if txid not in wanted: continue
+                ok = (tx.get('ret') or [{}])[0].get('contractRet') == 'SUCCESS'
+                for contract in tx.get('raw_data', {}).get('contract', []):
+                    if contract.get('type') == 'TransferContract':
+                        value = contract.get('parameter', {}).get('value', {})
+                        found[txid] = {"to": tron_address(value.get('to_address', '')), "amount": (value.get('amount') or 0) / 1_000_000,
+                                       "time": (tx.get('block_timestamp') or 0) // 1000, "ok": ok, "comment": None}
+            fingerprint = body.get('meta', {}).get('fingerprint')
+            if wanted <= found.keys() or not fingerprint:
+                break
+            params["fingerprint"] = fingerprint
+        return found
+
+# toncenter's v3 API, whose transactions carry the compute/action phase results that v2 leaves out
+class TonCenterExplorer:
+    symbol = "TON"
+    MAX_PAGES = 20
+
+    def __init__(self, base_url: str = TON_EXPLORER_URL, api_key: str = TON_EXPLORER_API_KEY, page_size: int = 100):
+        self.base_url, self.api_key, self.page_size = base_url.rstrip('/'), api_key, page_size
+
+    # Raw (0:abcd...) and user-friendly (EQ.../UQ...) forms of one address compare equal
+    @staticmethod
+    def address_key(address: str) -> tuple:
+        if ':' in address:
+            workchain, account = address.split(':', 1)
+            return int(workchain), account.lower()
+        raw = base64.urlsafe_b64decode(address.replace('+', '-').replace('/', '_') + '=' * (-len(address) % 4))
+        return int.from_bytes(raw[1:2], 'big', signed=True), raw[2:34].hex()
+
+    @classmethod
+    def same_address(cls, a: str, b: str) -> bool:
+        try:
+            return cls.address_key(a) == cls.address_key(b)
+        except (ValueError, TypeError):
+            return False
 
-                token = res.cookies.get("3x-ui")
-                print(f"🔹 کوکی دریافتی 3x-ui: {token}")
+    # A bounced or aborted transaction still has an in_msg with a source; only the phases tell it failed
+    @staticmethod
+    def succeeded(tx: dict) -> bool:
+        description = tx.get('description') or {}
+        compute, action = description.get('compute_ph') or {}, description.get('action') or {}
+        return not description.get('aborted', True) and compute.get('success') is True and action.get('success', True) is True
+
+    async def fetch(self, client: httpx.AsyncClient, wallet: str, txids: list, since: int) -> dict:
+        headers = {"X-API-Key": self.api_key} if self.api_key else {}
+        params = {"account": wallet, "limit": self.page_size, "offset": 0, "sort": "desc", "start_utime": since}
+        wanted, found = set(txids), {}
+        for _ in range(self.MAX_PAGES):
+            response = await client.get(f"{self.base_url}/transactions", params=params, headers=headers)
+            response.raise_for_status()
+            page = response.json().get('transactions', [])
+            for tx in page:
+                txid = normalize_txid(tx.get('hash', ''))
+                if txid not in wanted: continue
+                message = tx.get('in_msg') or {}
+                decoded = (message.get('message_content') or {}).get('decoded') or {}
+                found[txid] = {"to": message.get('destination') or '', "amount": int(message.get('value') or 0) / 1_000_000_000,
+                               "time": tx.get('now') or 0, "ok": bool(message.get('source')) and self.succeeded(tx),
+                               "comment": decoded.get('comment') if decoded.get('type') == 'text_comment' else None}
+            if wanted <= found.keys() or len(page) < self.page_size:
+                break
+            params["offset"] += len(page)
+        return found
+
+# TON explorers show transaction hashes as hex or base64; both are stored as lowercase hex
+def normalize_txid(txid: str) -> str:
+    txid = txid.strip()
+    if re.fullmatch(r'[0-9a-fA-F]{64}', txid): return txid.lower()
+    try:
+        raw = base64.urlsafe_b64decode(txid.replace('+', '-').replace('/', '_') + '=' * (-len(txid) % 4))
+        if len(raw) == 32: return raw.hex()
+    except ValueError:
+        pass
+    return txid.lower()
+
+# Checks receipts against the chain. A successful transfer to our wallet, sent while the invoice was open and
+# tied to it by the invoice's unique amount (or, on TON, its id as the comment), within PAYMENT_AMOUNT_TOLERANCE
+# percent of the invoiced amount, is approved and fulfilled on the spot. Anything else goes to the admins, as
+# do receipts still missing (or not checkable because the explorer is down) after PAYMENT_VERIFY_TIMEOUT.
+# New receipts wake the worker, which waits BATCH_DELAY so receipts arriving together share one lookup.
+class PaymentVerifier:
+    BATCH_DELAY = 2
+
+    def __init__(self, explorers: list, interval: int = PAYMENT_VERIFY_INTERVAL, timeout: int = PAYMENT_VERIFY_TIMEOUT, tolerance: float = PAYMENT_AMOUNT_TOLERANCE):
+        self.explorers = {explorer.symbol: explorer for explorer in explorers}
+        self.interval, self.timeout, self.tolerance = interval, timeout, tolerance
+        self._wake = asyncio.Event()
+        self._client = None
+        self._task = None
+        self.stats = {"checked": 0, "approved": 0, "review": 0, "explorer_errors": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=15)
+        return self._client
+
+    def supports(self, symbol: str) -> bool:
+        return PAYMENT_AUTO_VERIFY and symbol in self.explorers
+
+    def nudge(self):
+        self._wake.set()
+
+    def overdue(self, payment: dict) -> bool:
+        return time.time() - payment['created_at'] > self.timeout
+
+    # Oldest moment a transfer for `payment` may have been sent; receipts from before the invoices table
+    # fall back to one invoice lifetime before they were submitted
+    @staticmethod
+    def since(payment: dict) -> int:
+        return payment['invoice_created_at'] or payment['created_at'] - INVOICE_TTL
+
+    def _verdict(self, explorer, payment: dict, transfer: Optional[dict]):
+        if transfer is None:
+            if self.overdue(payment):
+                return f"تراکنش پس از {self.timeout // 60} دقیقه در شبکه یافت نشد."
+            return None
+        if not transfer['ok']:
+            return "تراکنش در شبکه ناموفق ثبت شده است."
+        if not explorer.same_address(transfer['to'], payment['wallet']):
+            return f"مقصد تراکنش ({transfer['to']}) کیف پول ما نیست."
+        if payment['invoice_created_at'] is None:
+            return "فاکتور این رسید در پایگاه داده نیست."
+        if transfer['time'] < payment['invoice_created_at']:
+            return "تراکنش پیش از صدور این فاکتور ارسال شده است."
+        if transfer['time'] > payment['invoice_expires_at']:
+            return "تراکنش پس از انقضای فاکتور ارسال شده است."
+        if transfer['amount'] < payment['amount'] * (1 - self.tolerance / 100):
+            return f"مبلغ واریزی {transfer['amount']} کمتر از مبلغ فاکتور {payment['amount']} است."
+        if transfer['amount'] > payment['amount'] * (1 + self.tolerance / 100):
+            return f"مبلغ واریزی {transfer['amount']} بیشتر از مبلغ فاکتور {payment['amount']} است."
+        exact = round(transfer['amount'] * 1_000_000) == round(payment['amount'] * 1_000_000)
+        if not exact and (transfer['comment'] or '').strip().upper() != payment['invoice_id']:
+            return "مبلغ دقیق یا ممو تراکنش با این فاکتور مطابقت ندارد؛ ممکن است واریز مربوط به فاکتور دیگری باشد."
+        return True
+
+    async def run_once(self):
+        by_symbol = {}
+        for payment in await payment_repo.list_pending():
+            by_symbol.setdefault(payment['symbol'], []).append(payment)
+        for symbol, payments in by_symbol.items():
+            explorer = self.explorers.get(symbol)
+            if explorer is None:
+                for payment in payments:
+                    await self._review(payment, "بررسی خودکار برای این ارز فعال نیست.")
+                continue
+            try:
+                transfers = {}
+                for wallet in {p['wallet'] for p in payments}:
+                    mine = [p for p in payments if p['wallet'] == wallet]
+                    transfers.update(await explorer.fetch(self.client, wallet, [p['txid'] for p in mine], min(map(self.since, mine))))
+            except Exception as e:
+                self.stats["explorer_errors"] += 1
+                print(f"{symbol} explorer lookup failed: {e}")
+                # An explorer that stays down must not hold receipts back from the admins forever
+                reason = f"سرویس بررسی شبکه {symbol} پس از {self.timeout // 60} دقیقه در دسترس نبود."
+                verdicts = [(payment, reason) for payment in payments if self.overdue(payment)]
+            else:
+                self.stats["checked"] += len(payments)
+                verdicts = [(payment, self._verdict(explorer, payment, transfers.get(payment['txid']))) for payment in payments]
+            for result in await asyncio.gather(*(self._approve(payment) if verdict is True else self._review(payment, verdict)
+                                                 for payment, verdict in verdicts if verdict), return_exceptions=True):
+                if isinstance(result, Exception): print(f"Payment handling failed: {result}")
+
+    async def _approve(self, payment: dict):
+        invoice = await invoice_repo.get(payment['invoice_id'])
+        if not invoice or not await approve_invoice(invoice):
+            return await self._review(payment, "فاکتور این تراکنش دیگر در انتظار پرداخت نیست.")
+        if not await payment_repo.resolve(payment['id'], 'approved', 'auto'): return
+        self.stats["approved"] += 1
+        await notify_admins(f"✅ پرداخت فاکتور <code>{payment['invoice_id']}</code> ({payment['amount']} {payment['symbol']}) "
+                            f"از کاربر <a href='tg://user?id={payment['user_id']}'>{payment['user_id']}</a> به صورت خودکار تایید شد.", priority=PRIORITY_LOG)
+
+    async def _review(self, payment: dict, reason: str):
+        if not await payment_repo.resolve(payment['id'], 'review', reason): return
+        self.stats["review"] += 1
+        await request_payment_review(payment, reason)
+        try:
+            with sending_priority(PRIORITY_NOTIFY):
+                await bot.send_message(payment['user_id'], f"ℹ️ تراکنش فاکتور #{payment['invoice_id']} به صورت خودکار تایید نشد و برای بررسی به ادمین ارسال شد.")
+        except Exception: pass
 
-                if token:
-                    self._token = token
-                    self._token_expiry = datetime.now() + timedelta(hours=1)
-                    return token
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Payment verification cycle failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+                await asyncio.sleep(self.BATCH_DELAY)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def start(self):
+        if PAYMENT_AUTO_VERIFY and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+
+payment_verifier = PaymentVerifier([TronGridExplorer(), TonCenterExplorer()])
+
+# Marks unpaid invoices expired once their quote runs out; invoices with a receipt in flight are left alone
+class InvoiceSweeper:
+    def __init__(self, interval: int = INVOICE_SWEEP_INTERVAL):
+        self.interval = interval
+        self._task = None
+        self.stats = {"expired": 0}
+
+    async def _loop(self):
+        while True:
+            try:
+                self.stats["expired"] += await invoice_repo.expire_stale(int(time.time()))
+            except Exception as e:
+                print(f"Invoice sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+invoice_sweeper = InvoiceSweeper()
+
+# --- Provisioning Jobs ---
+# Paid orders are built from provision_jobs by at most PROVISION_JOB_WORKERS concurrent jobs. A failed attempt
+# is retried after PROVISION_JOB_BACKOFF * 2^(attempt-1) seconds (capped at PROVISION_JOB_MAX_BACKOFF, jittered);
+# after PROVISION_JOB_MAX_ATTEMPTS the job is parked as failed and the admins get a retry button.
+# Retries never duplicate work: a new client's node, inbound and full record (uuid/keys) are pinned in the job
+# before the first panel write, so a retry finds the client it already created; a renewal pins its target expiry.
+class JobFailed(Exception):
+    pass
+
+class ProvisionWorker:
+    POLL_INTERVAL = 60
+
+    def __init__(self, workers: int = PROVISION_JOB_WORKERS, max_attempts: int = PROVISION_JOB_MAX_ATTEMPTS,
+                 backoff: float = PROVISION_JOB_BACKOFF, max_backoff: float = PROVISION_JOB_MAX_BACKOFF):
+        self.workers, self.max_attempts = max(1, workers), max(1, max_attempts)
+        self.backoff, self.max_backoff = backoff, max_backoff
+        self._wake = asyncio.Event()
+        self._running = set()
+        self._task = None
+        self.stats = {"done": 0, "retries": 0, "failed": 0}
+
+    def nudge(self):
+        self._wake.set()
+
+    def delay(self, attempts: int) -> float:
+        return min(self.max_backoff, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+    async def _create(self, job: dict, plan: dict):
+        if job['record'] is None:
+            node, inbound = await node_registry.place(job['service_type'])
+            if not inbound:
+                raise PanelError(f"no inbound for {job['service_type']}")
+            created = new_client_record(inbound, job['remark'], plan)
+            if created is None:
+                raise JobFailed(f"protocol {inbound.get('protocol')} is not supported")
+            kind, record = created
+            await provision_job_repo.pin(job['id'], node.name, inbound['id'], record=json.dumps([kind, record]))
+            existing = None
+        else:
+            # A previous attempt may have reached the panel (or even the database) before failing
+            svc = await service_repo.get_by_remark(job['remark'])
+            if svc and svc['user_id'] == job['user_id'] and svc['created_at'] >= job['created_at']:
+                return False
+            node = node_registry.get(job['node'])
+            kind, record = json.loads(job['record'])
+            node.manager.inbounds.invalidate(job['inbound_id'])
+            existing = await node.manager.inbounds.find_client(job['inbound_id'], job['remark'])
+            inbound = await node.manager.inbounds.get(job['inbound_id'])
+            if inbound is None:
+                raise PanelError(f"inbound {job['inbound_id']} not found on {node.name}")
+        if existing is None:
+            await (node.provisioner.add_peer if kind == 'peer' else node.provisioner.add_client)(inbound['id'], record)
+        elif any(existing.get(field) != record.get(field) for field in ('id', 'password')):
+            raise JobFailed(f"name {job['remark']} is taken by another client on the panel")
+        await deliver_service(job['user_id'], plan, job['remark'], job['service_type'], node, inbound, record)
+        return True
+
+    async def _renew(self, job: dict, plan: dict):
+        if job['target_expiry'] is None:
+            svc = await service_repo.get_by_remark(job['remark'])
+            node = node_registry.get(svc['node'] if svc else None)
+            inbound = await node_registry.locate(node, job['remark'], job['service_type'])
+            if not inbound:
+                raise PanelError(f"no inbound holds {job['remark']} on {node.name}")
+            client = await node.manager.inbounds.find_client(inbound['id'], job['remark'])
+            if not client:
+                raise JobFailed(f"client {job['remark']} not found on the panel")
+            traffic = await node.manager.get_client_traffic(job['remark'])
+            target = ProvisioningScheduler._renewed_expiry((traffic or client).get('expiryTime', 0), plan['days'])
+            await provision_job_repo.pin(job['id'], node.name, inbound['id'], target_expiry=target)
+            inbound_id = inbound['id']
+        else:
+            node, inbound_id, target = node_registry.get(job['node']), job['inbound_id'], job['target_expiry']
+        expiry_ms = await node.provisioner.renew_client(inbound_id, job['remark'], plan['days'], int(plan['limit'] * 1024 * 1024 * 1024), expiry_ms=target)
+        if expiry_ms is None:
+            raise JobFailed(f"client {job['remark']} not found on the panel")
+        await deliver_renewal(job['user_id'], plan, job['remark'], expiry_ms)
+        return True
+
+    async def _run(self, job: dict):
+        plan, _ = get_plan_by_key(job['plan_key'])
+        try:
+            if not plan:
+                raise JobFailed(f"unknown plan {job['plan_key']}")
+            delivered = await (self._renew if job['kind'] == 'renew' else self._create)(job, plan)
+            await provision_job_repo.finish(job['id'])
+            self.stats["done"] += 1
+            if delivered and job['message_id']:
+                try: await bot.delete_message(job['chat_id'], job['message_id'])
+                except Exception: pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if isinstance(e, JobFailed) or job['attempts'] >= self.max_attempts:
+                return await self._give_up(job, error, permanent=isinstance(e, JobFailed))
+            self.stats["retries"] += 1
+            await provision_job_repo.retry(job['id'], self.delay(job['attempts']), error)
+            if job['attempts'] == 1:
+                await self._tell_user(job, "⏳ پنل موقتاً پاسخ نمی‌دهد. سفارش شما ثبت شده و به صورت خودکار دوباره انجام می‌شود؛ نیازی به پرداخت مجدد نیست.")
+
+    async def _tell_user(self, job: dict, text: str):
+        try:
+            with sending_priority(PRIORITY_NOTIFY):
+                if job['message_id']:
+                    await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'])
                 else:
-                    await log_to_admins(f"⚠️ لاگین انجام شد اما توکن خالی است! پاسخ: {res.text[:300]}")
+                    await bot.send_message(job['user_id'], text)
+        except Exception: pass
 
-        except Exception as e:
-            await log_to_admins(f"❌ خطای دریافت توکن TXUI: {e}")
-            return None
-txui_manager = TxuiManager()
+    # A wallet-paid job that can never succeed (JobFailed) is refunded; anything else waits for an admin's retry
+    async def _give_up(self, job: dict, error: str, permanent: bool = False):
+        action = "تمدید" if job['kind'] == 'renew' else "ساخت"
+        refunded = await provision_job_repo.refund(job, error) if permanent else None
+        self.stats["failed"] += 1
+        who = f"<a href='tg://user?id={job['user_id']}'>{job['user_id']}</a>"
+        if refunded is not None:
+            await self._tell_user(job, f"❌ {action} سرویس {job['remark']} انجام نشد و مبلغ {refunded:,} تومان به کیف پول شما بازگردانده شد (کد پیگیری #{job['id']}).")
+            return await notify_admins(f"↩️ {action} سرویس <code>{job['remark']}</code> برای کاربر {who} ممکن نبود و مبلغ {refunded:,} تومان "
+                                       f"به کیف پول او بازگشت (سفارش #{job['id']}).\n{error}")
+        await provision_job_repo.fail(job['id'], error)
+        await self._tell_user(job, f"❌ {action} سرویس {job['remark']} انجام نشد. پرداخت شما ثبت شده است و پشتیبانی آن را پیگیری می‌کند (کد پیگیری #{job['id']}).")
+        kb = InlineKeyboardBuilder().row(types.InlineKeyboardButton(text="🔁 تلاش مجدد", callback_data=f"job_retry_{job['id']}"))
+        await notify_admins(f"⚠️ {action} سرویس <code>{job['remark']}</code> برای کاربر {who} "
+                            f"پس از {job['attempts']} تلاش متوقف شد (سفارش #{job['id']}).\n{error}", reply_markup=kb.as_markup())
+
+    def _done(self, task: asyncio.Task):
+        self._running.discard(task)
+        self._wake.set()
+
+    async def _loop(self):
+        recovered = await provision_job_repo.requeue_running()
+        if recovered:
+            print(f"Requeued {recovered} provisioning jobs interrupted by a restart")
+        while True:
+            self._wake.clear()
+            timeout = self.POLL_INTERVAL
+            try:
+                if len(self._running) < self.workers:
+                    for job in await provision_job_repo.claim_due(self.workers - len(self._running)):
+                        task = asyncio.create_task(self._run(job))
+                        self._running.add(task)
+                        task.add_done_callback(self._done)
+                if len(self._running) >= self.workers:
+                    timeout = None  # a finishing job wakes the loop
+                else:
+                    next_due = await provision_job_repo.next_due()
+                    if next_due is not None:
+                        timeout = min(timeout, max(0.0, next_due - time.time()))
+            except Exception as e:
+                print(f"Provisioning job cycle failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        tasks = [t for t in (self._task, *self._running) if t and not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+provision_worker = ProvisionWorker()
 
 # --- Main & Menu Handlers ---
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext, command: CommandObject):
     await state.clear()
-    cur = db_conn.cursor()
 
     referrer_id = None
     if command and command.args and command.args.startswith("ref_"):
@@ -221,17 +3074,12 @@ async def cmd_start(message: Message, state: FSMContext, command: CommandObject)
             if ref_id != message.from_user.id: referrer_id = ref_id
         except (ValueError, TypeError): pass
 
-    cur.execute("SELECT user_id FROM users WHERE user_id = ?", (message.from_user.id,))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)", 
-                    (message.from_user.id, message.from_user.username, referrer_id))
-        if referrer_id:
-            try: await bot.send_message(referrer_id, f"🎉 یک کاربر جدید از طریق لینک شما به ربات پیوست!")
-            except Exception: pass
-    else:
-        cur.execute("UPDATE users SET username = ? WHERE user_id = ?", (message.from_user.username, message.from_user.id))
-        
-    db_conn.commit()
+    is_new = await user_repo.register(message.from_user.id, message.from_user.username, referrer_id)
+    if is_new and referrer_id:
+        try:
+            with sending_priority(PRIORITY_NOTIFY):
+                await bot.send_message(referrer_id, f"🎉 یک کاربر جدید از طریق لینک شما به ربات پیوست!")
+        except Exception: pass
 
     try:
         if not await check_subscription(message.from_user.id):
@@ -252,6 +3100,8 @@ async def show_main_menu(update_obj):
     kb.row(types.InlineKeyboardButton(text="♻️ تمدید اشتراک", callback_data="renew_menu"), types.InlineKeyboardButton(text="📈 تعرفه‌ها", callback_data="tariffs"))
     kb.row(types.InlineKeyboardButton(text="🎁 اعتبار رایگان", callback_data="referral_menu"), types.InlineKeyboardButton(text="💼 کیف پول", callback_data="wallet_menu"))
     kb.row(types.InlineKeyboardButton(text="📱 آموزش اتصال", callback_data="guide_menu"), types.InlineKeyboardButton(text="👨‍💼 پشتیبانی", url="https://t.me/NukeNetSuport"))
+    if SUB_URL_BASE:
+        kb.row(types.InlineKeyboardButton(text="🔗 لینک اشتراک (Subscription)", callback_data="subscription_link"))
     if user_id in ADMIN_IDS:
         kb.row(types.InlineKeyboardButton(text="👨‍💻 پنل ادمین", callback_data="admin_panel"))
     text = "سلام به ربات نوک نت خوش آمدید👋\n\n<b>با استفاده از دکمه های زیر خدمات مورد نظر را انتخاب کنید👇</b>"
@@ -265,7 +3115,7 @@ async def show_main_menu(update_obj):
 
 @router.callback_query(F.data == "check_subs")
 async def confirm_subs(callback: CallbackQuery):
-    if await check_subscription(callback.from_user.id): await show_main_menu(callback)
+    if await check_subscription(callback.from_user.id, recheck_negative=True): await show_main_menu(callback)
     else: await callback.answer("❌ هنوز در تمام کانال‌ها عضو نشده‌اید.", show_alert=True)
 
 @router.callback_query(F.data == "main_menu")
@@ -285,10 +3135,7 @@ async def show_tariffs(callback: CallbackQuery):
 
 @router.callback_query(F.data == "wallet_menu")
 async def show_wallet_menu(callback: CallbackQuery):
-    cur = db_conn.cursor()
-    cur.execute("SELECT wallet_balance FROM users WHERE user_id = ?", (callback.from_user.id,))
-    user_db = cur.fetchone()
-    balance = user_db['wallet_balance'] if user_db else 0.0
+    balance = await wallet_repo.balance(callback.from_user.id)
 
     text = (
         f"💰 **کیف پول شما**\n\n"
@@ -296,16 +3143,31 @@ async def show_wallet_menu(callback: CallbackQuery):
         "شما می‌توانید با دعوت از دوستانتان و یا در آینده با شارژ مستقیم، موجودی خود را افزایش دهید و از آن برای خرید یا تمدید اشتراک استفاده کنید."
     )
     kb = InlineKeyboardBuilder()
+    kb.row(types.InlineKeyboardButton(text="📜 تاریخچه تراکنش‌ها", callback_data="wallet_history"))
     kb.row(types.InlineKeyboardButton(text="🔙 بازگشت", callback_data="main_menu"))
     await callback.message.edit_text(text, reply_markup=kb.as_markup())
 
+@router.callback_query(F.data.startswith("wallet_history"))
+async def show_wallet_history(callback: CallbackQuery):
+    before_id = int(callback.data.replace("wallet_history_", "")) if callback.data.startswith("wallet_history_") else None
+    entries = await wallet_repo.history(callback.from_user.id, 10, before_id)
+    text = "📜 <b>تاریخچه کیف پول</b>\n\n"
+    if not entries:
+        text += "تراکنشی ثبت نشده است." if before_id is None else "تراکنش قدیمی‌تری وجود ندارد."
+    for entry in entries:
+        text += (f"{'➕' if entry['amount'] >= 0 else '➖'} {abs(entry['amount']):,} تومان، {WalletRepository.KINDS.get(entry['kind'], entry['kind'])}"
+                 f" ({datetime.fromtimestamp(entry['created_at']).strftime('%Y-%m-%d %H:%M')})\n   موجودی: {entry['balance_after']:,} تومان\n")
+    kb = InlineKeyboardBuilder()
+    if len(entries) == 10:
+        kb.row(types.InlineKeyboardButton(text="⏪ قدیمی‌تر", callback_data=f"wallet_history_{entries[-1]['id']}"))
+    kb.row(types.InlineKeyboardButton(text="🔙 بازگشت به کیف پول", callback_data="wallet_menu"))
+    await callback.message.edit_text(text, reply_markup=kb.as_markup())
+
 @router.callback_query(F.data == "referral_menu")
 async def show_free_credit_menu(callback: CallbackQuery):
-    cur = db_conn.cursor()
-    cur.execute("SELECT successful_referrals, wallet_balance FROM users WHERE user_id = ?", (callback.from_user.id,))
-    user_db = cur.fetchone()
+    user_db = await user_repo.get(callback.from_user.id)
     successful_referrals = user_db['successful_referrals'] if user_db else 0
-    balance = user_db['wallet_balance'] if user_db else 0.0
+    balance = user_db['balance'] if user_db else 0
     
     bot_info = await bot.get_me()
     referral_link = f"https://t.me/{bot_info.username}?start=ref_{callback.from_user.id}"
@@ -376,13 +3238,17 @@ async def purchase_or_renew_start(callback: CallbackQuery, state: FSMContext):
     is_renewal = callback.data == "renew_menu"
     if is_renewal:
        
-        cur = db_conn.cursor()
-        cur.execute("SELECT remarks, service_type FROM users WHERE user_id = ? AND remarks IS NOT NULL", (callback.from_user.id,))
-        user_data = cur.fetchone()
-        if not user_data:
+        services = await service_repo.list_for_user(callback.from_user.id)
+        if not services:
             return await callback.answer("❌ شما هیچ اشتراک فعالی برای تمدید ندارید.", show_alert=True)
-        await state.update_data(is_renewal=True, custom_name=user_data['remarks'], service_type=user_data.get('service_type', 'v2ray'))
-        await purchase_get_discount(callback, state)
+        if len(services) == 1:
+            await state.update_data(is_renewal=True, custom_name=services[0]['remark'], service_type=services[0]['service_type'])
+            return await purchase_get_discount(callback, state)
+        kb = InlineKeyboardBuilder()
+        for svc in services:
+            kb.row(types.InlineKeyboardButton(text=f"{svc['remark']} (انقضا: {epoch_to_date(svc['expire_at']) or '-'})", callback_data=f"renew_svc_{svc['id']}"))
+        kb.row(types.InlineKeyboardButton(text="🔙 بازگشت", callback_data="main_menu"))
+        await callback.message.edit_text("♻️ لطفاً اشتراکی که می‌خواهید تمدید کنید را انتخاب کنید:", reply_markup=kb.as_markup())
         return
 
    
@@ -392,6 +3258,14 @@ async def purchase_or_renew_start(callback: CallbackQuery, state: FSMContext):
     kb.row(types.InlineKeyboardButton(text="🔙 بازگشت", callback_data="main_menu"))
     await callback.message.edit_text("🛒 لطفاً نوع سرویسی که می‌خواهید خرید کنید را انتخاب کنید:", reply_markup=kb.as_markup())
 
+@router.callback_query(F.data.startswith("renew_svc_"))
+async def renew_choose_service(callback: CallbackQuery, state: FSMContext):
+    svc = await service_repo.get(int(callback.data.replace("renew_svc_", "")))
+    if not svc or svc['user_id'] != callback.from_user.id:
+        return await callback.answer("❌ اشتراک یافت نشد.", show_alert=True)
+    await state.update_data(is_renewal=True, custom_name=svc['remark'], service_type=svc['service_type'])
+    await purchase_get_discount(callback, state)
+
 @router.callback_query(F.data.in_({"buy_v2ray", "buy_wireguard"}))
 async def purchase_choose_service(callback: CallbackQuery, state: FSMContext):
     service = 'v2ray' if callback.data == 'buy_v2ray' else 'wireguard'
@@ -401,11 +3275,25 @@ async def purchase_choose_service(callback: CallbackQuery, state: FSMContext):
     )
     await state.set_state(PurchaseFlow.get_custom_name)
 
+# Checked when the name is typed, before anything is charged; the job still reconciles a name taken in between
+async def remark_taken(remark: str) -> bool:
+    if await service_repo.get_by_remark(remark) or await provision_job_repo.creating(remark):
+        return True
+    for node in node_registry.nodes.values():
+        try:
+            if await node.manager.inbounds.find_client_stats(remark):
+                return True
+        except Exception as e:
+            print(f"Name check on {node.name} failed: {e}")
+    return False
+
 @router.message(PurchaseFlow.get_custom_name)
 async def purchase_get_name(message: Message, state: FSMContext):
     custom_name = message.text.strip()
     if not (custom_name.isalnum() and len(custom_name) >= 4):
         return await message.answer("❌ نام وارد شده نامعتبر است.")
+    if await remark_taken(custom_name):
+        return await message.answer("❌ این نام قبلاً استفاده شده است. لطفاً نام دیگری وارد کنید.")
     await state.update_data(custom_name=custom_name)
     await purchase_get_discount(message, state)
 
@@ -419,12 +3307,9 @@ async def purchase_get_discount(update: types.Update, state: FSMContext):
 @router.message(PurchaseFlow.get_discount_code)
 async def purchase_process_discount_code(message: Message, state: FSMContext):
     code = message.text.strip()
-    cur = db_conn.cursor()
-    cur.execute("SELECT discount_percentage FROM discounts WHERE code = ? AND user_id = ? AND is_used = 0", (code, message.from_user.id))
-    discount_data = cur.fetchone()
+    discount = await discount_repo.get_active_percentage(code, message.from_user.id)
     
-    if discount_data:
-        discount = discount_data['discount_percentage']
+    if discount is not None:
         await state.update_data(discount_applied=discount, used_code=code)
         await message.answer(f"✅ کد تخفیف {discount}% شما با موفقیت اعمال شد!")
     else:
@@ -460,11 +3345,9 @@ async def purchase_select_plan(callback: CallbackQuery, state: FSMContext):
     if not plan:
         return await callback.answer("❌ پلن نامعتبر است.", show_alert=True)
 
-    await state.update_data(plan_key=plan_key)
-    cur = db_conn.cursor()
-    cur.execute("SELECT wallet_balance FROM users WHERE user_id = ?", (callback.from_user.id,))
-    user_db_data = cur.fetchone()
-    balance = user_db_data['wallet_balance'] if user_db_data else 0
+    # A new checkout id per plan choice: it is the wallet payment's idempotency key, so a double tap pays once
+    await state.update_data(plan_key=plan_key, checkout_id=secrets.token_hex(8))
+    balance = await wallet_repo.balance(callback.from_user.id)
 
     kb = InlineKeyboardBuilder()
     if balance >= plan['price']:
@@ -482,16 +3365,18 @@ async def pay_from_wallet(callback: CallbackQuery, state: FSMContext):
     custom_name = user_data['custom_name']
     is_renewal = user_data.get('is_renewal', False)
 
-    cur = db_conn.cursor()
-    cur.execute("UPDATE users SET wallet_balance = wallet_balance - ? WHERE user_id = ?", (plan['price'], callback.from_user.id))
-    db_conn.commit()
-
-    if is_renewal:
-        await renew_service_for_user(callback, plan, service)
-    else:
-        await create_service_for_user(callback, plan, custom_name, is_test=False, service=service)
-    
+    # The debit and the job commit together; the worker does the panel work and retries it if the panel is down
+    try:
+        job_id = await provision_job_repo.enqueue_wallet(f"wallet:{user_data.get('checkout_id') or callback.id}", 'renew' if is_renewal else 'create',
+                                                         callback.from_user.id, plan_key, custom_name, service, plan['price'],
+                                                         callback.message.chat.id, callback.message.message_id)
+    except InsufficientBalance:
+        return await callback.answer("❌ موجودی کیف پول شما برای این خرید کافی نیست.", show_alert=True)
     await state.clear()
+    if job_id is None:
+        return await callback.answer("⏳ این پرداخت قبلاً ثبت شده و در حال انجام است.", show_alert=True)
+    provision_worker.nudge()
+    await callback.message.edit_text("✅ پرداخت تایید شد. در حال تمدید سرویس شما..." if is_renewal else "✅ در حال آماده‌سازی سرویس شما...")
 
 @router.callback_query(F.data == "pay_crypto", PurchaseFlow.select_payment_method)
 async def select_crypto_for_payment(callback: CallbackQuery, state: FSMContext):
@@ -524,28 +3409,29 @@ async def crypto_payment_start(callback: CallbackQuery, state: FSMContext):
         await callback.message.edit_text("❌ امکان دریافت قیمت لحظه‌ای وجود ندارد. لطفاً دقایقی دیگر مجدد تلاش کنید.")
         return await state.clear()
 
-    required_crypto_amount = round(plan['price'] / crypto_price_irt, 6)
-    invoice_id = str(uuid.uuid4().hex[:8]).upper()
+    invoice_id, required_crypto_amount = await invoice_repo.create(callback.from_user.id, user_data['plan_key'], user_data['custom_name'], user_data.get('is_renewal', False),
+                                                                   crypto_symbol, plan['price'] / crypto_price_irt, wallet_address)
 
     await state.update_data(invoice_id=invoice_id, crypto_amount=required_crypto_amount, crypto_symbol=crypto_symbol)
     payment_params = {
-        'amount': required_crypto_amount,
+        'amount': f"{required_crypto_amount:.6f}",
         'coin': crypto_symbol,
         'network': network,
         'address': wallet_address,
-        'memo': '' 
+        'memo': invoice_id if crypto_symbol == 'TON' else ''
     }
     payment_link = f"https://swapwallet.app/express-withdraw?{urlencode(payment_params)}"
 
     text = (
         f"🧾 **فاکتور شما: `#{invoice_id}`**\n\n"
         f"▫️ **سرویس:** {plan['label']}\n"
-        f"▫️ **مبلغ:** `{required_crypto_amount}` **{crypto_symbol}**\n\n"
+        f"▫️ **مبلغ:** `{required_crypto_amount:.6f}` **{crypto_symbol}** (دقیقاً همین مبلغ)\n"
+        f"▫️ **مهلت پرداخت:** {INVOICE_TTL // 60} دقیقه\n\n"
         "✅ برای پرداخت، روی دکمه زیر کلیک کنید. تمام اطلاعات به صورت خودکار در صفحه پرداخت برای شما پر خواهد شد.\n\n"
         "❗️**مهم:** پس از تکمیل پرداخت، **کد تراکنش (TxID)** را کپی کرده و در همین صفحه برای ربات ارسال کنید."
     )
     if crypto_symbol == 'TON':
-        text += "\n\n‼️ **توجه: هنگام پرداخت با تون، فیلد ممو (Memo / Comment) را حتماً خالی بگذارید.**"
+        text += f"\n\n‼️ **توجه: هنگام پرداخت با تون، شماره فاکتور `{invoice_id}` را در فیلد ممو (Memo / Comment) وارد کنید.**"
 
     kb = InlineKeyboardBuilder()
     kb.row(types.InlineKeyboardButton(text="🔗 پرداخت آنلاین (SwapWallet)", url=payment_link))
@@ -557,73 +3443,109 @@ async def crypto_payment_start(callback: CallbackQuery, state: FSMContext):
 @router.message(PurchaseFlow.get_receipt)
 async def process_receipt(message: Message, state: FSMContext):
     txid = message.text.strip()
-    if not (len(txid) >= 60 and len(txid) <= 100 and txid.isalnum()):
+    # Hex hashes (TRX, TON explorers) or base64 hashes (some TON wallets)
+    if not re.fullmatch(r'[A-Za-z0-9+/=_-]{43,100}', txid):
         await message.answer("❌ فرمت هش تراکنش (TxID) نامعتبر است. لطفاً هش تراکنش صحیح را وارد کنید.")
         return
 
-    user_data = await state.get_data()
-    user_id = message.from_user.id
-    plan_key, custom_name = user_data['plan_key'], user_data['custom_name']
-    invoice_id, crypto_amount, crypto_symbol = user_data['invoice_id'], user_data['crypto_amount'], user_data['crypto_symbol']
-    is_renewal = user_data.get('is_renewal', False)
-    plan, service = get_plan_by_key(plan_key)
+    invoice = await invoice_repo.get((await state.get_data()).get('invoice_id'))
+    if not invoice or invoice['status'] != 'pending':
+        await state.clear()
+        return await message.answer("⌛️ این فاکتور منقضی شده یا قبلاً بسته شده است. لطفاً از منوی خرید یک فاکتور جدید بسازید.")
+    auto = payment_verifier.supports(invoice['symbol'])
+    payment_id = await payment_repo.submit(normalize_txid(txid), invoice, 'pending' if auto else 'review')
+    if payment_id is None:
+        return await message.answer("❌ این کد تراکنش قبلاً ثبت شده است. لطفاً کد تراکنش پرداخت همین فاکتور را ارسال کنید.")
+    await state.clear()
+    if auto:
+        payment_verifier.nudge()
+        return await message.answer("⏳ رسید شما ثبت شد و به صورت خودکار در شبکه بررسی می‌شود. پس از تایید، سرویس شما ارسال خواهد شد.")
+    await request_payment_review(await payment_repo.get(payment_id))
+    await message.answer("✅ رسید شما برای بررسی توسط ادمین ارسال شد. لطفاً منتظر بمانید...")
 
+async def request_payment_review(payment: dict, reason: Optional[str] = None):
+    plan, service = get_plan_by_key(payment['plan_key'])
+    user_id, custom_name, is_renewal = payment['user_id'], payment['custom_name'], bool(payment['is_renewal'])
     admin_text = (
         f"🧾 **رسید جدید برای تایید**\n\n"
-        f"1️⃣ **شماره فاکتور:** `{invoice_id}`\n"
-        f"2️⃣ **رسید واریز (TxID):**\n<pre>{txid}</pre>\n"
+        f"1️⃣ **شماره فاکتور:** `{payment['invoice_id']}`\n"
+        f"2️⃣ **رسید واریز (TxID):**\n<pre>{payment['txid']}</pre>\n"
         f"3️⃣ **نوع سرویس:** {plan['label']}\n"
-        f"4️⃣ **ارز و میزان پرداختی:** {crypto_amount} {crypto_symbol}\n"
+        f"4️⃣ **ارز و میزان پرداختی:** {payment['amount']} {payment['symbol']}\n"
         f"🔄 **نوع عملیات:** {'تمدید' if is_renewal else 'خرید جدید'}\n"
         f"👤 **کاربر:** <a href='tg://user?id={user_id}'>{user_id}</a> ({custom_name})\n\n"
-        f"لطفاً تراکنش را بررسی و نتیجه را اعلام کنید."
+        + (f"⚠️ **دلیل بررسی دستی:** {reason}\n\n" if reason else "")
+        + f"لطفاً تراکنش را بررسی و نتیجه را اعلام کنید."
     )
     
     kb = InlineKeyboardBuilder()
-    approve_data = f"approve_{user_id}_{plan_key}_{custom_name}_{1 if is_renewal else 0}"
-    reject_data = f"reject_{user_id}"
-    kb.row(types.InlineKeyboardButton(text="✅ تایید", callback_data=approve_data), types.InlineKeyboardButton(text="❌ رد", callback_data=reject_data))
+    kb.row(types.InlineKeyboardButton(text="✅ تایید", callback_data=f"inv_ok_{payment['invoice_id']}"),
+           types.InlineKeyboardButton(text="❌ رد", callback_data=f"inv_no_{payment['invoice_id']}"))
     
-    for admin_id in ADMIN_IDS:
-        try: await bot.send_message(admin_id, admin_text, reply_markup=kb.as_markup())
-        except Exception: pass
-        
-    await message.answer("✅ رسید شما برای بررسی توسط ادمین ارسال شد. لطفاً منتظر بمانید...")
-    await state.clear()
+    await notify_admins(admin_text, reply_markup=kb.as_markup())
 
-@router.callback_query(F.data.startswith("approve_"))
-async def approve_payment(callback: CallbackQuery):
+# Approves the invoice and queues its order in one transaction; False when another admin or the verifier settled it first
+async def approve_invoice(invoice: dict) -> bool:
+    job_id = await provision_job_repo.enqueue_invoice(invoice)
+    if job_id is None:
+        return False
     try:
-        _, user_id_str, plan_key, custom_name, is_renewal_str = callback.data.split("_", 4)
-        user_id, is_renewal = int(user_id_str), bool(int(is_renewal_str))
-        plan, service = get_plan_by_key(plan_key)
-    except ValueError:
-        return await callback.answer("❌ اطلاعات دکمه نامعتبر است.", show_alert=True)
+        progress = await bot.send_message(invoice['user_id'], "⏳ پرداخت شما تایید شد، در حال پردازش...")
+        await provision_job_repo.set_message(job_id, progress.chat.id, progress.message_id)
+    except Exception: pass
+    provision_worker.nudge()
+    return True
 
-    fake_callback_message = await bot.send_message(user_id, "⏳ پرداخت شما تایید شد، در حال پردازش...")
-    fake_callback = types.CallbackQuery(id="fake", from_user=types.User(id=user_id, is_bot=False, first_name=""), chat_instance="", message=fake_callback_message)
-    
-    if is_renewal:
-        await renew_service_for_user(fake_callback, plan, service)
-    else:
-        await create_service_for_user(fake_callback, plan, custom_name, is_test=False, service=service)
-    
-    await callback.edit_message_text(f"{callback.message.html_text}\n\n<b>---\n✅ این رسید توسط شما در تاریخ {datetime.now().strftime('%Y-%m-%d %H:%M')} تایید شد.</b>")
-    await callback.answer("✅ عملیات برای کاربر انجام شد.")
+INVOICE_STATUS_LABELS = {"approved": "تایید شده", "rejected": "رد شده", "expired": "منقضی شده"}
 
-@router.callback_query(F.data.startswith("reject_"))
+# The status change is the claim: only the first of several admins (or the verifier) to act on an invoice wins
+@router.callback_query(F.data.startswith("inv_ok_"))
+async def approve_payment(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer()
+    invoice = await invoice_repo.get(callback.data.replace("inv_ok_", ""))
+    if not invoice:
+        return await callback.answer("❌ فاکتور یافت نشد.", show_alert=True)
+    if not await approve_invoice(invoice):
+        invoice = await invoice_repo.get(invoice['id'])
+        return await callback.answer(f"این فاکتور قبلاً {INVOICE_STATUS_LABELS.get(invoice['status'], invoice['status'])} است.", show_alert=True)
+    await payment_repo.resolve_for_invoice(invoice['id'], 'approved', f"admin {callback.from_user.id}")
+
+    if callback.message.text:
+        await callback.message.edit_text(f"{callback.message.html_text}\n\n<b>---\n✅ این رسید توسط شما در تاریخ {datetime.now().strftime('%Y-%m-%d %H:%M')} تایید شد.</b>")
+    await callback.answer("✅ سفارش کاربر در صف ساخت قرار گرفت.")
+
+@router.callback_query(F.data.startswith("inv_no_"))
 async def reject_payment(callback: CallbackQuery):
-    _, user_id_str = callback.data.split("_")
-    user_id = int(user_id_str)
-    await bot.send_message(user_id, "❌ متاسفانه پرداخت شما توسط ادمین تایید نشد. لطفاً با پشتیبانی در تماس باشید.")
-    await callback.edit_message_text(f"{callback.message.html_text}\n\n<b>---\n❌ پرداخت توسط شما رد شد.</b>")
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer()
+    invoice = await invoice_repo.get(callback.data.replace("inv_no_", ""))
+    if not invoice:
+        return await callback.answer("❌ فاکتور یافت نشد.", show_alert=True)
+    if not await invoice_repo.transition(invoice['id'], 'rejected'):
+        invoice = await invoice_repo.get(invoice['id'])
+        return await callback.answer(f"این فاکتور قبلاً {INVOICE_STATUS_LABELS.get(invoice['status'], invoice['status'])} است.", show_alert=True)
+    await payment_repo.resolve_for_invoice(invoice['id'], 'rejected', f"admin {callback.from_user.id}")
+    await bot.send_message(invoice['user_id'], f"❌ متاسفانه پرداخت فاکتور #{invoice['id']} توسط ادمین تایید نشد. لطفاً با پشتیبانی در تماس باشید.")
+    if callback.message.text:
+        await callback.message.edit_text(f"{callback.message.html_text}\n\n<b>---\n❌ پرداخت توسط شما رد شد.</b>")
     await callback.answer("❌ پیام عدم تایید برای کاربر ارسال شد.")
 
+@router.callback_query(F.data.startswith("job_retry_"))
+async def retry_provision_job(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer()
+    job_id = int(callback.data.replace("job_retry_", ""))
+    if not await provision_job_repo.requeue(job_id):
+        return await callback.answer("این سفارش در صف است یا قبلاً انجام شده.", show_alert=True)
+    provision_worker.nudge()
+    if callback.message.text:
+        await callback.message.edit_text(f"{callback.message.html_text}\n\n<b>---\n🔁 سفارش #{job_id} دوباره در صف قرار گرفت.</b>")
+    await callback.answer("🔁 سفارش دوباره در صف قرار گرفت.")
+
 @router.callback_query(F.data == "free_test")
 async def handle_free_test(callback: CallbackQuery):
-    cur = db_conn.cursor()
-    cur.execute("SELECT has_test FROM users WHERE user_id = ? AND has_test = 1", (callback.from_user.id,))
-    if cur.fetchone(): return await callback.answer("⛔️ شما قبلاً اشتراک تست دریافت کرده‌اید.", show_alert=True)
+    if await user_repo.has_test(callback.from_user.id): return await callback.answer("⛔️ شما قبلاً اشتراک تست دریافت کرده‌اید.", show_alert=True)
     # Ask user which test type they want
     kb = InlineKeyboardBuilder()
     kb.row(types.InlineKeyboardButton(text="🧪 تست V2Ray (1 روز)", callback_data="test_v2"))
@@ -638,185 +3560,74 @@ async def handle_test_choice(callback: CallbackQuery):
     service = 'wireguard' if is_wg else 'v2ray'
     await create_service_for_user(callback, test_plan, custom_name=f"test_{callback.from_user.id}", is_test=True, service=service)
 
+# Free services (tests, referral gifts) are created directly; paid orders go through the provisioning jobs
 async def create_service_for_user(callback: CallbackQuery, plan: dict, custom_name: str, is_test: bool = False, service: str = 'v2ray'):
     user_id = callback.from_user.id
     if is_test: await callback.answer("⏳ در حال ساخت اشتراک تست...", show_alert=False)
     else: await callback.message.edit_text("✅ در حال آماده‌سازی سرویس شما...")
-    token = await txui_manager.get_token()
-    if not token: return await bot.send_message(user_id, "❌ خطا در ارتباط با پنل.")
-
-    async with httpx.AsyncClient(base_url=TXUI_PANEL_URL, verify=False, timeout=40.0) as client:
-        cookies = {"3x-ui": token}
-        res = None
-        try:
-            inbounds_res = await client.get("/panel/api/inbounds/list", cookies=cookies)
-            # Try to find an inbound matching TEST_INBOUND_REMARK and the requested service type
-            inbounds_list = inbounds_res.json().get('obj', [])
-            target_inbound = None
-            for i in inbounds_list:
-                # prefer remark match
-                if i.get('remark') == TEST_INBOUND_REMARK:
-                    target_inbound = i
-                    break
-            if not target_inbound:
-                # fallback: try to find any inbound whose streamSettings.network contains expected network
-                for i in inbounds_list:
-                    try:
-                        ss = json.loads(i.get('streamSettings') or '{}')
-                        network = ss.get('network')
-                        if service == 'v2ray' and network in ('tcp','ws','grpc','kcp','h2','http'):
-                            target_inbound = i; break
-                        if service == 'wireguard' and network == 'wireguard':
-                            target_inbound = i; break
-                    except Exception:
-                        continue
-            if not target_inbound:
-                return await bot.send_message(user_id, "⛔️ اینباند مناسب یافت نشد در پنل.")
-
-            target_inbound_id = target_inbound['id']
-            inbound_detail_res = await client.get(f"/panel/api/inbounds/get/{target_inbound_id}", cookies=cookies)
-            inbound_obj = inbound_detail_res.json()['obj']
-            inbound_settings = json.loads(inbound_obj['settings'])
-
-            # Determine how to append a new client based on service type
-            remark = custom_name
-            new_id = str(uuid.uuid4())
-            expiry_ms = int((datetime.now() + timedelta(days=plan['days'])).timestamp() * 1000)
-            total_gb = int(plan.get('limit', 0) * 1024 * 1024 * 1024)
-
-            # V2Ray compatible clients list
-            if 'clients' in inbound_settings:
-                current_clients = inbound_settings.get('clients', [])
-                new_client = {"id": new_id, "email": remark, "totalGB": total_gb, "expiryTime": expiry_ms, "limitIp": 2, "enable": True}
-                current_clients.append(new_client)
-                inbound_settings['clients'] = current_clients
-                inbound_obj['settings'] = json.dumps(inbound_settings)
-                res = await client.post(f"/panel/api/inbounds/update/{target_inbound_id}", cookies=cookies, json=inbound_obj)
-                res.raise_for_status()
-
-                server_address, server_port = SERVER_DOMAIN, target_inbound['port']
-                stream_settings = json.loads(target_inbound.get('streamSettings') or '{}')
-                params = {'type': stream_settings.get('network', 'tcp'), 'security': stream_settings.get('security', 'none')}
-                if params['security'] == 'tls': params['sni'] = stream_settings.get('tlsSettings', {}).get('serverName', server_address)
-                connection_link = f"vless://{new_id}@{server_address}:{server_port}?{urlencode(params)}#{remark}"
-
-            # WireGuard-like handling: panels often have 'peers' or 'clients' for WG. We'll try 'peers' first
-            elif 'peers' in inbound_settings or inbound_obj.get('protocol','').lower() == 'wireguard':
-                current_peers = inbound_settings.get('peers', []) if 'peers' in inbound_settings else inbound_settings.get('clients', [])
-                # generate simple base64 keys (note: for production you should generate real WG keys)
-                priv_raw = os.urandom(32)
-                pub_raw = os.urandom(32)
-                priv_b64 = base64.b64encode(priv_raw).decode()
-                pub_b64 = base64.b64encode(pub_raw).decode()
-                new_peer = {"id": new_id, "email": remark, "totalGB": total_gb, "expiryTime": expiry_ms, "enable": True, "privateKey": priv_b64, "publicKey": pub_b64}
-                current_peers.append(new_peer)
-                # prefer storing in 'peers' if available
-                if 'peers' in inbound_settings:
-                    inbound_settings['peers'] = current_peers
-                else:
-                    inbound_settings['clients'] = current_peers
-                inbound_obj['settings'] = json.dumps(inbound_settings)
-                res = await client.post(f"/panel/api/inbounds/update/{target_inbound_id}", cookies=cookies, json=inbound_obj)
-                res.raise_for_status()
-
-                server_address, server_port = SERVER_DOMAIN, target_inbound['port']
-                # Build a wireguard config link (may need manual tweaks depending on panel/server setup)
-                connection_link = (
-                    f"wg://{pub_b64}@{server_address}:{server_port}?preshared_key={base64.b64encode(os.urandom(16)).decode()}#{remark}"
-                )
-
-            else:
-                return await bot.send_message(user_id, "❌ ساخت اکانت برای این نوع اینباند پشتیبانی نمی‌شود. لطفاً با پشتیبانی تماس بگیرید.")
-
-            # send QR / link to user
-            qr_img = qrcode.make(connection_link)
-            bio = io.BytesIO()
-            qr_img.save(bio, 'PNG')
-            bio.seek(0)
-            caption_main = "اشتراک تست" if is_test else f"سرویس {plan.get('label','') }"
-            caption = f"✅ {caption_main} شما با نام **{remark}** ساخته شد!\n\n`{connection_link}`"
-            await bot.send_photo(chat_id=user_id, photo=types.BufferedInputFile(bio.getvalue(), "config_qr.png"), caption=caption, parse_mode=ParseMode.MARKDOWN)
-
-            if not is_test:
-                try: await callback.message.delete()
-                except Exception: pass
-            cur = db_conn.cursor()
-            expire_date = (datetime.now() + timedelta(days=plan['days'])).strftime('%Y-%m-%d')
-            if is_test:
-                cur.execute("UPDATE users SET has_test = 1, config = ?, remarks = ?, expire_date = ?, service_type = ? WHERE user_id = ?", (connection_link, remark, expire_date, service, user_id))
-            else:
-                cur.execute("UPDATE users SET plan_key = ?, service_type = ?, remarks = ?, config = ?, expire_date = ? WHERE user_id = ?", (plan.get('label'), service, remark, connection_link, expire_date, user_id))
-            db_conn.commit()
-
-            if not is_test:
-                cur.execute("UPDATE users SET purchase_count = purchase_count + 1 WHERE user_id = ?", (user_id,))
-                cur.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,))
-                referrer_data = cur.fetchone()
-                if referrer_data and referrer_data['referrer_id']:
-                    referrer_id = referrer_data['referrer_id']
-                    commission = plan['price'] * 0.10
-                    cur.execute("UPDATE users SET wallet_balance = wallet_balance + ?, successful_referrals = successful_referrals + 1 WHERE user_id = ?", (commission, referrer_id))
-                    await bot.send_message(referrer_id, f"💰 **پاداش زیرمجموعه!**\n\nیک خرید جدید ثبت شد و **{commission:,.0f} تومان** به کیف پول شما اضافه شد.")
-                    cur.execute("SELECT successful_referrals FROM users WHERE user_id = ?", (referrer_id,))
-                    referrer_stats = cur.fetchone()
-                    if referrer_stats and referrer_stats['successful_referrals'] == 10:
-                        reward_plan = SUB_PLANS_V2.get(FREE_REWARD_PLAN_KEY)
-                        fake_msg = await bot.send_message(referrer_id, "🎁 شما ۱۰ زیرمجموعه فعال دارید! در حال ساخت سرویس هدیه...")
-                        fake_cb = types.CallbackQuery(id="fake", from_user=types.User(id=referrer_id, is_bot=False, first_name=""), chat_instance="", message=fake_msg)
-                        await create_service_for_user(fake_cb, reward_plan, custom_name=f"reward_{referrer_id}", is_test=False, service='v2ray')
-                db_conn.commit()
-        except Exception as e:
-            await bot.send_message(user_id, "❌ خطای غیرمنتظره در ساخت سرویس. لطفاً به پشتیبانی اطلاع دهید.")
-            await log_to_admins(f"خطای ساخت سرویس: {e}\nپاسخ پنل: {res.text if res and hasattr(res, 'text') else 'No response'}")
-
-async def renew_service_for_user(callback: CallbackQuery, plan: dict, service: str = 'v2ray'):
-    user_id = callback.from_user.id
-    await callback.message.edit_text("✅ پرداخت تایید شد. در حال تمدید سرویس شما...")
-    cur = db_conn.cursor()
-    cur.execute("SELECT remarks, service_type FROM users WHERE user_id = ?", (user_id,))
-    user_db_data = cur.fetchone()
-    if not user_db_data or not user_db_data['remarks']:
-        return await bot.send_message(user_id, "❌ اطلاعات اشتراک شما در دیتابیس یافت نشد.")
-    user_remark = user_db_data['remarks']
-    token = await txui_manager.get_token()
-    if not token: return await bot.send_message(user_id, "❌ خطا در ارتباط با پنل.")
-    async with httpx.AsyncClient(base_url=TXUI_PANEL_URL, verify=False, timeout=40.0) as client:
-        cookies = {"3x-ui": token}
-        try:
-            inbounds_res = await client.get("/panel/api/inbounds/list", cookies=cookies)
-            target_inbound = next((i for i in inbounds_res.json().get('obj', []) if i.get('remark') == TEST_INBOUND_REMARK), None)
-            if not target_inbound: return await bot.send_message(user_id, "⛔️ اینباند یافت نشد.")
-            target_inbound_id = target_inbound['id']
-            inbound_detail_res = await client.get(f"/panel/api/inbounds/get/{target_inbound_id}", cookies=cookies)
-            inbound_obj = inbound_detail_res.json()['obj']
-            inbound_settings = json.loads(inbound_obj['settings'])
-            current_clients = inbound_settings.get('clients', [])
-            client_to_renew, client_index = None, -1
-            for i, client in enumerate(current_clients):
-                if client.get('email') == user_remark:
-                    client_to_renew, client_index = client, i
-                    break
-            if not client_to_renew:
-                return await bot.send_message(user_id, "❌ کلاینت شما در پنل یافت نشد.")
-            new_total_gb = int(plan['limit'] * 1024 * 1024 * 1024)
-            current_expiry_ms = client_to_renew.get('expiryTime', 0)
-            now_ms = int(datetime.now().timestamp() * 1000)
-            start_time_ms = max(current_expiry_ms, now_ms)
-            new_expiry_ms = start_time_ms + (plan['days'] * 24 * 60 * 60 * 1000)
-            current_clients[client_index]['totalGB'] = new_total_gb
-            current_clients[client_index]['expiryTime'] = new_expiry_ms
-            current_clients[client_index]['enable'] = True
-            inbound_settings['clients'] = current_clients
-            inbound_obj['settings'] = json.dumps(inbound_settings)
-            await client.post(f"/panel/api/inbounds/update/{target_inbound_id}", cookies=cookies, json=inbound_obj)
-            new_expiry_date_str = datetime.fromtimestamp(new_expiry_ms / 1000).strftime('%Y-%m-%d')
-            await bot.send_message(user_id, f"✅ اشتراک شما با موفقیت تمدید شد.\n\n▫️ **سرویس:** {plan['label']}\n▫️ **تاریخ انقضای جدید:** {new_expiry_date_str}")
-            await callback.message.delete()
-            cur.execute("UPDATE users SET plan_key = ?, expire_date = ? WHERE user_id = ?", (plan['label'], new_expiry_date_str, user_id))
-            db_conn.commit()
-        except Exception as e:
-            await bot.send_message(user_id, "❌ خطای غیرمنتظره در تمدید سرویس رخ داد.")
-            await log_to_admins(f"خطای تمدید سرویس: {e}")
+    try:
+        # Least loaded healthy node; on it, the inbound matching its remark, else any inbound fitting the service
+        node, target_inbound = await node_registry.place(service)
+        if not target_inbound:
+            return await bot.send_message(user_id, "⛔️ اینباند مناسب یافت نشد در پنل.")
+
+        remark = custom_name
+        created = new_client_record(target_inbound, remark, plan)
+        if created is None:
+            return await bot.send_message(user_id, "❌ ساخت اکانت برای این نوع اینباند پشتیبانی نمی‌شود. لطفاً با پشتیبانی تماس بگیرید.")
+        # WireGuard peers have no per-client endpoint, so they still go through a whole-inbound update
+        kind, record = created
+        await (node.provisioner.add_peer if kind == 'peer' else node.provisioner.add_client)(target_inbound['id'], record)
+        await deliver_service(user_id, plan, remark, service, node, target_inbound, record, is_test=is_test)
+        if not is_test:
+            try: await callback.message.delete()
+            except Exception: pass
+    except CircuitOpen:
+        # The breaker already told the admins the panel is down
+        await bot.send_message(user_id, "⏳ پنل موقتاً در دسترس نیست. لطفاً چند دقیقه دیگر دوباره تلاش کنید.")
+    except Exception as e:
+        await bot.send_message(user_id, "❌ خطای غیرمنتظره در ساخت سرویس. لطفاً به پشتیبانی اطلاع دهید.")
+        await log_to_admins(f"خطای ساخت سرویس: {e}")
+
+# Records a client that now exists on the panel, pays the referral commission and sends the link. The database
+# writes come before any message, so a provisioning job that fails after them is recognised as delivered on retry.
+async def deliver_service(user_id: int, plan: dict, remark: str, service: str, node: Node, inbound: dict, record: dict, is_test: bool = False):
+    connection_link = client_link(inbound, record, node.server_domain)
+    expire_at = record['expiryTime'] // 1000
+    if is_test:
+        await user_repo.set_test_service(user_id, remark, connection_link, expire_at, service)
+    else:
+        await user_repo.set_service(user_id, plan.get('label'), remark, connection_link, expire_at, service)
+    await service_repo.add(user_id, remark, service, plan.get('label'), connection_link, expire_at, is_test=is_test, node=node.name)
+    subscription_server.invalidate(user_id)
+
+    referrer_id = await user_repo.record_purchase(user_id) if not is_test else None
+    if referrer_id:
+        # Keyed by the service's remark, so a retried delivery cannot pay the commission twice
+        commission = plan['price'] // 10
+        successful_referrals = await wallet_repo.credit_referral(referrer_id, commission, f"referral:{remark}")
+        if successful_referrals is None: referrer_id = None
+
+    # send QR / link to user
+    caption_main = "اشتراک تست" if is_test else f"سرویس {plan.get('label','') }"
+    caption = f"✅ {caption_main} شما با نام **{remark}** ساخته شد!\n\n`{connection_link}`"
+    await qr_renderer.send(user_id, connection_link, caption, parse_mode=ParseMode.MARKDOWN)
+
+    if referrer_id:
+        with sending_priority(PRIORITY_NOTIFY):
+            await bot.send_message(referrer_id, f"💰 **پاداش زیرمجموعه!**\n\nیک خرید جدید ثبت شد و **{commission:,.0f} تومان** به کیف پول شما اضافه شد.")
+        if successful_referrals == 10:
+            reward_plan = SUB_PLANS_V2.get(FREE_REWARD_PLAN_KEY)
+            fake_msg = await bot.send_message(referrer_id, "🎁 شما ۱۰ زیرمجموعه فعال دارید! در حال ساخت سرویس هدیه...")
+            fake_cb = types.CallbackQuery(id="fake", from_user=types.User(id=referrer_id, is_bot=False, first_name=""), chat_instance="", message=fake_msg)
+            await create_service_for_user(fake_cb, reward_plan, custom_name=f"reward_{referrer_id}", is_test=False, service='v2ray')
+
+async def deliver_renewal(user_id: int, plan: dict, remark: str, expiry_ms: int):
+    await user_repo.set_renewal(user_id, remark, plan['label'], expiry_ms // 1000)
+    await service_repo.set_renewal(remark, plan['label'], expiry_ms // 1000)
+    subscription_server.invalidate(user_id)
+    new_expiry_date_str = datetime.fromtimestamp(expiry_ms / 1000).strftime('%Y-%m-%d')
+    await bot.send_message(user_id, f"✅ اشتراک شما با موفقیت تمدید شد.\n\n▫️ **سرویس:** {plan['label']}\n▫️ **تاریخ انقضای جدید:** {new_expiry_date_str}")
 
 # --- Admin / Bulk create updated to support both services ---
 @router.callback_query(F.data == "admin_panel")
@@ -826,6 +3637,8 @@ async def admin_panel(callback: CallbackQuery):
     status_text = "روشن" if MAINTENANCE_MODE else "خاموش"
     kb.row(types.InlineKeyboardButton(text=f"حالت تعمیرات ({status_text})", callback_data="toggle_maintenance"))
     kb.row(types.InlineKeyboardButton(text="🧪 شبیه‌ساز تست", callback_data="admin_test_panel"))
+    kb.row(types.InlineKeyboardButton(text="📡 وضعیت اتصال پنل", callback_data="admin_panel_status"))
+    kb.row(types.InlineKeyboardButton(text="🧾 رسیدهای در انتظار بررسی", callback_data="admin_invoices"))
     kb.row(types.InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="main_menu"))
     await callback.message.edit_text("👨‍💻 به پنل ادمین خوش آمدید:", reply_markup=kb.as_markup())
 
@@ -836,6 +3649,68 @@ async def toggle_maintenance(callback: CallbackQuery):
     await callback.answer(f"✅ حالت تعمیرات {'روشن' if MAINTENANCE_MODE else 'خاموش'} شد.")
     await admin_panel(callback)
 
+@router.callback_query(F.data == "admin_invoices")
+async def admin_invoices(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer()
+    counts = await invoice_repo.count_by_status()
+    pending = await invoice_repo.list_awaiting_review(10)
+    text = (f"🧾 <b>فاکتورها</b>\n\n▫️ در انتظار پرداخت: {counts.get('pending', 0)}\n▫️ تایید شده: {counts.get('approved', 0)}"
+            f"\n▫️ رد شده: {counts.get('rejected', 0)}\n▫️ منقضی شده: {counts.get('expired', 0)}\n\n")
+    kb = InlineKeyboardBuilder()
+    if not pending:
+        text += "✅ رسیدی در انتظار بررسی نیست."
+    for invoice in pending:
+        plan, _ = get_plan_by_key(invoice['plan_key'])
+        text += (f"#{invoice['id']}: {invoice['amount']} {invoice['symbol']}، {plan['label'] if plan else invoice['plan_key']}، "
+                 f"<a href='tg://user?id={invoice['user_id']}'>{invoice['user_id']}</a> ({invoice['receipts']} رسید)\n")
+        kb.row(types.InlineKeyboardButton(text=f"✅ #{invoice['id']}", callback_data=f"inv_ok_{invoice['id']}"),
+               types.InlineKeyboardButton(text=f"❌ #{invoice['id']}", callback_data=f"inv_no_{invoice['id']}"))
+    kb.row(types.InlineKeyboardButton(text="🔙 بازگشت به پنل ادمین", callback_data="admin_panel"))
+    await callback.message.edit_text(text, reply_markup=kb.as_markup())
+
+@router.callback_query(F.data == "admin_panel_status")
+async def admin_panel_status(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer()
+    per_node = [node.manager.connection_stats() for node in node_registry.nodes.values()]
+    stats = {key: sum(n[key] for n in per_node) for key in per_node[0]}
+    ops = sum(node.provisioner.stats['ops'] for node in node_registry.nodes.values())
+    panel_writes = sum(node.provisioner.stats['panel_writes'] for node in node_registry.nodes.values())
+    text = (
+        f"📡 **وضعیت اتصال به پنل**\n\n"
+        f"▫️ تعداد درخواست‌ها: {stats['requests']}\n"
+        f"▫️ اتصال‌های جدید: {stats['connections_opened']}\n"
+        f"▫️ استفاده مجدد از اتصال: {stats['connections_reused']}\n"
+        f"▫️ عملیات ساخت/تمدید: {ops} در {panel_writes} درخواست پنل\n"
+        f"▫️ کش عضویت کانال: {subscription_cache.hit_rate():.0%} ({subscription_cache.stats['hits']} hit / {subscription_cache.stats['misses']} miss)"
+    )
+    wait_p50, wait_p99 = outbound.wait_percentiles()
+    text += (f"\n▫️ صف ارسال تلگرام: {outbound.depth()} در انتظار، تاخیر p50 {wait_p50 * 1000:.0f}ms / p99 {wait_p99 * 1000:.0f}ms"
+             f"\n▫️ پیام‌های ارسالی: {outbound.stats['sent']} ({outbound.stats['flood_waits']} محدودیت RetryAfter)")
+    payments = await payment_repo.count_by_status()
+    text += (f"\n▫️ رسیدها: {payments.get('approved', 0)} تایید / {payments.get('review', 0)} بررسی دستی / {payments.get('pending', 0)} در انتظار شبکه"
+             f" ({payment_verifier.stats['approved']} تایید خودکار، {payment_verifier.stats['explorer_errors']} خطای اکسپلورر)")
+    jobs = await provision_job_repo.count_by_status()
+    text += (f"\n▫️ صف ساخت/تمدید: {jobs.get('pending', 0)} در انتظار / {jobs.get('running', 0)} در حال اجرا / {jobs.get('failed', 0)} ناموفق / {jobs.get('refunded', 0)} بازپرداخت"
+             f" ({provision_worker.stats['retries']} تلاش مجدد)")
+    text += "\n\n🛡 **وضعیت سرویس‌های بیرونی:**"
+    for policy in policies:
+        breaker = policy.breaker
+        state = {"closed": "🟢", "half_open": "🟡"}.get(breaker.state, f"🔴 تلاش بعدی تا {breaker.retry_in():.0f} ثانیه")
+        text += f"\n{state} `{policy.name}`: {policy.stats['calls']} درخواست، {policy.stats['retries']} تلاش مجدد، {breaker.stats['rejected']} رد سریع"
+    if len(node_registry.nodes) > 1:
+        text += "\n\n🖥 **نودها:**"
+        busiest = max(n.traffic_rate for n in node_registry.nodes.values())
+        for node in node_registry.nodes.values():
+            text += f"\n{'🟢' if node.healthy else '🔴'} {node.name}: {node.clients} کاربر، بار {node.load(busiest):.2f}"
+    if UPDATE_MODE == 'webhook':
+        q = update_queue.stats
+        text += (f"\n▫️ صف آپدیت‌ها: {update_queue.depth()}/{update_queue.capacity()} (بیشینه {q['max_depth']})"
+                 f"\n▫️ آپدیت‌ها: {q['processed']} پردازش / {q['rejected']} رد شده / {q['errors']} خطا")
+    kb = InlineKeyboardBuilder().row(types.InlineKeyboardButton(text="🔙 بازگشت به پنل ادمین", callback_data="admin_panel"))
+    await callback.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode=ParseMode.MARKDOWN)
+
 @router.callback_query(F.data == "bulk_create_start")
 async def bulk_create_start(callback: CallbackQuery, state: FSMContext):
     kb = InlineKeyboardBuilder()
@@ -866,45 +3741,23 @@ async def bulk_create_process(message: Message, state: FSMContext):
     plan_key = data['plan_key']
     plan, service = get_plan_by_key(plan_key)
     quantity, prefix = data['quantity'], message.text
-    await message.answer(f"✅ در حال ساخت {quantity} اشتراک از پلن '{plan['label']}'. لطفاً صبر کنید...")
-    token = await txui_manager.get_token()
-    if not token:
-        await message.answer("❌ خطا در ارتباط با پنل.")
-        return await state.clear()
-    async with httpx.AsyncClient(base_url=TXUI_PANEL_URL, verify=False, timeout=60.0) as client:
-        cookies = {"3x-ui": token}
-        try:
-            inbounds_res = await client.get("/panel/api/inbounds/list", cookies=cookies)
-            target_inbound = next((i for i in inbounds_res.json().get('obj', []) if i.get('remark') == TEST_INBOUND_REMARK), None)
-            if not target_inbound: return await message.answer("⛔️ اینباند یافت نشد.")
-            target_inbound_id = target_inbound['id']
-            inbound_detail_res = await client.get(f"/panel/api/inbounds/get/{target_inbound_id}", cookies=cookies)
-            inbound_obj = inbound_detail_res.json()['obj']
-            inbound_settings = json.loads(inbound_obj['settings'])
-            current_clients = inbound_settings.get('clients', [])
-            new_clients, generated_links = [], []
-            for i in range(quantity):
-                remark, new_uuid = f"{prefix}_{uuid.uuid4().hex[:6]}", str(uuid.uuid4())
-                new_client_obj = {"id": new_uuid, "email": remark, "totalGB": int(plan['limit'] * 1024 * 1024 * 1024), "expiryTime": int((datetime.now() + timedelta(days=plan['days'])).timestamp() * 1000), "limitIp": 2, "enable": True}
-                new_clients.append(new_client_obj)
-                server_address, server_port = SERVER_DOMAIN, target_inbound['port']
-                stream_settings = json.loads(target_inbound.get('streamSettings') or '{}')
-                params = {'type': stream_settings.get('network', 'tcp'), 'security': stream_settings.get('security', 'none')}
-                if params['security'] == 'tls': params['sni'] = stream_settings.get('tlsSettings', {}).get('serverName', server_address)
-                link = f"vless://{new_uuid}@{server_address}:{server_port}?{urlencode(params)}#{remark}"
-                generated_links.append(link)
-            current_clients.extend(new_clients)
-            inbound_settings['clients'] = current_clients
-            inbound_obj['settings'] = json.dumps(inbound_settings)
-            await client.post(f"/panel/api/inbounds/update/{target_inbound_id}", cookies=cookies, json=inbound_obj)
-            file_content = "\n".join(generated_links)
-            file_bio = io.BytesIO(file_content.encode('utf-8'))
-            await message.answer_document(types.BufferedInputFile(file_bio.getvalue(), f"{prefix}_configs.txt"), caption=f"✅ {quantity} اشتراک با موفقیت ساخته شد.")
-            await log_to_admins(f"ادمین {message.from_user.id} تعداد {quantity} اشتراک از پلن {plan['label']} ساخت.")
-        except Exception as e:
-            await message.answer("❌ خطای غیرمنتظره در ساخت اشتراک‌ها.")
-            await log_to_admins(f"خطای ساخت گروهی: {e}")
     await state.clear()
+    progress = await message.answer(f"✅ در حال ساخت {quantity} اشتراک از پلن '{plan['label']}'. لطفاً صبر کنید...")
+    job_id = await bulk_repo.create(message.from_user.id, plan_key, prefix, quantity)
+    await bulk_repo.set_progress_message(job_id, progress.chat.id, progress.message_id)
+    bulk_provisioner.start(job_id)
+
+@router.callback_query(F.data.startswith("bulk_resume_"))
+async def bulk_resume(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer()
+    job_id = int(callback.data.replace("bulk_resume_", ""))
+    job = await bulk_repo.get(job_id)
+    if not job or job['status'] == 'done' or bulk_provisioner.is_running(job_id):
+        return await callback.answer("این عملیات در حال اجرا است یا قبلاً تمام شده.", show_alert=True)
+    await callback.message.edit_text(f"⏳ ادامه ساخت گروهی #{job_id} از {job['committed']}/{job['quantity']}...")
+    await bulk_repo.set_progress_message(job_id, callback.message.chat.id, callback.message.message_id)
+    bulk_provisioner.start(job_id)
 
 @router.callback_query(F.data == "admin_test_panel")
 async def admin_test_panel(event: types.Union[Message, CallbackQuery]):
@@ -924,11 +3777,7 @@ async def process_wallet_charge_test(message: Message, state: FSMContext):
         return await message.answer("❌ لطفاً یک عدد صحیح و مثبت وارد کنید.")
     amount = int(message.text)
     admin_id = message.from_user.id
-    cur = db_conn.cursor()
-    cur.execute("UPDATE users SET wallet_balance = wallet_balance + ? WHERE user_id = ?", (amount, admin_id))
-    db_conn.commit()
-    cur.execute("SELECT wallet_balance FROM users WHERE user_id = ?", (admin_id,))
-    new_balance = cur.fetchone()['wallet_balance']
+    new_balance = await wallet_repo.credit(admin_id, amount, 'adjust')
     await message.answer(f"✅ مبلغ **{amount:,.0f} تومان** با موفقیت به کیف پول شما اضافه شد.\n"                         f"موجودی جدید شما: **{new_balance:,.0f} تومان**")
     await state.clear()
     await admin_test_panel(message)
@@ -944,15 +3793,10 @@ async def process_referral_test(message: Message, state: FSMContext):
         return await message.answer("❌ لطفاً یک عدد صحیح و مثبت وارد کنید.")
     fake_price = int(message.text)
     admin_id = message.from_user.id
-    commission = fake_price * 0.10
-    cur = db_conn.cursor()
-    cur.execute("UPDATE users SET wallet_balance = wallet_balance + ?, successful_referrals = successful_referrals + 1 WHERE user_id = ?",
-                (commission, admin_id))
-    db_conn.commit()
+    commission = fake_price // 10
+    successful_referrals = await wallet_repo.credit_referral(admin_id, commission, f"referral_test:{admin_id}:{time.time_ns()}")
     await message.answer(f"✅ تست خرید زیرمجموعه با موفقیت انجام شد.\n▫️ مبلغ **{commission:,.0f} تومان** (۱۰٪ از {fake_price:,.0f}) به کیف پول شما اضافه شد.\n▫️ شمارنده زیرمجموعه‌های موفق شما یک عدد افزایش یافت.")
-    cur.execute("SELECT successful_referrals FROM users WHERE user_id = ?", (admin_id,))
-    referrer_stats = cur.fetchone()
-    if referrer_stats and referrer_stats['successful_referrals'] == 10:
+    if successful_referrals == 10:
         await message.answer("🎉 **تبریک!** شما به ۱۰ زیرمجموعه موفق رسیدید. در حال ساخت سرویس هدیه برای شما...")
         reward_plan = SUB_PLANS_V2.get(FREE_REWARD_PLAN_KEY)
         fake_msg = await message.answer("درحال ساخت سرویس هدیه تستی...")
@@ -961,24 +3805,281 @@ async def process_referral_test(message: Message, state: FSMContext):
     await state.clear()
     await admin_test_panel(message)
 
+# --- Subscription Endpoint ---
+# GET {SUB_URL_PATH}/<token> returns the user's active configs as a base64 link list, the format v2rayNG,
+# v2rayN, Hiddify and friends poll. Links are rendered from the services table with each node's current
+# server_domain, so moving a node to a new address only needs a config change. Bodies are cached per token
+# and every response carries an ETag, so the steady polling from client apps is answered with a 304.
+class SubscriptionServer:
+    HOST = re.compile(r'@[^:/?#@]+:')
+
+    def __init__(self, ttl: int = SUB_URL_CACHE_TTL, size: int = SUB_URL_CACHE_SIZE):
+        self.ttl, self.size = ttl, size
+        self._cache = OrderedDict()
+        self._tokens = {}
+        self.stats = {"requests": 0, "not_modified": 0, "hits": 0, "renders": 0}
+
+    @staticmethod
+    def url(token: str) -> str:
+        return f"{SUB_URL_BASE.rstrip('/')}{SUB_URL_PATH}/{token}"
+
+    def invalidate(self, user_id: int):
+        token = self._tokens.pop(user_id, None)
+        if token: self._cache.pop(token, None)
+
+    async def _render(self, token: str):
+        user_id = await user_repo.get_by_sub_token(token)
+        if user_id is None:
+            return None
+        links = [self.HOST.sub(f"@{node_registry.get(svc['node']).server_domain}:", svc['config'], count=1)
+                 for svc in await service_repo.list_active(user_id) if svc['config']]
+        body = base64.b64encode("\n".join(links).encode()).decode()
+        self.stats["renders"] += 1
+        return user_id, body, '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+
+    async def handle(self, request: web.Request):
+        self.stats["requests"] += 1
+        token = request.match_info['token']
+        entry = self._cache.get(token)
+        if entry and entry[3] > time.monotonic():
+            self._cache.move_to_end(token)
+            self.stats["hits"] += 1
+        else:
+            rendered = await self._render(token)
+            if rendered is None:
+                return web.Response(status=404)
+            entry = self._cache[token] = (*rendered, time.monotonic() + self.ttl)
+            self._tokens[entry[0]] = token
+            while len(self._cache) > self.size:
+                evicted = self._cache.popitem(last=False)[1]
+                self._tokens.pop(evicted[0], None)
+        _, body, etag, _ = entry
+        headers = {"ETag": etag, "Cache-Control": f"max-age={self.ttl}", "Profile-Update-Interval": str(SUB_URL_UPDATE_HOURS)}
+        if etag in request.headers.get('If-None-Match', ''):
+            self.stats["not_modified"] += 1
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=body, headers=headers, content_type='text/plain')
+
+subscription_server = SubscriptionServer()
+
+@router.callback_query(F.data == "subscription_link")
+async def subscription_link(callback: CallbackQuery):
+    url = subscription_server.url(await user_repo.get_sub_token(callback.from_user.id))
+    kb = InlineKeyboardBuilder().row(types.InlineKeyboardButton(text="🔙 بازگشت", callback_data="main_menu"))
+    await callback.message.edit_text(
+        f"🔗 <b>لینک اشتراک شما</b>\n\n<code>{url}</code>\n\n"
+        f"این لینک را در برنامه خود (v2rayNG، v2rayN، Hiddify و ...) به عنوان Subscription اضافه کنید تا همه سرویس‌های فعال شما همیشه به‌روز بمانند.",
+        reply_markup=kb.as_markup())
+
+# --- Webhook Ingestion ---
+# Updates POSTed by Telegram are acknowledged as soon as they are queued and handled by a pool of
+# dispatcher workers. Each worker owns one bounded shard and updates are sharded by user, so one
+# user's updates are always handled in order while different users proceed in parallel.
+class UpdateQueue:
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int = UPDATE_WORKERS, maxsize: int = UPDATE_QUEUE_SIZE):
+        self.dp, self.bot = dispatcher, bot
+        self.shards = [asyncio.Queue(maxsize=max(1, maxsize // max(1, workers))) for _ in range(max(1, workers))]
+        self._tasks = []
+        self.stats = {"received": 0, "processed": 0, "rejected": 0, "errors": 0, "max_depth": 0, "enqueue_wait": 0.0}
+
+    @staticmethod
+    def shard_key(data: dict) -> int:
+        for value in data.values():
+            if isinstance(value, dict):
+                sender = value.get('from') or value.get('user') or (value.get('message') or {}).get('from') or value.get('chat')
+                if isinstance(sender, dict) and 'id' in sender:
+                    return sender['id']
+        return data.get('update_id', 0)
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.shards)
+
+    def capacity(self) -> int:
+        return sum(q.maxsize for q in self.shards)
+
+    async def put(self, data: dict) -> bool:
+        # Blocks up to UPDATE_ENQUEUE_TIMEOUT when the user's shard is full; a False return makes the
+        # webhook answer 503 so Telegram redelivers later instead of the bot buffering without limit.
+        self.stats["received"] += 1
+        queue = self.shards[hash(self.shard_key(data)) % len(self.shards)]
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(queue.put(data), UPDATE_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            return False
+        self.stats["enqueue_wait"] += time.monotonic() - started
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.depth())
+        return True
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            data = await queue.get()
+            try:
+                update = Update.model_validate(data, context={"bot": self.bot})
+                await self.dp.feed_update(self.bot, update)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error handling update {data.get('update_id')}: {e}")
+            finally:
+                queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self.shards]
+
+    async def close(self, timeout: float = 10):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.shards)), timeout)
+        except asyncio.TimeoutError:
+            print(f"Dropping {self.depth()} queued updates on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+update_queue = UpdateQueue(dp, bot)
+
+async def handle_webhook(request: web.Request):
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict) or 'update_id' not in data:
+        return web.Response(status=400)
+    if not await update_queue.put(data):
+        return web.Response(status=503, headers={'Retry-After': '1'})
+    return web.Response(text='ok')
+
+def build_web_app() -> web.Application:
+    app = web.Application()
+    if UPDATE_MODE == 'webhook':
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    if SUB_URL_BASE:
+        app.router.add_get(SUB_URL_PATH.rstrip('/') + '/{token}', subscription_server.handle)
+    return app
+
+async def start_web_server() -> web.AppRunner:
+    runner = web.AppRunner(build_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT).start()
+    return runner
+
+async def run_webhook():
+    # Telegram redelivers pending updates as soon as the port answers, so the database, repositories and
+    # background workers must be up before the site and the dispatcher workers start
+    await dp.emit_startup(bot=bot)
+    runner = None
+    try:
+        update_queue.start()
+        runner = await start_web_server()
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                                  allowed_updates=dp.resolve_used_update_types(), max_connections=100)
+        print(f"Webhook listening on {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        if runner:
+            await runner.cleanup()
+        await update_queue.close()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+# Collected only when /metrics is scraped
+async def fsm_state_counts() -> dict:
+    storage = dp.fsm.storage
+    if isinstance(storage, SQLiteStorage):
+        rows = await db.fetchall("SELECT state, COUNT(*) AS n FROM fsm_states WHERE state IS NOT NULL GROUP BY state")
+        return {(r['state'],): r['n'] for r in rows}
+    if isinstance(storage, MemoryStorage):
+        counts = {}
+        for record in storage.storage.values():
+            if record.state: counts[(record.state,)] = counts.get((record.state,), 0) + 1
+        return counts
+    return {}
+
+metrics.gauge('bot_fsm_states', 'Users currently inside each FSM state', fsm_state_counts, ('state',))
+metrics.gauge('bot_telegram_send_queue_depth', 'Bot API calls waiting for rate-limit tokens', outbound.depth)
+metrics.gauge('bot_update_queue_depth', 'Webhook updates queued for dispatcher workers', update_queue.depth)
+metrics.gauge('bot_db_pending_writes', 'Statements waiting for the next group commit', lambda: len(db._pending))
+metrics.gauge('bot_provisioning_ops', 'Provisioning operations submitted per node', lambda: {(n.name,): n.provisioner.stats['ops'] for n in node_registry.nodes.values()}, ('node',))
+metrics.gauge('bot_node_healthy', 'Whether each panel node passes health checks', lambda: {(n.name,): int(n.healthy) for n in node_registry.nodes.values()}, ('node',))
+async def payment_counts() -> dict:
+    return {(status,): n for status, n in (await payment_repo.count_by_status()).items()}
+
+async def invoice_counts() -> dict:
+    return {(status,): n for status, n in (await invoice_repo.count_by_status()).items()}
+
+async def provision_job_counts() -> dict:
+    return {(status,): n for status, n in (await provision_job_repo.count_by_status()).items()}
+
+metrics.gauge('bot_payments', 'Submitted crypto receipts by verification status', payment_counts, ('status',))
+metrics.gauge('bot_invoices', 'Crypto invoices by status', invoice_counts, ('status',))
+metrics.gauge('bot_provision_jobs', 'Paid provisioning jobs by status', provision_job_counts, ('status',))
+metrics.gauge('bot_circuit_state', 'Circuit breaker state per backend (0 closed, 1 half-open, 2 open)',
+              lambda: {(p.name,): CircuitBreaker.STATES[p.breaker.state] for p in policies}, ('backend',))
+metrics.gauge('bot_price_age_seconds', 'Age of the cached crypto quotes', lambda: {(sym,): price_feed.age(sym) for sym in list(price_feed._prices)}, ('symbol',))
+
 @dp.startup()
 async def on_startup(bot: Bot):
-    create_db()
-    with sqlite3.connect("example.db") as conn:
-        c = conn.cursor()
-        for admin_id in ADMIN_IDS:
-            c.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (admin_id,))
-        conn.commit()
+    await qr_renderer.start()
+    await db.migrate()
+    await metrics.start()
+    await user_repo.ensure_exists(ADMIN_IDS)
     await bot.set_my_commands([BotCommand(command="start", description="شروع ربات")])
+    node_registry.start()
+    price_feed.start()
+    await bulk_provisioner.recover()
+    usage_monitor.start()
+    payment_verifier.start()
+    invoice_sweeper.start()
+    provision_worker.start()
+    if isinstance(dp.fsm.storage, SQLiteStorage):
+        dp.fsm.storage.start()
+
+@dp.shutdown()
+async def on_shutdown(bot: Bot):
+    await metrics.close()
+    await usage_monitor.close()
+    await payment_verifier.close()
+    await invoice_sweeper.close()
+    await provision_worker.close()
+    await bulk_provisioner.close()
+    await node_registry.close()
+    await price_feed.close()
+    qr_renderer.close()
+    await db.close()
+
+def register_middlewares():
+    dp.update.outer_middleware.register(TimingMiddleware())
+    dp.update.middleware.register(MaintenanceMiddleware())
+    router.message.middleware.register(RouteTagger())
+    router.callback_query.middleware.register(RouteTagger())
 
 async def main():
-    required_vars = [API_TOKEN, ADMIN_IDS, TXUI_PANEL_URL, TXUI_USERNAME, TXUI_PASSWORD, SERVER_DOMAIN, TEST_INBOUND_REMARK, WALLET_TRX, WALLET_TON]
+    panel_vars = [] if TXUI_NODES else [TXUI_PANEL_URL, TXUI_USERNAME, TXUI_PASSWORD, SERVER_DOMAIN, TEST_INBOUND_REMARK]
+    required_vars = [API_TOKEN, ADMIN_IDS, WALLET_TRX, WALLET_TON] + panel_vars
     if not all(required_vars):
         print("!!! خطای مهم: یک یا چند متغیر اصلی در فایل .env تعریف نشده است.")
         return
-    dp.update.middleware.register(MaintenanceMiddleware())
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per panel request otherwise
+    register_middlewares()
     print("Bot started...")
-    await dp.start_polling(bot)
+    if UPDATE_MODE == 'webhook':
+        await run_webhook()
+    elif SUB_URL_BASE:
+        runner = await start_web_server()
+        try:
+            await dp.start_polling(bot)
+        finally:
+            await runner.cleanup()
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     asyncio.run(main())
\ No newline at end of file